@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+"""
+Headless batch inference for archived conveyor footage.
+
+Re-scores recorded videos much faster than real time:
+  - a decode thread (PyAV) prefetches frames into a bounded queue,
+  - the model is called on batches of frames,
+  - annotated video (optional) is written by a separate thread,
+  - several files can be processed in parallel worker processes (--workers).
+
+Flip, trigger-line or --trigger-zones filtering and the stable-frames debounce come from
+trigger_logic.py, the same code the live server uses, so transitions match production.
+With zones every zone debounces on its own; rows carry the zone bit mask and each zone
+flip counts as one transition, like the server's per-zone events.
+
+Examples:
+  python batch_infer.py recordings/*.mp4 --out-dir scored --flip vertical --line-trigger-enabled
+  python batch_infer.py recordings/*.mp4 --out-dir scored --trigger-zones deploy/zones.json
+  python batch_infer.py recordings/ --out-dir scored --format parquet --workers 3 --annotate
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from queue import Queue
+
+import av
+import cv2
+
+from trigger_logic import (
+    FLIP_MODES,
+    TriggerDebouncer,
+    TriggerZones,
+    apply_flip,
+    detections_from_result,
+    draw_trigger_line,
+    filter_trigger_detections,
+)
+
+VIDEO_SUFFIXES = ('.mp4', '.avi', '.mkv', '.mov', '.h264', '.ts', '.webm')
+_EOF = object()
+
+# Loaded once per worker process.
+_model = None
+_model_batch_ok = True
+
+
+def _env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value not in (None, '') else default
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def _resolve_model_path(model_path: str) -> str:
+    """Same lookup as test_video.py: direct path, then under AI-Model/."""
+    if os.path.exists(model_path):
+        return model_path
+    alt = os.path.join("AI-Model", model_path) if not model_path.startswith("AI-Model") else None
+    if alt and os.path.exists(alt):
+        return alt
+    raise SystemExit(f"Error: model '{model_path}' not found" + (f" (also tried '{alt}')" if alt else ""))
+
+
+def _collect_sources(inputs: list[str]) -> list[Path]:
+    sources = []
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            sources.extend(sorted(p for p in path.rglob('*') if p.suffix.lower() in VIDEO_SUFFIXES))
+        elif path.exists():
+            sources.append(path)
+        else:
+            print(f"Skipping missing input: {item}", file=sys.stderr)
+    return sources
+
+
+def _decode_worker(path: Path, frames: Queue, stride: int, stop: threading.Event) -> None:
+    """Decode frames with PyAV and push (index, seconds, bgr) tuples; _EOF when done."""
+    try:
+        with av.open(str(path)) as container:
+            stream = container.streams.video[0]
+            stream.thread_type = 'AUTO'
+            time_base = float(stream.time_base) if stream.time_base else 0.0
+            for index, frame in enumerate(container.decode(stream)):
+                if stop.is_set():
+                    break
+                if index % stride:
+                    continue
+                seconds = float(frame.pts * time_base) if frame.pts is not None else None
+                frames.put((index, seconds, frame.to_ndarray(format='bgr24')))
+    except Exception as e:
+        frames.put(e)
+    finally:
+        frames.put(_EOF)
+
+
+def _annotated_writer(path: Path, fps: float, frames: Queue) -> None:
+    writer = None
+    while True:
+        item = frames.get()
+        if item is _EOF:
+            break
+        if writer is None:
+            h, w = item.shape[:2]
+            writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+        writer.write(item)
+    if writer is not None:
+        writer.release()
+
+
+def _load_model(model_path: str):
+    global _model
+    if _model is None:
+        from ultralytics import YOLO
+        _model = YOLO(model_path, task='detect')
+    return _model
+
+
+def _predict(model, frames: list, opts: dict) -> list:
+    """Run one batch; fall back to per-frame calls for exports with a fixed batch of 1."""
+    global _model_batch_ok
+    kwargs = {'conf': opts['conf'], 'verbose': False}
+    if not opts['model'].lower().endswith('.onnx'):
+        # Same rule as the server: fixed-shape ONNX exports use their native size.
+        kwargs['imgsz'] = opts['imgsz']
+    if _model_batch_ok and len(frames) > 1:
+        try:
+            return model(frames, **kwargs)
+        except Exception as e:
+            _model_batch_ok = False
+            print(f"Batched inference failed ({e}); falling back to batch size 1", file=sys.stderr)
+    results = []
+    for frame in frames:
+        results.extend(model(frame, **kwargs))
+    return results
+
+
+class _RowWriter:
+    """Write per-frame rows as JSONL (streamed) or Parquet (buffered, needs pyarrow)."""
+
+    def __init__(self, path: Path, fmt: str):
+        self.path = path
+        self.fmt = fmt
+        self.rows = []
+        self.fh = open(path, 'w', encoding='utf-8') if fmt == 'jsonl' else None
+
+    def write(self, row: dict) -> None:
+        if self.fh is not None:
+            self.fh.write(json.dumps(row, separators=(',', ':')) + '\n')
+        else:
+            self.rows.append(row)
+
+    def close(self) -> None:
+        if self.fh is not None:
+            self.fh.close()
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        for row in self.rows:
+            # Parquet wants a stable schema; keep boxes as a JSON string column.
+            row['detections'] = json.dumps(row['detections'], separators=(',', ':'))
+        pq.write_table(pa.Table.from_pylist(self.rows), self.path)
+
+
+def process_file(path: str, opts: dict) -> dict:
+    """Score one video and return summary stats (runs in a worker process when --workers > 1)."""
+    path = Path(path)
+    model = _load_model(opts['model'])
+    names = getattr(model, 'names', None)
+    out_dir = Path(opts['out_dir'])
+    suffix = '.parquet' if opts['format'] == 'parquet' else '.jsonl'
+    rows = _RowWriter(out_dir / f"{path.stem}{suffix}", opts['format'])
+
+    frames: Queue = Queue(maxsize=opts['prefetch'])
+    stop = threading.Event()
+    decoder = threading.Thread(target=_decode_worker, args=(path, frames, opts['stride'], stop), daemon=True)
+    decoder.start()
+
+    annotated = None
+    writer_thread = None
+    if opts['annotate']:
+        with av.open(str(path)) as probe:
+            rate = probe.streams.video[0].average_rate
+        fps = (float(rate) if rate else 20.0) / opts['stride']
+        annotated = Queue(maxsize=opts['prefetch'])
+        writer_thread = threading.Thread(
+            target=_annotated_writer,
+            args=(out_dir / f"{path.stem}.annotated.mp4", fps, annotated),
+            daemon=True,
+        )
+        writer_thread.start()
+
+    debouncer = TriggerDebouncer()
+    stable_frames = opts['trigger_stable_frames'] if opts['line_trigger_enabled'] else 1
+    zones = None
+    if opts['trigger_zones']:
+        # Fresh per video so debounce state never carries over between files.
+        zones = TriggerZones.from_config(
+            opts['trigger_zones'],
+            default_min_conf=opts['trigger_min_conf'],
+            default_stable_frames=opts['trigger_stable_frames'],
+        )
+    stats = {'source': str(path), 'frames': 0, 'transitions': 0, 'seconds': 0.0, 'error': None}
+    started = time.perf_counter()
+    done = False
+    try:
+        while not done:
+            batch = []
+            while len(batch) < opts['batch']:
+                item = frames.get()
+                if item is _EOF:
+                    done = True
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch.append(item)
+            if not batch:
+                break
+
+            images = [apply_flip(img, opts['flip']) for _, _, img in batch]
+            results = _predict(model, images, opts)
+            for (index, seconds, _), image, result in zip(batch, images, results):
+                h, w = image.shape[:2]
+                dets = detections_from_result(result, names)
+                if zones is not None:
+                    changes = zones.update(dets, w, h)
+                    zone_mask = zones.state_mask
+                    trigger_count = int(zones.last_counts.sum())
+                    state = int(bool(zone_mask))
+                    transitions = len(changes)
+                else:
+                    trigger_dets = filter_trigger_detections(
+                        dets,
+                        w,
+                        h,
+                        line_trigger_enabled=opts['line_trigger_enabled'],
+                        line_y=opts['trigger_line_y'],
+                        side=opts['after_line_side'],
+                        cls_filter=opts['trigger_class'],
+                        min_conf=opts['trigger_min_conf'],
+                    )
+                    transitions = int(debouncer.update(bool(trigger_dets), stable_frames))
+                    trigger_count = len(trigger_dets)
+                    state = zone_mask = int(debouncer.state)
+                stats['transitions'] += transitions
+                rows.write({
+                    'source': path.name,
+                    'frame': index,
+                    't': round(seconds, 3) if seconds is not None else None,
+                    'count': len(dets),
+                    'trigger_count': trigger_count,
+                    'state': state,
+                    'zone_mask': zone_mask,
+                    'transition': int(transitions > 0),
+                    'detections': dets,
+                })
+                if annotated is not None:
+                    plotted = result.plot()
+                    if zones is not None:
+                        zones.draw(plotted, int(sum(1 << i for i, c in enumerate(zones.last_counts) if c)))
+                    elif opts['line_trigger_enabled']:
+                        draw_trigger_line(plotted, opts['trigger_line_y'], opts['after_line_side'], bool(trigger_count))
+                    annotated.put(plotted)
+            stats['frames'] += len(batch)
+    except Exception as e:
+        stats['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        stop.set()
+        # Unblock the decoder if it is waiting on a full queue.
+        while decoder.is_alive():
+            while not frames.empty():
+                frames.get_nowait()
+            decoder.join(timeout=0.1)
+        if annotated is not None:
+            annotated.put(_EOF)
+            writer_thread.join()
+        rows.close()
+
+    stats['seconds'] = round(time.perf_counter() - started, 2)
+    stats['fps'] = round(stats['frames'] / stats['seconds'], 1) if stats['seconds'] > 0 else 0.0
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless batch YOLO inference over recorded videos")
+    parser.add_argument("inputs", nargs='+', help="Video files and/or directories (searched recursively)")
+    parser.add_argument("--out-dir", required=True, help="Directory for per-video detection files")
+    parser.add_argument("--format", choices=['jsonl', 'parquet'], default='jsonl',
+                        help="Detection output format (parquet needs pyarrow)")
+    parser.add_argument("--annotate", action="store_true", help="Also write <name>.annotated.mp4")
+    parser.add_argument("--model", default=os.environ.get("MODEL_PATH", "AI-Model/runs/detect/nutricycle_foreign_only/weights/best.pt"))
+    parser.add_argument("--conf", type=float, default=_env_float("CONFIDENCE", 0.5))
+    parser.add_argument("--imgsz", type=int, default=_env_int("INFERENCE_IMGSZ", 320))
+    parser.add_argument("--flip", choices=FLIP_MODES, default=os.environ.get("FLIP_MODE", "none"))
+    parser.add_argument("--batch", type=int, default=8, help="Frames per model call")
+    parser.add_argument("--prefetch", type=int, default=64, help="Decoded frames buffered ahead of inference")
+    parser.add_argument("--stride", type=int, default=1, help="Score every Nth frame")
+    parser.add_argument("--workers", type=int, default=1, help="Parallel worker processes (one video each)")
+    parser.add_argument("--line-trigger-enabled", action="store_true",
+                        default=os.environ.get("LINE_TRIGGER_ENABLED", "").lower() in ('1', 'true', 'yes', 'on'))
+    parser.add_argument("--trigger-line-y", type=float, default=_env_float("TRIGGER_LINE_Y", 0.55))
+    parser.add_argument("--after-line-side", choices=['top', 'bottom'], default=os.environ.get("AFTER_LINE_SIDE", 'top'))
+    parser.add_argument("--trigger-stable-frames", type=int, default=_env_int("TRIGGER_STABLE_FRAMES", 3))
+    parser.add_argument("--trigger-min-conf", type=float, default=_env_float("TRIGGER_MIN_CONF", None))
+    parser.add_argument("--trigger-class", type=int, default=_env_int("TRIGGER_CLASS", None))
+    parser.add_argument("--trigger-zones", default=os.environ.get("TRIGGER_ZONES") or None,
+                        help="Trigger zones as a JSON file or inline JSON, as on the server (replaces the line)")
+    args = parser.parse_args()
+
+    trigger_min_conf = args.trigger_min_conf if args.trigger_min_conf is not None else args.conf
+    if args.trigger_zones:
+        try:
+            TriggerZones.from_config(args.trigger_zones)
+        except Exception as e:
+            parser.error(f"invalid --trigger-zones: {e}")
+
+    sources = _collect_sources(args.inputs)
+    if not sources:
+        raise SystemExit("No input videos found")
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    opts = {
+        'model': _resolve_model_path(args.model),
+        'out_dir': str(out_dir),
+        'format': args.format,
+        'annotate': args.annotate,
+        'conf': args.conf,
+        'imgsz': args.imgsz,
+        'flip': args.flip,
+        'batch': max(1, args.batch),
+        'prefetch': max(1, args.prefetch),
+        'stride': max(1, args.stride),
+        'line_trigger_enabled': args.line_trigger_enabled,
+        'trigger_line_y': args.trigger_line_y,
+        'after_line_side': args.after_line_side,
+        'trigger_stable_frames': max(1, args.trigger_stable_frames),
+        'trigger_min_conf': trigger_min_conf,
+        'trigger_class': args.trigger_class,
+        'trigger_zones': args.trigger_zones,
+    }
+
+    print(f"Scoring {len(sources)} video(s) with {opts['model']} (batch={opts['batch']}, workers={args.workers})")
+    started = time.perf_counter()
+    summaries = []
+    if args.workers <= 1:
+        for path in sources:
+            summaries.append(process_file(str(path), opts))
+            print(json.dumps(summaries[-1]))
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = [pool.submit(process_file, str(path), opts) for path in sources]
+            for future in as_completed(futures):
+                summaries.append(future.result())
+                print(json.dumps(summaries[-1]))
+
+    total_frames = sum(s['frames'] for s in summaries)
+    elapsed = time.perf_counter() - started
+    failed = [s for s in summaries if s['error']]
+    print(f"Done: {total_frames} frames in {elapsed:.1f}s ({total_frames / max(elapsed, 1e-6):.1f} fps), "
+          f"{sum(s['transitions'] for s in summaries)} transitions, {len(failed)} failed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
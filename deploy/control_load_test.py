@@ -0,0 +1,603 @@
+#!/usr/bin/env python3
+"""
+Control-plane load test: ESP32 command bursts through MQTT and /control, into a fake API.
+
+Runs webrtc_server.py against two stand-ins hosted by this script:
+  - a minimal MQTT 3.1.1 broker (QoS 0/1/2, + and # wildcards); it timestamps every
+    message the server publishes, so ESP32 forward latency needs no second client,
+  - a fake NutriCycle API (aiohttp) with --api-latency-ms/--api-jitter-ms and
+    --api-error-rate / --api-timeout-rate, which records every call it receives.
+
+It replays --rounds rounds of ESP32 traffic on the control topic. Each round per batch is
+a telemetry burst, then sorting -> grinding -> dehydration -> feed_completed. Telemetry
+without a batchNumber exercises the cached-batch / device-control path. An
+emergency_stop goes out every --estop-every messages, and --http-controls /control
+requests run alongside. After the server drains, the report gives:
+  - throughput and per-command latency (publish -> first API call, publish -> applied),
+  - API calls by endpoint and status, with retries (extra attempts for one command),
+    duplicates (a command applied twice), lost commands and out-of-order applies per batch,
+  - emergency_stop forward latency, /control response times and the server scheduler stats.
+
+Telemetry carries its sequence number in estimatedWeight so each PATCH maps back to the
+message behind it. --compare diffs against an earlier report, so changes to
+on_esp32_control / _ensure_latest_batch_number / patch_batch_status / control_handler can
+be measured. The exit code is 1 on duplicates, out-of-order applies, or losses with no
+injected errors.
+
+Example:
+  python deploy/control_load_test.py --batches 4 --rounds 5 --telemetry-per-batch 20 --rate 200 \\
+      --api-latency-ms 80 --api-error-rate 0.02 --output control_report.json
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from aiohttp import ClientSession, ClientTimeout, web
+
+SERVER = Path(__file__).resolve().parent / 'webrtc_server.py'
+MACHINE_ID = 'LOADTEST-01'
+TOKEN = 'control-load-test'
+STAGES = ('sorting', 'grinding', 'dehydration', 'feed_completed')
+# post_stage_update() renames these before patching feedStatus.
+FEED_STATUS = {'sorting': 'sorting', 'grinding': 'grinding', 'dehydration': 'dehydrating', 'feed_completed': 'completed'}
+
+
+# --- stand-in MQTT broker -------------------------------------------------------------
+
+def _mqtt_length(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte, n = n % 128, n // 128
+        out.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def _mqtt_str(value: str) -> bytes:
+    raw = value.encode()
+    return len(raw).to_bytes(2, 'big') + raw
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    pparts, tparts = pattern.split('/'), topic.split('/')
+    for i, part in enumerate(pparts):
+        if part == '#':
+            return True
+        if i >= len(tparts) or (part != '+' and part != tparts[i]):
+            return False
+    return len(pparts) == len(tparts)
+
+
+class _MqttSession:
+    def __init__(self, writer):
+        self.writer = writer
+        self.client_id = None
+        self.subscriptions = {}
+        self._next_pid = 0
+
+    def pid(self) -> bytes:
+        self._next_pid = self._next_pid % 65535 + 1
+        return self._next_pid.to_bytes(2, 'big')
+
+
+class StandInBroker:
+    """Just enough MQTT 3.1.1 for paho: connect, subscribe, publish (QoS <= 2), ping.
+
+    No retained messages, wills or persistent sessions. observe(topic, payload, at) is
+    called for every PUBLISH a client sends.
+    """
+
+    def __init__(self, observe=None):
+        self.observe = observe
+        self.sessions = set()
+        self.stats = collections.Counter()
+        self._server = None
+        self.port = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._handle, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            for session in list(self.sessions):
+                session.writer.close()
+            await self._server.wait_closed()
+
+    def subscribed(self, topic: str) -> bool:
+        return any(topic_matches(f, topic) for s in self.sessions for f in s.subscriptions)
+
+    def publish(self, topic: str, payload: bytes, qos: int = 0) -> None:
+        for session in list(self.sessions):
+            granted = [q for f, q in session.subscriptions.items() if topic_matches(f, topic)]
+            if not granted:
+                continue
+            out_qos = min(qos, max(granted), 1)
+            body = _mqtt_str(topic) + (session.pid() if out_qos else b'') + payload
+            session.writer.write(bytes([0x30 | (out_qos << 1)]) + _mqtt_length(len(body)) + body)
+            self.stats['delivered'] += 1
+
+    @staticmethod
+    async def _read_packet(reader):
+        first = (await reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        return first, (await reader.readexactly(length) if length else b'')
+
+    async def _handle(self, reader, writer) -> None:
+        session = _MqttSession(writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                first, body = await self._read_packet(reader)
+                kind = first >> 4
+                if kind == 1:      # CONNECT
+                    name_len = int.from_bytes(body[:2], 'big')
+                    pos = 2 + name_len + 4
+                    id_len = int.from_bytes(body[pos:pos + 2], 'big')
+                    session.client_id = body[pos + 2:pos + 2 + id_len].decode(errors='replace')
+                    writer.write(b'\x20\x02\x00\x00')
+                elif kind == 3:    # PUBLISH
+                    at = time.time()
+                    qos = (first >> 1) & 0x03
+                    topic_len = int.from_bytes(body[:2], 'big')
+                    topic = body[2:2 + topic_len].decode()
+                    pos = 2 + topic_len
+                    pid = body[pos:pos + 2] if qos else b''
+                    payload = body[pos + len(pid):]
+                    if qos == 1:
+                        writer.write(b'\x40\x02' + pid)
+                    elif qos == 2:
+                        writer.write(b'\x50\x02' + pid)
+                    self.stats['received'] += 1
+                    if self.observe is not None:
+                        self.observe(topic, payload, at)
+                    self.publish(topic, payload, qos)
+                elif kind == 6:    # PUBREL
+                    writer.write(b'\x70\x02' + body[:2])
+                elif kind == 8:    # SUBSCRIBE
+                    pos, codes = 2, bytearray()
+                    while pos < len(body):
+                        flen = int.from_bytes(body[pos:pos + 2], 'big')
+                        topic_filter = body[pos + 2:pos + 2 + flen].decode()
+                        qos = min(body[pos + 2 + flen] & 0x03, 1)
+                        session.subscriptions[topic_filter] = qos
+                        codes.append(qos)
+                        pos += 3 + flen
+                    writer.write(b'\x90' + _mqtt_length(2 + len(codes)) + body[:2] + bytes(codes))
+                elif kind == 10:   # UNSUBSCRIBE
+                    pos = 2
+                    while pos < len(body):
+                        flen = int.from_bytes(body[pos:pos + 2], 'big')
+                        session.subscriptions.pop(body[pos + 2:pos + 2 + flen].decode(), None)
+                        pos += 2 + flen
+                    writer.write(b'\xb0\x02' + body[:2])
+                elif kind == 12:   # PINGREQ
+                    writer.write(b'\xd0\x00')
+                elif kind == 14:   # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+
+# --- fake NutriCycle API --------------------------------------------------------------
+
+class FakeApi:
+    """Batch endpoints the control plane calls, with injected latency, errors and timeouts."""
+
+    def __init__(self, latency_ms: float, jitter_ms: float, error_rate: float, timeout_rate: float, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.rng = random.Random(seed)
+        self.calls = []
+        self.active_batch = None
+        self.batches_created = 0
+        self._runner = None
+        self.port = None
+
+    def _new_batch(self) -> str:
+        self.batches_created += 1
+        return f'API-{self.batches_created:04d}'
+
+    async def _handle(self, request):
+        arrived = time.time()
+        path = request.path[4:] if request.path.startswith('/api/') else request.path
+        try:
+            body = await request.json() if request.can_read_body else None
+        except Exception:
+            body = None
+        call = {'at': arrived, 'method': request.method, 'path': path, 'api_prefix': request.path != path,
+                'body': body, 'status': None}
+        self.calls.append(call)
+
+        delay = max(0.0, self.rng.gauss(self.latency_ms, self.jitter_ms)) / 1000.0
+        roll = self.rng.random()
+        if roll < self.timeout_rate:
+            delay = 12.0   # past the server's 10 s client timeout
+        await asyncio.sleep(delay)
+        if self.timeout_rate <= roll < self.timeout_rate + self.error_rate:
+            call['status'] = 500
+            return web.json_response({'error': 'injected'}, status=500)
+
+        parts = [p for p in path.split('/') if p]
+        if parts == ['machines', 'device', 'control']:
+            if (body or {}).get('action') == 'start':
+                self.active_batch = (body or {}).get('batchNumber') or self.active_batch or self._new_batch()
+            call['status'] = 200
+            return web.json_response({'batchNumber': self.active_batch})
+        if len(parts) == 4 and parts[0] == 'machines' and parts[2:] == ['device', 'status']:
+            call['status'] = 200
+            return web.json_response({'ok': True})
+        if parts == ['batches'] and request.method == 'POST':
+            self.active_batch = self._new_batch()
+            call['status'] = 201
+            return web.json_response({'batchNumber': self.active_batch}, status=201)
+        if len(parts) >= 2 and parts[0] == 'batches':
+            call['status'] = 200
+            return web.json_response({'batchNumber': parts[1], 'status': 'running', **(body or {})})
+        call['status'] = 404
+        return web.Response(status=404)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> int:
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.port = self._runner.addresses[0][1]
+        return self.port
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+# --- scenario -------------------------------------------------------------------------
+
+def build_scenario(args) -> list[dict]:
+    """ESP32 messages in send order, each tagged with what the API should see for it."""
+    batches = [f'BATCH-{i + 1:02d}' for i in range(args.batches)]
+    messages, seq = [], 0
+    for _ in range(args.rounds):
+        lanes = []
+        for batch in batches:
+            lane = []
+            for _ in range(args.telemetry_per_batch):
+                seq += 1
+                lane.append({'kind': 'telemetry', 'seq': seq, 'batch': batch, 'payload': {
+                    'batchNumber': batch, 'humidity': round(random.uniform(40, 70), 1),
+                    'temperature': round(random.uniform(20, 60), 1), 'estimatedWeight': seq,
+                }})
+            for stage in STAGES:
+                lane.append({'kind': 'stage', 'stage': FEED_STATUS[stage], 'batch': batch,
+                             'payload': {'command': stage, 'batchNumber': batch}})
+            lanes.append(lane)
+        for _ in range(args.unbatched_telemetry):
+            seq += 1
+            lanes.append([{'kind': 'telemetry', 'seq': seq, 'batch': None, 'payload': {
+                'humidity': 50.0, 'temperature': 30.0, 'estimatedWeight': seq,
+            }}])
+        # Interleave the batches the way several machines' worth of traffic would arrive.
+        while any(lanes):
+            for lane in lanes:
+                if lane:
+                    messages.append(lane.pop(0))
+    if args.estop_every > 0:
+        for i in range(args.estop_every, len(messages) + 1, args.estop_every + 1):
+            batch = messages[i - 1].get('batch')
+            messages.insert(i, {'kind': 'estop', 'batch': batch,
+                                'payload': {'command': 'emergency_stop', 'batchNumber': batch, 'machineId': MACHINE_ID}})
+    return messages
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {'n': 0}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(len(values) * q))], 1)
+
+    return {'n': len(values), 'p50': pick(0.5), 'p95': pick(0.95), 'max': round(values[-1], 1),
+            'mean': round(statistics.fmean(values), 1)}
+
+
+def analyse(messages: list[dict], api: FakeApi, forwards: list, http_latencies: list, scheduler: dict,
+            sent_window: tuple[float, float]) -> dict:
+    def ok(call):
+        return call['status'] is not None and call['status'] < 400
+
+    patches = [c for c in api.calls if c['method'] == 'PATCH' and c['path'].startswith('/batches/')]
+
+    # Telemetry: estimatedWeight is the message's sequence number.
+    attempts, applied = collections.defaultdict(list), collections.defaultdict(list)
+    for call in patches:
+        seq = (call['body'] or {}).get('estimatedWeight')
+        if isinstance(seq, int):
+            attempts[seq].append(call)
+            if ok(call):
+                applied[seq].append(call)
+    telemetry = [m for m in messages if m['kind'] == 'telemetry']
+    first_call = [(attempts[m['seq']][0]['at'] - m['sent_at']) * 1000.0 for m in telemetry if attempts.get(m['seq'])]
+    applied_ms = [(applied[m['seq']][0]['at'] - m['sent_at']) * 1000.0 for m in telemetry if applied.get(m['seq'])]
+    out_of_order = 0
+    highest = {}
+    for call in sorted((c for calls in applied.values() for c in calls), key=lambda c: c['at']):
+        batch, seq = call['path'].split('/')[2], call['body']['estimatedWeight']
+        if seq < highest.get(batch, 0):
+            out_of_order += 1
+        highest[batch] = max(highest.get(batch, 0), seq)
+
+    # Stage updates: matched FIFO per (batch, feedStatus), since the body carries no sequence.
+    stage_sent = collections.defaultdict(collections.deque)
+    for m in messages:
+        if m['kind'] == 'stage':
+            stage_sent[(m['batch'], m['stage'])].append(m['sent_at'])
+    stage_sent_count = {k: len(v) for k, v in stage_sent.items()}
+    stage_ms, stage_applied, stage_order_violations = [], collections.Counter(), 0
+    order = {s: i for i, s in enumerate(FEED_STATUS.values())}
+    last_stage = {}
+    for call in sorted((c for c in patches if ok(c) and 'feedStatus' in (c['body'] or {})), key=lambda c: c['at']):
+        batch, stage = call['path'].split('/')[2], call['body']['feedStatus']
+        stage_applied[(batch, stage)] += 1
+        if stage_sent[(batch, stage)]:
+            stage_ms.append((call['at'] - stage_sent[(batch, stage)].popleft()) * 1000.0)
+        previous = last_stage.get(batch)
+        if previous is not None and order.get(stage, 0) < order.get(previous, 0) and not (stage == 'sorting' and previous == 'completed'):
+            stage_order_violations += 1
+        last_stage[batch] = stage
+
+    estops = [m for m in messages if m['kind'] == 'estop']
+    estop_ms = []
+    pending_forwards = sorted(at for topic, payload, at in forwards if payload.get('command') == 'emergency_stop'
+                              and payload.get('source') != 'http_control')
+    for m in estops:
+        match = next((at for at in pending_forwards if at >= m['sent_at']), None)
+        if match is not None:
+            pending_forwards.remove(match)
+            estop_ms.append((match - m['sent_at']) * 1000.0)
+
+    start, end = sent_window
+    applied_total = sum(1 for v in applied.values() if v) + sum(stage_applied.values())
+    last_apply = max((c['at'] for c in api.calls if ok(c)), default=end)
+    by_endpoint = collections.Counter(
+        f"{c['method']} {'/batches/{n}' if c['path'].startswith('/batches/') else c['path']} {c['status']}" for c in api.calls
+    )
+    return {
+        'messages_sent': len(messages),
+        'send_seconds': round(end - start, 2),
+        'send_rate': round(len(messages) / max(1e-6, end - start), 1),
+        'applied_commands': applied_total,
+        'throughput_per_s': round(applied_total / max(1e-6, last_apply - start), 1),
+        'drain_seconds': round(max(0.0, last_apply - end), 2),
+        'telemetry': {
+            'sent': len(telemetry),
+            'first_call_ms': percentiles(first_call),
+            'applied_ms': percentiles(applied_ms),
+            'retries': sum(max(0, len(v) - 1) for v in attempts.values()),
+            'duplicates': sum(1 for v in applied.values() if len(v) > 1),
+            'lost': sum(1 for m in telemetry if not applied.get(m['seq'])),
+            'out_of_order': out_of_order,
+        },
+        'stages': {
+            'sent': sum(stage_sent_count.values()),
+            'applied_ms': percentiles(stage_ms),
+            'duplicates': sum(max(0, n - stage_sent_count.get(k, 0)) for k, n in stage_applied.items()),
+            'lost': sum(max(0, n - stage_applied.get(k, 0)) for k, n in stage_sent_count.items()),
+            'out_of_order': stage_order_violations,
+        },
+        'emergency_stop': {'sent': len(estops), 'forward_ms': percentiles(estop_ms)},
+        'http_control_ms': percentiles(http_latencies),
+        'api': {
+            'calls': len(api.calls),
+            'device_control_calls': sum(1 for c in api.calls if c['path'] == '/machines/device/control'),
+            'api_prefix_fallbacks': sum(1 for c in api.calls if c['api_prefix']),
+            'by_endpoint': dict(by_endpoint.most_common()),
+        },
+        'scheduler': scheduler,
+    }
+
+
+async def run(args, out: Path) -> dict:
+    forwards = []
+
+    def observe(topic, payload, at):
+        if topic.endswith('/command'):
+            try:
+                forwards.append((topic, json.loads(payload), at))
+            except ValueError:
+                pass
+
+    broker = StandInBroker(observe)
+    api = FakeApi(args.api_latency_ms, args.api_jitter_ms, args.api_error_rate, args.api_timeout_rate, args.seed)
+    broker_port = await broker.start()
+    api_port = await api.start()
+    base = f'http://127.0.0.1:{args.port}'
+    control_topic = f'nutricycle/rpi/control/{MACHINE_ID}'
+
+    cmd = [
+        sys.executable, str(SERVER),
+        '--source', 'synthetic:bars?fps=5',
+        '--host', '127.0.0.1', '--port', str(args.port),
+        '--mqtt-broker', '127.0.0.1', '--mqtt-port', str(broker_port),
+        '--server-url', f'http://127.0.0.1:{api_port}',
+        '--machine-id', MACHINE_ID,
+        '--control-token', TOKEN,
+    ]
+    if args.model:
+        cmd += ['--model', args.model]
+    cmd += [a for a in args.server_args if a != '--']
+    env = dict(os.environ, API_BASE_URL='', DEVICE_STATE_FILE=str(out / 'device_state.json'))
+    (out / 'device_state.json').unlink(missing_ok=True)
+    print(' '.join(cmd))
+    log = open(out / 'server.log', 'w')
+    server = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=SERVER.parent.parent)
+
+    try:
+        deadline = time.monotonic() + args.startup_timeout
+        while not broker.subscribed(control_topic):
+            if server.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f'server never subscribed to {control_topic} (see {out / "server.log"})')
+            await asyncio.sleep(0.5)
+        print(f"Server subscribed (broker :{broker_port}, fake API :{api_port}); sending")
+
+        random.seed(args.seed)
+        messages = build_scenario(args)
+        http_latencies = []
+        interval = 1.0 / args.rate if args.rate > 0 else 0.0
+
+        async with ClientSession(timeout=ClientTimeout(total=30)) as session:
+            async def http_control(command: str) -> None:
+                t0 = time.time()
+                try:
+                    async with session.post(f'{base}/control', json={'machine_id': MACHINE_ID, 'command': command},
+                                            headers={'Authorization': f'Bearer {TOKEN}'}) as resp:
+                        await resp.read()
+                        http_latencies.append((time.time() - t0) * 1000.0)
+                except Exception:
+                    pass
+
+            http_every = max(1, len(messages) // args.http_controls) if args.http_controls else 0
+            http_tasks = []
+            start = time.time()
+            for i, message in enumerate(messages):
+                message['sent_at'] = time.time()
+                broker.publish(control_topic, json.dumps(message['payload']).encode(), qos=1)
+                if http_every and i % http_every == 0 and len(http_tasks) < args.http_controls:
+                    http_tasks.append(asyncio.create_task(http_control(('pause', 'reset')[len(http_tasks) % 2])))
+                if interval:
+                    await asyncio.sleep(max(0.0, start + (i + 1) * interval - time.time()))
+                elif i % 50 == 49:
+                    await asyncio.sleep(0)
+            end = time.time()
+            await asyncio.gather(*http_tasks)
+
+            # Drained once the scheduler is empty and the API has been quiet for --quiet-s.
+            scheduler = {}
+            deadline = time.monotonic() + args.drain_timeout
+            while time.monotonic() < deadline:
+                await asyncio.sleep(0.5)
+                try:
+                    async with session.get(f'{base}/status') as resp:
+                        scheduler = (await resp.json()).get('control_scheduler') or {}
+                except Exception:
+                    continue
+                quiet = time.time() - max((c['at'] for c in api.calls), default=end)
+                if not scheduler.get('routine_pending') and not scheduler.get('active_lanes') and quiet >= args.quiet_s:
+                    break
+    finally:
+        if server.poll() is None:
+            server.send_signal(signal.SIGINT)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, server.wait, 30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        log.close()
+        await api.close()
+        await broker.close()
+
+    report = analyse(messages, api, forwards, http_latencies, scheduler, (start, end))
+    report['settings'] = {k: getattr(args, k) for k in (
+        'batches', 'rounds', 'telemetry_per_batch', 'unbatched_telemetry', 'estop_every', 'http_controls', 'rate',
+        'api_latency_ms', 'api_jitter_ms', 'api_error_rate', 'api_timeout_rate', 'seed',
+    )}
+    (out / 'api_calls.json').write_text(json.dumps(api.calls, indent=1))
+    return report
+
+
+def print_report(report: dict, baseline: dict | None) -> None:
+    def delta(path):
+        if not baseline:
+            return ''
+        old, new = baseline, report
+        for key in path:
+            old, new = (old or {}).get(key), (new or {}).get(key)
+        if isinstance(old, (int, float)) and isinstance(new, (int, float)):
+            return f"  ({new - old:+.1f} vs baseline)"
+        return ''
+
+    t, s = report['telemetry'], report['stages']
+    print(f"\nSent {report['messages_sent']} messages in {report['send_seconds']}s ({report['send_rate']}/s); "
+          f"applied {report['applied_commands']} at {report['throughput_per_s']}/s{delta(('throughput_per_s',))}, "
+          f"drained {report['drain_seconds']}s after the last send{delta(('drain_seconds',))}")
+    print(f"Telemetry  first call p50 {t['first_call_ms'].get('p50')} ms{delta(('telemetry', 'first_call_ms', 'p50'))}, "
+          f"applied p50/p95 {t['applied_ms'].get('p50')}/{t['applied_ms'].get('p95')} ms{delta(('telemetry', 'applied_ms', 'p95'))}; "
+          f"retries {t['retries']}, duplicates {t['duplicates']}, lost {t['lost']}, out of order {t['out_of_order']}")
+    print(f"Stages     applied p50/p95 {s['applied_ms'].get('p50')}/{s['applied_ms'].get('p95')} ms"
+          f"{delta(('stages', 'applied_ms', 'p95'))}; duplicates {s['duplicates']}, lost {s['lost']}, out of order {s['out_of_order']}")
+    e = report['emergency_stop']['forward_ms']
+    print(f"E-stop     forward p50/max {e.get('p50')}/{e.get('max')} ms over {e['n']}{delta(('emergency_stop', 'forward_ms', 'max'))}; "
+          f"/control p50/max {report['http_control_ms'].get('p50')}/{report['http_control_ms'].get('max')} ms")
+    a = report['api']
+    print(f"API        {a['calls']} calls ({a['device_control_calls']} device/control, {a['api_prefix_fallbacks']} /api fallbacks)")
+    for endpoint, count in a['by_endpoint'].items():
+        print(f"             {count:6d}  {endpoint}")
+    print(f"Scheduler  {json.dumps(report['scheduler'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MQTT/HTTP control-plane load test with a stand-in broker and fake API")
+    parser.add_argument("--batches", type=int, default=3, help="Concurrent batch lanes")
+    parser.add_argument("--rounds", type=int, default=3, help="Telemetry burst + stage sequence per batch, repeated")
+    parser.add_argument("--telemetry-per-batch", type=int, default=20)
+    parser.add_argument("--unbatched-telemetry", type=int, default=5, help="Telemetry without batchNumber per round")
+    parser.add_argument("--estop-every", type=int, default=0, help="Insert an emergency_stop every N messages (0 = none)")
+    parser.add_argument("--http-controls", type=int, default=0, help="POST /control pause/reset requests during the burst")
+    parser.add_argument("--rate", type=float, default=0.0, help="Messages per second (0 = one burst, as fast as possible)")
+    parser.add_argument("--api-latency-ms", type=float, default=50.0)
+    parser.add_argument("--api-jitter-ms", type=float, default=20.0)
+    parser.add_argument("--api-error-rate", type=float, default=0.0, help="Share of API calls answered 500")
+    parser.add_argument("--api-timeout-rate", type=float, default=0.0, help="Share of API calls held past the client timeout")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model", default=os.environ.get("MODEL_PATH"), help="Model for the server (default: its own)")
+    parser.add_argument("--port", type=int, default=18081)
+    parser.add_argument("--startup-timeout", type=float, default=180.0)
+    parser.add_argument("--drain-timeout", type=float, default=300.0)
+    parser.add_argument("--quiet-s", type=float, default=3.0, help="API silence that counts as drained")
+    parser.add_argument("--out", default='control_load_run', help="Directory for server.log and api_calls.json")
+    parser.add_argument("--output", default=None, help="Write the JSON report here (default: <out>/report.json)")
+    parser.add_argument("--compare", default=None, help="Earlier report to diff against")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER, help="Extra webrtc_server.py arguments after --")
+    args = parser.parse_args()
+
+    out = Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+    report = asyncio.run(run(args, out))
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare else None
+    print_report(report, baseline)
+    output = Path(args.output) if args.output else out / 'report.json'
+    output.write_text(json.dumps(report, indent=2))
+    print(f"Report written to {output}")
+
+    t, s = report['telemetry'], report['stages']
+    injected = args.api_error_rate > 0 or args.api_timeout_rate > 0
+    failed = (t['duplicates'] or s['duplicates'] or t['out_of_order'] or s['out_of_order']
+              or (not injected and (t['lost'] or s['lost'])))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
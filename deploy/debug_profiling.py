@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+On-demand CPU and memory profiling for webrtc_server.py's /debug endpoints, plus the
+memory-growth watchdog and the process probes soak_test.py samples.
+
+Nothing here runs until asked: the stack sampler is a short-lived thread that exists only
+for the duration of one /debug/profile request, and tracemalloc is started by the first
+/debug/memory call and stopped again with ?stop=1 or once no report has been asked for
+within the idle timeout, so an idle unit pays nothing.
+"""
+
+import collections
+import gc
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+MAX_PROFILE_SECONDS = 60.0
+
+
+def process_stats(pid: int | None = None) -> dict:
+    """RSS (MB), open fds, thread count and CPU seconds used, from /proc (None where unavailable)."""
+    base = Path('/proc') / (str(pid) if pid else 'self')
+    stats = {'rss_mb': None, 'fds': None, 'threads': None, 'cpu_s': None}
+    try:
+        for line in (base / 'status').read_text().splitlines():
+            if line.startswith('VmRSS:'):
+                stats['rss_mb'] = round(int(line.split()[1]) / 1024.0, 1)
+            elif line.startswith('Threads:'):
+                stats['threads'] = int(line.split()[1])
+    except (OSError, ValueError):
+        if pid is None:
+            import resource
+            # ru_maxrss is the peak, in KB on Linux and bytes on macOS; better than nothing.
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            stats['rss_mb'] = round(peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0), 1)
+            stats['threads'] = threading.active_count()
+    try:
+        stats['fds'] = len(os.listdir(base / 'fd'))
+    except OSError:
+        pass
+    if pid is None:
+        times = os.times()
+        stats['cpu_s'] = round(times.user + times.system, 2)
+    else:
+        try:
+            fields = (base / 'stat').read_text().rsplit(')', 1)[1].split()
+            stats['cpu_s'] = round((int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'), 2)
+        except (OSError, IndexError, ValueError):
+            pass
+    return stats
+
+
+def object_type_counts() -> collections.Counter:
+    """Live gc-tracked objects per type name (walks the whole heap: tens of ms to seconds)."""
+    counts = collections.Counter()
+    for obj in gc.get_objects():
+        counts[type(obj).__qualname__] += 1
+    return counts
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Sample every thread's Python stack at a fixed interval (one profile at a time).
+
+    Works across the event loop, executor and MQTT threads alike because it reads
+    sys._current_frames() instead of hooking a profiler into one thread. Output is
+    either collapsed stacks (flamegraph.pl / speedscope input) or per-function
+    self/total sample counts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    def sample(self, seconds: float, interval: float = 0.005) -> dict:
+        """Blocking; run off the event loop. Raises RuntimeError if a profile is already running."""
+        seconds = max(0.1, min(float(seconds), MAX_PROFILE_SECONDS))
+        interval = max(0.001, float(interval))
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError('A profile is already running')
+        try:
+            own = threading.get_ident()
+            stacks = collections.Counter()
+            samples = 0
+            start = time.perf_counter()
+            deadline = start + seconds
+            while time.perf_counter() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    labels = []
+                    while frame is not None:
+                        labels.append(_frame_label(frame.f_code))
+                        frame = frame.f_back
+                    labels.append(names.get(ident, f"thread-{ident}"))
+                    stacks[tuple(reversed(labels))] += 1
+                samples += 1
+                time.sleep(interval)
+            return {
+                'seconds': round(time.perf_counter() - start, 3),
+                'interval_ms': round(interval * 1000.0, 2),
+                'samples': samples,
+                'stacks': stacks,
+            }
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def collapsed(profile: dict) -> str:
+        """'thread;outer;...;inner count' lines, heaviest first."""
+        return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in profile['stacks'].most_common())
+
+    @staticmethod
+    def summary(profile: dict, limit: int = 40) -> dict:
+        """Per-thread sample totals and the top functions by self and total samples."""
+        threads = collections.Counter()
+        self_counts = collections.Counter()
+        total_counts = collections.Counter()
+        for stack, count in profile['stacks'].items():
+            threads[stack[0]] += count
+            if len(stack) > 1:
+                self_counts[stack[-1]] += count
+            for label in set(stack[1:]):
+                total_counts[label] += count
+        samples = max(1, profile['samples'])
+        return {
+            'seconds': profile['seconds'],
+            'interval_ms': profile['interval_ms'],
+            'samples': profile['samples'],
+            'threads': dict(threads.most_common()),
+            'top_self': [
+                {'function': f, 'samples': n, 'fraction': round(n / samples, 3)} for f, n in self_counts.most_common(limit)
+            ],
+            'top_total': [
+                {'function': f, 'samples': n, 'fraction': round(n / samples, 3)} for f, n in total_counts.most_common(limit)
+            ],
+        }
+
+
+class MemoryTracker:
+    """tracemalloc top allocations plus the growth since the previous report.
+
+    The first report starts tracing, so its "since previous" section is empty; later
+    reports diff against the snapshot taken by the one before. stop() ends tracing and
+    drops the stored snapshot; so does a timer that fires idle_s after the last report
+    (idle_s <= 0 leaves tracing on until stop()).
+    """
+
+    _FILTERS = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    )
+
+    def __init__(self, frames: int = 1, idle_s: float = 600.0):
+        self.frames = max(1, int(frames))
+        self.idle_s = max(0.0, float(idle_s))
+        self._lock = threading.Lock()
+        self._previous = None
+        self._previous_at = None
+        self._started_at = None
+        self._idle_timer = None
+
+    def _auto_stop_in(self) -> float | None:
+        if not self.idle_s or self._previous_at is None or not tracemalloc.is_tracing():
+            return None
+        return round(max(0.0, self._previous_at + self.idle_s - time.time()), 1)
+
+    def _arm_idle_timer(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        if self.idle_s:
+            self._idle_timer = threading.Timer(self.idle_s, self._idle_stop)
+            self._idle_timer.daemon = True
+            self._idle_timer.start()
+
+    def _idle_stop(self):
+        with self._lock:
+            # A report that raced the timer re-armed it; only stop if still idle.
+            if self._previous_at is None or time.time() - self._previous_at < self.idle_s:
+                return
+            self._stop_locked()
+
+    @staticmethod
+    def _stat(stat) -> dict:
+        frame = stat.traceback[0]
+        entry = {
+            'location': f"{frame.filename}:{frame.lineno}",
+            'size_kb': round(stat.size / 1024.0, 1),
+            'count': stat.count,
+        }
+        if hasattr(stat, 'size_diff'):
+            entry['size_diff_kb'] = round(stat.size_diff / 1024.0, 1)
+            entry['count_diff'] = stat.count_diff
+        return entry
+
+    def report(self, limit: int = 25, key_type: str = 'lineno') -> dict:
+        """Blocking (snapshots walk every traced block); run off the event loop."""
+        limit = max(1, int(limit))
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self._started_at = time.time()
+                self._previous = None
+            now = time.time()
+            snapshot = tracemalloc.take_snapshot().filter_traces(self._FILTERS)
+            current, peak = tracemalloc.get_traced_memory()
+            result = {
+                'tracing_since': self._started_at,
+                'traced_kb': round(current / 1024.0, 1),
+                'traced_peak_kb': round(peak / 1024.0, 1),
+                'tracemalloc_overhead_kb': round(tracemalloc.get_tracemalloc_memory() / 1024.0, 1),
+                'top': [self._stat(s) for s in snapshot.statistics(key_type)[:limit]],
+                'since_previous': None,
+            }
+            if self._previous is not None:
+                growth = [s for s in snapshot.compare_to(self._previous, key_type) if s.size_diff]
+                growth.sort(key=lambda s: abs(s.size_diff), reverse=True)
+                result['since_previous'] = {
+                    'seconds': round(now - self._previous_at, 1),
+                    'size_diff_kb': round(sum(s.size_diff for s in growth) / 1024.0, 1),
+                    'top': [self._stat(s) for s in growth[:limit]],
+                }
+            self._previous = snapshot
+            self._previous_at = now
+            self._arm_idle_timer()
+            result['idle_s'] = self.idle_s or None
+            result['auto_stop_in_s'] = self._auto_stop_in()
+            return result
+
+    def _stop_locked(self) -> bool:
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        was_tracing = tracemalloc.is_tracing()
+        tracemalloc.stop()
+        self._previous = None
+        self._previous_at = None
+        self._started_at = None
+        return was_tracing
+
+    def stop(self) -> dict:
+        with self._lock:
+            return {'stopped': self._stop_locked()}
+
+    def snapshot(self) -> dict:
+        return {
+            'tracing': tracemalloc.is_tracing(),
+            'tracing_since': self._started_at,
+            'auto_stop_in_s': self._auto_stop_in(),
+        }
+
+
+class MemoryWatchdog:
+    """Log the fastest-growing object types once RSS crosses a threshold.
+
+    check() is cheap on every call (a /proc read and the gc-tracked object total). The
+    per-type census only runs when RSS first reaches threshold_mb and again every further
+    step_mb, and is diffed against the census before it (the first one against a
+    baseline taken at startup), so each alert names what grew since the last one.
+    """
+
+    def __init__(self, threshold_mb: float, step_mb: float = 64.0, top: int = 15, logger=None):
+        self.threshold_mb = float(threshold_mb)
+        self.step_mb = max(1.0, float(step_mb))
+        self.top = max(1, int(top))
+        self.logger = logger
+        self._next_alert_mb = self.threshold_mb
+        self._baseline = None
+        self._baseline_at = None
+        self.started_at = time.time()
+        self.samples = 0
+        self.alerts = 0
+        self.last = {}
+        self.start_stats = None
+        self.last_alert = None
+
+    def check(self, gauges: dict | None = None) -> dict | None:
+        """Blocking; returns the alert dict when one fired. gauges are extra counters to record."""
+        stats = process_stats()
+        stats['gc_objects'] = len(gc.get_objects())
+        stats.update(gauges or {})
+        self.samples += 1
+        self.last = dict(stats, at=round(time.time(), 1))
+        if self._baseline is None:
+            # Startup baseline; taking it before the threshold keeps the first alert meaningful.
+            self.start_stats = dict(self.last)
+            self._baseline = object_type_counts()
+            self._baseline_at = time.time()
+            return None
+        rss = stats['rss_mb']
+        if rss is None or rss < self._next_alert_mb:
+            return None
+
+        counts = object_type_counts()
+        growth = [(name, n - self._baseline.get(name, 0), n) for name, n in counts.items()]
+        growth = [g for g in growth if g[1] > 0]
+        growth.sort(key=lambda g: g[1], reverse=True)
+        alert = {
+            'at': round(time.time(), 1),
+            'rss_mb': rss,
+            'since_s': round(time.time() - self._baseline_at, 1),
+            'growing_types': [{'type': name, 'added': added, 'live': live} for name, added, live in growth[:self.top]],
+            'gauges': stats,
+        }
+        self.alerts += 1
+        self.last_alert = alert
+        self._baseline = counts
+        self._baseline_at = time.time()
+        while self._next_alert_mb <= rss:
+            self._next_alert_mb += self.step_mb
+        if self.logger is not None:
+            top = ', '.join(f"{g['type']} +{g['added']} ({g['live']})" for g in alert['growing_types'][:8])
+            self.logger.warning(
+                f"Memory watchdog: RSS {rss:.0f} MB (fds {stats.get('fds')}, threads {stats.get('threads')}); "
+                f"fastest-growing types over {alert['since_s']:.0f}s: {top}"
+            )
+        return alert
+
+    def snapshot(self) -> dict:
+        return {
+            'threshold_mb': self.threshold_mb,
+            'next_alert_mb': self._next_alert_mb,
+            'samples': self.samples,
+            'alerts': self.alerts,
+            'start': self.start_stats,
+            'current': self.last,
+            'last_alert': self.last_alert,
+        }
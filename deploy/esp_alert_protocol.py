@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Compact ESP32 alert protocol for NutriCycle trigger events.
+
+Published on --mqtt-esp-topic when --esp-alert-format is 'binary' or 'csv'
+('json' keeps the legacy {"machine_id", "alert"} payload).
+
+binary (little-endian, 18 bytes):
+
+  struct nc_alert_v1 {
+      uint8_t  version;       // ALERT_PROTOCOL_VERSION
+      uint8_t  flags;         // bit0 = alert (1 detected, 0 clear)
+      uint32_t seq;           // per-topic sequence, starts at 1 after server start
+      uint64_t capture_ms;    // unix epoch ms when the triggering frame was captured
+      uint16_t pipeline_ms;   // capture -> publish delay measured on the Pi (saturates at 65535)
+      uint16_t zone_mask;     // bit N = trigger zone N occupied
+  } __attribute__((packed));
+
+csv (ASCII, sscanf-friendly):
+
+  "<version>,<seq>,<alert>,<capture_ms>,<pipeline_ms>,<zone_mask>"
+
+The device detects lost or reordered alerts from gaps in seq, ignores a repeated seq
+(the server retrying an alert it could not publish), treats seq == 1 as a server restart, and can estimate staleness as now_ms - capture_ms when its clock is synced.
+"""
+
+import struct
+
+ALERT_PROTOCOL_VERSION = 1
+ALERT_FORMATS = ('json', 'binary', 'csv')
+
+_BINARY_ALERT = struct.Struct('<BBIQHH')
+BINARY_ALERT_SIZE = _BINARY_ALERT.size
+
+_FLAG_ALERT = 0x01
+
+
+def encode_alert(
+    fmt: str,
+    seq: int,
+    alert: bool,
+    capture_ts: float,
+    publish_ts: float,
+    zone_mask: int = 0,
+) -> bytes:
+    """Encode one alert as 'binary' or 'csv' bytes (timestamps in epoch seconds)."""
+    capture_ms = max(0, int(round(capture_ts * 1000.0)))
+    pipeline_ms = min(0xFFFF, max(0, int(round((publish_ts - capture_ts) * 1000.0))))
+    seq = int(seq) & 0xFFFFFFFF
+    zone_mask = int(zone_mask) & 0xFFFF
+    if fmt == 'binary':
+        flags = _FLAG_ALERT if alert else 0
+        return _BINARY_ALERT.pack(ALERT_PROTOCOL_VERSION, flags, seq, capture_ms, pipeline_ms, zone_mask)
+    if fmt == 'csv':
+        fields = (ALERT_PROTOCOL_VERSION, seq, 1 if alert else 0, capture_ms, pipeline_ms, zone_mask)
+        return ','.join(str(f) for f in fields).encode('ascii')
+    raise ValueError(f"Unsupported alert format: {fmt}")
+
+
+def decode_alert(payload: bytes) -> dict:
+    """Decode a 'binary' or 'csv' alert payload; raises ValueError on malformed input."""
+    if len(payload) == BINARY_ALERT_SIZE and payload[0] == ALERT_PROTOCOL_VERSION:
+        version, flags, seq, capture_ms, pipeline_ms, zone_mask = _BINARY_ALERT.unpack(payload)
+        alert = bool(flags & _FLAG_ALERT)
+    else:
+        try:
+            parts = payload.decode('ascii').strip().split(',')
+            version, seq, alert_raw, capture_ms, pipeline_ms, zone_mask = (int(p) for p in parts)
+        except Exception as e:
+            raise ValueError(f"Malformed alert payload: {payload!r}") from e
+        alert = bool(alert_raw)
+    if version != ALERT_PROTOCOL_VERSION:
+        raise ValueError(f"Unsupported alert protocol version: {version}")
+    return {
+        'version': version,
+        'seq': seq,
+        'alert': 1 if alert else 0,
+        'capture_ms': capture_ms,
+        'pipeline_ms': pipeline_ms,
+        'zone_mask': zone_mask,
+    }
+
+
+class AlertSequencer:
+    """Monotonic per-topic sequence numbers for outgoing alerts."""
+
+    def __init__(self):
+        self._seq: dict[str, int] = {}
+
+    def next(self, topic: str) -> int:
+        seq = (self._seq.get(topic, 0) % 0xFFFFFFFF) + 1
+        self._seq[topic] = seq
+        return seq
+
+    def snapshot(self) -> dict[str, int]:
+        return dict(self._seq)
+
+
+class AlertGapTracker:
+    """Receiver-side bookkeeping mirroring what the ESP32 firmware should do."""
+
+    def __init__(self):
+        self.last_seq = None
+        self.received = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.restarts = 0
+
+    def observe(self, seq: int) -> str:
+        """Return 'ok', 'gap', 'duplicate', 'reordered' or 'restart' for the given sequence number."""
+        self.received += 1
+        last, self.last_seq = self.last_seq, seq
+        if last is None:
+            return 'ok'
+        if seq == last:
+            self.duplicates += 1
+            return 'duplicate'
+        if seq == 1:
+            self.restarts += 1
+            return 'restart'
+        if seq == last + 1:
+            return 'ok'
+        if seq > last + 1:
+            self.lost += seq - last - 1
+            return 'gap'
+        self.reordered += 1
+        self.last_seq = last
+        return 'reordered'
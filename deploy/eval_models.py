@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Accuracy vs. latency sweep across model exports and inference sizes.
+
+Runs the labelled validation split through every model given (.pt, .onnx, NCNN export
+directories) at each --imgsz, measuring on this machine:
+  - mAP50 / mAP50-95 (Ultralytics val),
+  - precision / recall of --target-class (foreign_object by default),
+  - single-frame predict latency (mean / p50 / p95 over --latency-images frames).
+
+Writes a JSON report (and prints a table) marking the Pareto-optimal settings, i.e. those
+no other setting beats on latency, mAP50 and target recall at once. Pass --compare with an
+older report to see per-setting deltas between model versions.
+
+Fixed-shape exports (ONNX/NCNN) are evaluated once, at the size recorded in their metadata;
+use --export onnx ncnn to export the .pt model at every --imgsz into --export-dir first.
+
+Example (on the Pi):
+  python deploy/eval_models.py --data path/to/data.yaml \
+      --models deploy/models/best.pt deploy/models/best.onnx deploy/models/best3_ncnn_model \
+      --imgsz 256 320 416 512 --output eval_report.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from ultralytics import YOLO
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def model_format(path: str) -> str:
+    p = Path(path)
+    if p.is_dir() and (p / "model.ncnn.param").exists():
+        return 'ncnn'
+    if p.suffix.lower() == '.onnx':
+        return 'onnx'
+    if p.suffix.lower() == '.pt':
+        return 'pt'
+    return p.suffix.lstrip('.').lower() or 'unknown'
+
+
+def exported_imgsz(path: str) -> int | None:
+    """Input size baked into a fixed-shape export (None for .pt or when unknown)."""
+    fmt = model_format(path)
+    try:
+        if fmt == 'ncnn':
+            import yaml
+            meta = yaml.safe_load((Path(path) / 'metadata.yaml').read_text())
+        elif fmt == 'onnx':
+            import ast
+            import onnxruntime
+            raw = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider']).get_modelmeta().custom_metadata_map
+            meta = {'imgsz': ast.literal_eval(raw['imgsz'])} if 'imgsz' in raw else {}
+        else:
+            return None
+        imgsz = meta.get('imgsz')
+        return int(imgsz[0] if isinstance(imgsz, (list, tuple)) else imgsz) if imgsz else None
+    except Exception:
+        return None
+
+
+def export_variants(pt_path: str, formats: list[str], sizes: list[int], export_dir: Path) -> list[str]:
+    """Export pt_path once per (format, imgsz), reusing earlier exports found in export_dir."""
+    exported = []
+    export_dir.mkdir(parents=True, exist_ok=True)
+    stem = Path(pt_path).stem
+    for fmt in formats:
+        for imgsz in sizes:
+            target = export_dir / (f"{stem}_{imgsz}_ncnn_model" if fmt == 'ncnn' else f"{stem}_{imgsz}.{fmt}")
+            if not target.exists():
+                print(f"Exporting {pt_path} -> {fmt} @ {imgsz}")
+                # Ultralytics writes next to the weights; export a scratch copy so nothing lands
+                # beside (or overwrites exports of) the source model.
+                with tempfile.TemporaryDirectory(dir=export_dir) as scratch:
+                    weights = shutil.copy2(pt_path, scratch)
+                    out = YOLO(weights).export(format=fmt, imgsz=imgsz)
+                    shutil.move(str(out), str(target))
+            exported.append(str(target))
+    return exported
+
+
+def validation_images(data_yaml: str, split: str, limit: int) -> list[str]:
+    from ultralytics.data.utils import check_det_dataset
+
+    data = check_det_dataset(data_yaml)
+    roots = data.get(split) or data.get('val')
+    roots = roots if isinstance(roots, list) else [roots]
+    images = []
+    for root in roots:
+        root = Path(root)
+        if root.is_file() and root.suffix == '.txt':
+            images.extend(line.strip() for line in root.read_text().splitlines() if line.strip())
+        else:
+            images.extend(str(p) for p in sorted(root.rglob('*')) if p.suffix.lower() in IMAGE_SUFFIXES)
+    return images[:limit]
+
+
+def measure_latency(model, images: list[str], imgsz: int, conf: float, warmup: int, fixed_shape: bool) -> dict:
+    import cv2
+
+    frames = [f for f in (cv2.imread(p) for p in images) if f is not None]
+    if not frames:
+        return {}
+    kwargs = {'conf': conf, 'verbose': False}
+    if not fixed_shape:
+        kwargs['imgsz'] = imgsz
+    for frame in frames[:warmup]:
+        model(frame, **kwargs)
+    samples = []
+    for frame in frames:
+        t0 = time.perf_counter()
+        model(frame, **kwargs)
+        samples.append((time.perf_counter() - t0) * 1000.0)
+    samples.sort()
+    return {
+        'mean': round(statistics.fmean(samples), 2),
+        'p50': round(samples[len(samples) // 2], 2),
+        'p95': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+        'n': len(samples),
+    }
+
+
+def evaluate(model_path: str, imgsz: int, args, images: list[str]) -> dict:
+    fmt = model_format(model_path)
+    entry = {'model': model_path, 'format': fmt, 'imgsz': imgsz, 'error': None}
+    try:
+        model = YOLO(model_path, task='detect')
+        metrics = model.val(
+            data=args.data, imgsz=imgsz, batch=1, split=args.split, device=args.device,
+            conf=args.val_conf, plots=False, verbose=False,
+        )
+        names = metrics.names if hasattr(metrics, 'names') else model.names
+        name_to_id = {v: k for k, v in (names.items() if isinstance(names, dict) else enumerate(names))}
+        entry['map50'] = round(float(metrics.box.map50), 4)
+        entry['map50_95'] = round(float(metrics.box.map), 4)
+        target_id = name_to_id.get(args.target_class)
+        class_index = list(getattr(metrics.box, 'ap_class_index', []))
+        if target_id is not None and target_id in class_index:
+            i = class_index.index(target_id)
+            entry['target_precision'] = round(float(metrics.box.p[i]), 4)
+            entry['target_recall'] = round(float(metrics.box.r[i]), 4)
+        else:
+            entry['target_precision'] = entry['target_recall'] = None
+        entry['val_speed_ms'] = {k: round(float(v), 2) for k, v in getattr(metrics, 'speed', {}).items()}
+        entry['latency_ms'] = measure_latency(
+            model, images, imgsz, args.conf, args.warmup, fixed_shape=fmt in ('onnx', 'ncnn'),
+        )
+    except Exception as e:
+        entry['error'] = f"{type(e).__name__}: {e}"
+    return entry
+
+
+def mark_pareto(results: list[dict]) -> list[dict]:
+    """Flag settings not dominated on (lower p50 latency, higher mAP50, higher target recall)."""
+    scored = [r for r in results if not r['error'] and r.get('latency_ms')]
+
+    def key(r):
+        return (r['latency_ms']['p50'], -(r.get('map50') or 0.0), -(r.get('target_recall') or 0.0))
+
+    for r in results:
+        r['pareto'] = False
+    for r in scored:
+        rk = key(r)
+        dominated = any(
+            all(a <= b for a, b in zip(key(o), rk)) and key(o) != rk
+            for o in scored if o is not r
+        )
+        r['pareto'] = not dominated
+    return sorted((r for r in scored if r['pareto']), key=lambda r: r['latency_ms']['p50'])
+
+
+def print_table(results: list[dict], baseline: dict | None) -> None:
+    header = f"{'model':40} {'fmt':5} {'imgsz':>5} {'mAP50':>7} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8}  pareto"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        if r['error']:
+            print(f"{Path(r['model']).name[:40]:40} {r['format']:5} {r['imgsz'] or '?':>5}  ERROR {r['error'][:60]}")
+            continue
+        lat = r.get('latency_ms') or {}
+        line = (
+            f"{Path(r['model']).name[:40]:40} {r['format']:5} {r['imgsz']:>5} "
+            f"{r['map50']:>7.3f} {(r['target_recall'] if r['target_recall'] is not None else float('nan')):>7.3f} "
+            f"{lat.get('p50', float('nan')):>8.1f} {lat.get('p95', float('nan')):>8.1f}  {'*' if r['pareto'] else ''}"
+        )
+        old = (baseline or {}).get((Path(r['model']).name, r['imgsz']))
+        if old and not old.get('error'):
+            d_map = r['map50'] - old.get('map50', 0.0)
+            d_lat = lat.get('p50', 0.0) - (old.get('latency_ms') or {}).get('p50', 0.0)
+            line += f"   (vs baseline: mAP50 {d_map:+.3f}, p50 {d_lat:+.1f} ms)"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accuracy vs latency sweep across exports and image sizes")
+    parser.add_argument("--data", required=True, help="Dataset YAML with a labelled validation split")
+    parser.add_argument("--models", nargs='+', required=True, help=".pt / .onnx files and NCNN export directories")
+    parser.add_argument("--imgsz", nargs='+', type=int, default=[256, 320, 416, 512])
+    parser.add_argument("--split", default='val')
+    parser.add_argument("--device", default='cpu')
+    parser.add_argument("--target-class", default='foreign_object', help="Class whose recall is reported")
+    parser.add_argument("--conf", type=float, default=float(os.environ.get("CONFIDENCE", 0.5)),
+                        help="Confidence used for latency runs (match the server's --conf)")
+    parser.add_argument("--val-conf", type=float, default=0.001, help="Confidence used for mAP (Ultralytics default)")
+    parser.add_argument("--latency-images", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--export", nargs='*', choices=['onnx', 'ncnn'], default=[],
+                        help="Also export each .pt model at every --imgsz in these formats")
+    parser.add_argument("--export-dir", default='eval_exports')
+    parser.add_argument("--output", default='eval_report.json')
+    parser.add_argument("--compare", default=None, help="Earlier report to diff against")
+    args = parser.parse_args()
+
+    models = list(args.models)
+    for path in args.models:
+        if args.export and model_format(path) == 'pt':
+            models.extend(export_variants(path, args.export, args.imgsz, Path(args.export_dir)))
+
+    images = validation_images(args.data, args.split, args.latency_images)
+    print(f"{len(models)} model(s) x {len(args.imgsz)} size(s); latency over {len(images)} validation images")
+
+    results = []
+    for path in models:
+        # Fixed-shape exports only run at their exported size; sweep sizes for .pt models.
+        fixed = exported_imgsz(path)
+        fmt = model_format(path)
+        if fixed is None and fmt in ('onnx', 'ncnn'):
+            # Without the size a row would be labelled with sizes the export never ran at.
+            print(f"Skipping {path}: cannot read its exported input size")
+            results.append({
+                'model': path, 'format': fmt, 'imgsz': None,
+                'error': 'exported imgsz unknown (needs onnxruntime for ONNX metadata, metadata.yaml for NCNN)',
+            })
+            continue
+        for imgsz in ([fixed] if fixed else args.imgsz):
+            print(f"Evaluating {path} @ {imgsz} ...")
+            results.append(evaluate(path, imgsz, args, images))
+
+    pareto = mark_pareto(results)
+    baseline = None
+    if args.compare:
+        old = json.loads(Path(args.compare).read_text())
+        baseline = {(Path(r['model']).name, r['imgsz']): r for r in old.get('results', [])}
+
+    print_table(results, baseline)
+    report = {
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {'platform': platform.platform(), 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'data': args.data,
+        'split': args.split,
+        'target_class': args.target_class,
+        'latency_conf': args.conf,
+        'results': results,
+        'pareto': [{'model': r['model'], 'format': r['format'], 'imgsz': r['imgsz']} for r in pareto],
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f"\nPareto-optimal: " + ', '.join(f"{Path(r['model']).name}@{r['imgsz']}" for r in pareto))
+    print(f"Report written to {args.output}")
+    sys.exit(1 if all(r['error'] for r in results) else 0)
+
+
+if __name__ == "__main__":
+    main()
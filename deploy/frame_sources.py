@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Synthetic camera sources for webrtc_server.py (--source), used by load_test.py and soak_test.py.
+
+  synthetic:belt?fps=15            objects crossing a plain belt (detections come and go)
+  synthetic:bars | synthetic:noise colour bars (cheap to encode) / noise (worst case for H.264)
+  replay:<video or image dir>?fps=10   loop recorded footage or a folder of images
+  <image dir>                          same as replay:<image dir>
+
+Sources behave like a live camera rather than a file: read() blocks until the next frame is
+due at the fixed fps, and a consumer that falls behind gets the current frame, not a backlog
+(the skipped frames are counted). Frames carry their capture wall-clock time as a strip of
+blocks along the bottom edge (stamp=0 to disable), which load_test.py decodes from MJPEG and
+WebRTC frames to measure capture-to-viewer latency; run the server with --flip none so the
+strip stays where the decoder looks.
+
+The classes mimic the parts of cv2.VideoCapture that SharedCamera uses, so the server needs
+no second code path.
+"""
+
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp')
+PATTERNS = ('belt', 'bars', 'noise')
+
+STAMP_BITS = 44          # milliseconds since the epoch fit in 44 bits until the year 2527
+STAMP_FRACTION = 1 / 24  # strip height as a share of frame height, so any stream scale decodes
+
+
+def stamp_timestamp(frame, ts: float) -> None:
+    """Draw ts (epoch seconds) into a strip along the bottom edge as black/white blocks, in place."""
+    h, w = frame.shape[:2]
+    value = int(ts * 1000.0)
+    edges = np.linspace(0, w, STAMP_BITS + 1).astype(int)
+    strip = frame[h - max(4, int(h * STAMP_FRACTION)):h]
+    for i in range(STAMP_BITS):
+        strip[:, edges[i]:edges[i + 1]] = 255 if (value >> (STAMP_BITS - 1 - i)) & 1 else 0
+
+
+def read_timestamp(frame) -> float | None:
+    """Decode a stamp_timestamp() strip (at any scale); None when the frame carries none."""
+    h, w = frame.shape[:2]
+    strip = max(4, int(h * STAMP_FRACTION))
+    gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    # Middle half of the strip only: compression smears its top edge into the picture.
+    band = gray[h - strip * 3 // 4:h - max(1, strip // 4)].astype(np.float32).mean(axis=0)
+    edges = np.linspace(0, w, STAMP_BITS + 1)
+    value = 0
+    for i in range(STAMP_BITS):
+        lo, hi = edges[i], edges[i + 1]
+        pad = (hi - lo) * 0.25
+        level = band[int(lo + pad):max(int(lo + pad) + 1, int(hi - pad))].mean()
+        if 60 < level < 195:
+            return None
+        value = (value << 1) | int(level >= 128)
+    ts = value / 1000.0
+    # Random content decodes to nonsense; only accept something within a day of now.
+    return ts if abs(ts - time.time()) < 86400 else None
+
+
+class _PacedSource:
+    """Fixed-rate, drop-when-late frame clock plus the VideoCapture surface SharedCamera uses."""
+
+    def __init__(self, fps: float, width: int, height: int, stamp: bool):
+        self.fps = max(0.5, float(fps))
+        self.width = int(width)
+        self.height = int(height)
+        self.stamp = stamp
+        self.fixed_size = False
+        self.frames = 0
+        self.dropped = 0
+        self._index = 0
+        self._start = None
+        self._opened = True
+
+    def _next_index(self) -> int:
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now
+        due = self._start + self._index / self.fps
+        if due > now:
+            time.sleep(due - now)
+        else:
+            behind = int((now - due) * self.fps)
+            self._index += behind
+            self.dropped += behind
+        index = self._index
+        self._index += 1
+        return index
+
+    def _render(self, index: int):
+        raise NotImplementedError
+
+    def read(self, image=None):
+        if not self._opened:
+            return False, None
+        index = self._next_index()
+        frame = self._render(index)
+        if frame is None:
+            return False, None
+        if frame.shape[1] != self.width or frame.shape[0] != self.height:
+            frame = cv2.resize(frame, (self.width, self.height), interpolation=cv2.INTER_AREA)
+        if self.stamp:
+            stamp_timestamp(frame, time.time())
+        self.frames += 1
+        return True, frame
+
+    def grab(self) -> bool:
+        if not self._opened:
+            return False
+        self._next_index()
+        return True
+
+    def isOpened(self) -> bool:
+        return self._opened
+
+    def release(self) -> None:
+        self._opened = False
+
+    def set(self, prop, value) -> bool:
+        # Capture size follows --capture-width/height like a camera would, unless the URI fixed it
+        # (then the server's software-resize fallback kicks in); the rate is always the URI's.
+        if prop in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT) and self.fixed_size:
+            return False
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            self.width = max(16, int(value))
+        elif prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            self.height = max(16, int(value))
+        else:
+            return False
+        return True
+
+    def get(self, prop) -> float:
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return self._index * 1000.0 / self.fps
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self._index)
+        return 0.0
+
+    def snapshot(self) -> dict:
+        return {'kind': type(self).__name__, 'fps': self.fps, 'frames': self.frames, 'dropped': self.dropped}
+
+
+class PatternSource(_PacedSource):
+    """Generated frames: 'belt' (moving objects), 'bars' (static colour bars) or 'noise'."""
+
+    def __init__(self, pattern: str = 'belt', fps: float = 15.0, width: int = 640, height: int = 480,
+                 objects: int = 2, stamp: bool = True, seed: int = 0):
+        if pattern not in PATTERNS:
+            raise ValueError(f"unknown pattern {pattern!r} (choose from {', '.join(PATTERNS)})")
+        super().__init__(fps, width, height, stamp)
+        self.pattern = pattern
+        self.objects = max(0, int(objects))
+        self._rng = np.random.default_rng(seed)
+
+    def _render(self, index: int):
+        w, h = self.width, self.height
+        if self.pattern == 'noise':
+            return self._rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        if self.pattern == 'bars':
+            colours = np.array([(255, 255, 255), (0, 255, 255), (255, 255, 0), (0, 255, 0),
+                                (255, 0, 255), (0, 0, 255), (255, 0, 0), (0, 0, 0)], dtype=np.uint8)
+            return np.ascontiguousarray(np.broadcast_to(colours[np.arange(w) * len(colours) // w], (h, w, 3)))
+        frame = np.full((h, w, 3), (90, 100, 95), dtype=np.uint8)
+        period = max(1, int(self.fps * 6))  # one object crosses in ~6 s
+        size = max(8, min(w, h) // 6)
+        for k in range(self.objects):
+            phase = ((index + k * period // max(1, self.objects)) % period) / period
+            y = int(phase * (h + 2 * size)) - size
+            x = int((k + 0.5) * w / max(1, self.objects)) - size // 2
+            cv2.rectangle(frame, (x, y), (x + size, y + size * 2 // 3), (40, 60, 200), -1)
+        return frame
+
+    def snapshot(self) -> dict:
+        return dict(super().snapshot(), pattern=self.pattern)
+
+
+class ReplaySource(_PacedSource):
+    """Loop a video file or an image directory at a fixed rate, like a live camera."""
+
+    def __init__(self, path: str, fps: float | None = None, width: int = 640, height: int = 480, stamp: bool = True):
+        self.path = Path(path)
+        self._images = None
+        self._cap = None
+        if self.path.is_dir():
+            self._images = sorted(p for p in self.path.rglob('*') if p.suffix.lower() in IMAGE_SUFFIXES)
+            if not self._images:
+                raise ValueError(f"no images in {path}")
+            native_fps = 10.0
+        else:
+            self._cap = cv2.VideoCapture(str(self.path))
+            if not self._cap.isOpened():
+                raise ValueError(f"cannot open {path}")
+            native_fps = self._cap.get(cv2.CAP_PROP_FPS) or 15.0
+        super().__init__(fps or native_fps, width, height, stamp)
+        self._position = -1
+
+    def _render(self, index: int):
+        if self._images is not None:
+            return cv2.imread(str(self._images[index % len(self._images)]))
+        # Decode forward to the due frame (skipping what a late consumer missed), looping at EOF.
+        frame = None
+        for _ in range(max(1, index - self._position)):
+            ok, frame = self._cap.read()
+            if not ok:
+                self._cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, frame = self._cap.read()
+                if not ok:
+                    return None
+        self._position = index
+        return frame
+
+    def release(self) -> None:
+        super().release()
+        if self._cap is not None:
+            self._cap.release()
+
+    def snapshot(self) -> dict:
+        return dict(super().snapshot(), path=str(self.path))
+
+
+def _parse_query(query: str) -> dict:
+    params = {}
+    for part in filter(None, query.split('&')):
+        key, _, value = part.partition('=')
+        params[key.strip()] = value.strip()
+    return params
+
+
+def open_frame_source(source, width: int = 640, height: int = 480):
+    """Synthetic source for a --source value, or None for a camera index / plain video file."""
+    if not isinstance(source, str):
+        return None
+    scheme, sep, rest = source.partition(':')
+    if not sep or scheme not in ('synthetic', 'replay'):
+        if Path(source).is_dir():
+            return ReplaySource(source, width=width, height=height)
+        return None
+    target, _, query = rest.partition('?')
+    params = _parse_query(query)
+    fps = float(params['fps']) if params.get('fps') else None
+    stamp = params.get('stamp', '1').lower() not in ('0', 'false', 'no', 'off')
+    if 'size' in params:
+        width, height = (int(v) for v in params['size'].lower().split('x'))
+    if scheme == 'synthetic':
+        frame_source = PatternSource(
+            target or 'belt', fps=fps or 15.0, width=width, height=height,
+            objects=int(params.get('objects', 2)), stamp=stamp, seed=int(params.get('seed', 0)),
+        )
+    else:
+        frame_source = ReplaySource(target, fps=fps, width=width, height=height, stamp=stamp)
+    frame_source.fixed_size = 'size' in params
+    return frame_source
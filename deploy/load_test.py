@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+Viewer load generator: how many WebRTC and MJPEG viewers can one unit serve?
+
+Opens --webrtc-peers headless aiortc peers (POST /offer, recvonly video) and --mjpeg-clients
+/mjpeg readers against a running server. For each step it reports:
+  - the FPS each client received,
+  - capture-to-viewer latency, decoded from the timestamp strip that frame_sources.py draws
+    (start the server with a synthetic:/replay: --source and --flip none; run this on the
+    same host or on a clock-synced one),
+  - viewers turned away by the server's viewer limits (503),
+  - server CPU, load average and trigger FPS, from /status.
+
+--ramp adds viewers one at a time every --step-s (WebRTC first, then MJPEG) and stops once
+the mean WebRTC FPS falls below --min-fps or the mean MJPEG FPS below --min-mjpeg-fps. The
+server paces MJPEG at its --mjpeg-max-fps, so a client always measures a little under that
+cap; the MJPEG threshold therefore defaults to 80% of the cap read from /status. The last
+step that kept up is the viewer limit for that Pi. Without --ramp, every viewer starts at once and runs for --duration seconds.
+Decoding WebRTC video is CPU-heavy here too, so drive a Pi from a laptop, not from itself.
+
+Example:
+  python deploy/webrtc_server.py --source "synthetic:belt?fps=15" --flip none --persistent
+  python deploy/load_test.py --url http://raspberrypi.local:8080 --webrtc-peers 4 --mjpeg-clients 8 \\
+      --ramp --step-s 30 --min-fps 10 --min-mjpeg-fps 8 --output load_pi4.json
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+from aiohttp import ClientSession, ClientTimeout
+
+from frame_sources import read_timestamp
+
+
+class Viewer:
+    """One fake client's receive log: arrival times and decoded capture-to-arrival latencies."""
+
+    def __init__(self, kind: str, index: int):
+        self.kind = kind
+        self.index = index
+        self.arrivals = []
+        self.latencies = []   # (arrival, ms)
+        self.rejected = False
+        self.error = None
+        self.started = time.time()
+
+    def frame(self, image=None) -> None:
+        now = time.time()
+        self.arrivals.append(now)
+        if image is not None:
+            ts = read_timestamp(image)
+            if ts is not None:
+                self.latencies.append((now, (now - ts) * 1000.0))
+
+    def window(self, start: float, end: float) -> dict:
+        arrivals = [t for t in self.arrivals if start <= t < end]
+        latencies = [ms for t, ms in self.latencies if start <= t < end]
+        span = end - max(start, self.started)
+        return {
+            'fps': round(len(arrivals) / span, 2) if span > 0 else 0.0,
+            'latencies': latencies,
+        }
+
+
+async def run_mjpeg(session: ClientSession, base: str, viewer: Viewer, stop: asyncio.Event, decode_every: int) -> None:
+    try:
+        async with session.get(f'{base}/mjpeg') as resp:
+            if resp.status == 503:
+                viewer.rejected = True
+                return
+            resp.raise_for_status()
+            count = 0
+            while not stop.is_set():
+                length = None
+                while True:
+                    line = await resp.content.readline()
+                    if not line:
+                        return
+                    if line.lower().startswith(b'content-length:'):
+                        length = int(line.split(b':', 1)[1])
+                    elif line in (b'\r\n', b'\n') and length is not None:
+                        break
+                jpeg = await resp.content.readexactly(length)
+                count += 1
+                image = None
+                if decode_every and count % decode_every == 0:
+                    image = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+                viewer.frame(image)
+    except Exception as e:
+        viewer.error = f"{type(e).__name__}: {e}"
+
+
+async def run_webrtc(session: ClientSession, base: str, viewer: Viewer, stop: asyncio.Event, decode_every: int) -> None:
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    from aiortc.mediastreams import MediaStreamError
+
+    pc = RTCPeerConnection()
+    try:
+        pc.addTransceiver('video', direction='recvonly')
+        tracks = asyncio.Queue()
+        pc.on('track', tracks.put_nowait)
+        await pc.setLocalDescription(await pc.createOffer())
+        async with session.post(f'{base}/offer', json={'sdp': pc.localDescription.sdp, 'type': pc.localDescription.type}) as resp:
+            if resp.status == 503:
+                viewer.rejected = True
+                return
+            resp.raise_for_status()
+            answer = await resp.json()
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=answer['sdp'], type=answer['type']))
+        track = await asyncio.wait_for(tracks.get(), 30)
+        count = 0
+        while not stop.is_set():
+            try:
+                frame = await asyncio.wait_for(track.recv(), 10)
+            except MediaStreamError:
+                return
+            count += 1
+            image = frame.to_ndarray(format='gray') if decode_every and count % decode_every == 0 else None
+            viewer.frame(image)
+    except Exception as e:
+        viewer.error = f"{type(e).__name__}: {e}"
+    finally:
+        await pc.close()
+
+
+class ServerMonitor:
+    """Poll /status for CPU time, load average and trigger FPS."""
+
+    def __init__(self, session: ClientSession, base: str, interval: float = 2.0):
+        self.session = session
+        self.base = base
+        self.interval = interval
+        self.samples = []   # (time, cpu_pct, load_1m, trigger_fps)
+
+    async def run(self, stop: asyncio.Event) -> None:
+        last = None
+        while not stop.is_set():
+            try:
+                async with self.session.get(f'{self.base}/status') as resp:
+                    status = await resp.json()
+                proc = status.get('process') or {}
+                now, cpu_s = time.time(), proc.get('cpu_s')
+                if last is not None and cpu_s is not None:
+                    cpu_pct = 100.0 * (cpu_s - last[1]) / max(1e-6, now - last[0])
+                    load = (proc.get('load_avg') or [None])[0]
+                    fps = (status.get('trigger_pipeline') or {}).get('trigger_fps')
+                    self.samples.append((now, cpu_pct, load, fps))
+                last = (now, cpu_s)
+            except Exception:
+                pass
+            try:
+                await asyncio.wait_for(stop.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def window(self, start: float, end: float) -> dict:
+        rows = [s for s in self.samples if start <= s[0] < end]
+
+        def mean(i):
+            values = [r[i] for r in rows if r[i] is not None]
+            return round(statistics.fmean(values), 1) if values else None
+
+        return {'server_cpu_pct': mean(1), 'server_load_1m': mean(2), 'trigger_fps': mean(3)}
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * q))], 1)
+
+
+def step_report(viewers: list[Viewer], monitor: ServerMonitor, start: float, end: float) -> dict:
+    active = [v for v in viewers if not v.rejected and v.error is None]
+    report = {
+        'webrtc': sum(1 for v in active if v.kind == 'webrtc'),
+        'mjpeg': sum(1 for v in active if v.kind == 'mjpeg'),
+        'rejected': sum(1 for v in viewers if v.rejected),
+        'failed': sum(1 for v in viewers if v.error is not None),
+    }
+    for kind in ('webrtc', 'mjpeg'):
+        windows = [v.window(start, end) for v in active if v.kind == kind]
+        fps = [w['fps'] for w in windows]
+        latencies = [ms for w in windows for ms in w['latencies']]
+        report[f'{kind}_fps_mean'] = round(statistics.fmean(fps), 2) if fps else None
+        report[f'{kind}_fps_min'] = min(fps) if fps else None
+        report[f'{kind}_latency_p50_ms'] = percentile(latencies, 0.5)
+        report[f'{kind}_latency_p95_ms'] = percentile(latencies, 0.95)
+    report.update(monitor.window(start, end))
+    return report
+
+
+def print_step(step: dict) -> None:
+    def fmt(value, spec):
+        return format(value, spec) if value is not None else '-'.rjust(len(format(0, spec)))
+
+    print(
+        f"webrtc {step['webrtc']:>2} mjpeg {step['mjpeg']:>2} | "
+        f"fps webrtc {fmt(step['webrtc_fps_mean'], '5.1f')} (min {fmt(step['webrtc_fps_min'], '5.1f')}) "
+        f"mjpeg {fmt(step['mjpeg_fps_mean'], '5.1f')} (min {fmt(step['mjpeg_fps_min'], '5.1f')}) | "
+        f"latency p50/p95 webrtc {fmt(step['webrtc_latency_p50_ms'], '6.0f')}/{fmt(step['webrtc_latency_p95_ms'], '6.0f')} "
+        f"mjpeg {fmt(step['mjpeg_latency_p50_ms'], '6.0f')}/{fmt(step['mjpeg_latency_p95_ms'], '6.0f')} ms | "
+        f"cpu {fmt(step['server_cpu_pct'], '5.0f')}% trigger {fmt(step['trigger_fps'], '4.1f')} fps"
+        + (f" | rejected {step['rejected']}" if step['rejected'] else '')
+        + (f" failed {step['failed']}" if step['failed'] else '')
+    )
+
+
+def keeps_up(step: dict, min_fps: float, min_mjpeg_fps: float) -> bool:
+    """Every client kind present reached its own FPS threshold."""
+    fps = [(step['webrtc_fps_mean'], min_fps), (step['mjpeg_fps_mean'], min_mjpeg_fps)]
+    fps = [(f, floor) for f, floor in fps if f is not None]
+    return bool(fps) and all(f >= floor for f, floor in fps)
+
+
+async def mjpeg_threshold(session: ClientSession, base: str, args) -> float:
+    """--min-mjpeg-fps, else 80% of the server's MJPEG cap (--min-fps when uncapped or unknown)."""
+    if args.min_mjpeg_fps is not None:
+        return args.min_mjpeg_fps
+    try:
+        async with session.get(f'{base}/status') as resp:
+            cap = float(((await resp.json()).get('mjpeg') or {}).get('max_fps') or 0.0)
+    except Exception:
+        cap = 0.0
+    return 0.8 * cap if cap > 0 else args.min_fps
+
+
+async def run(args) -> dict:
+    base = args.url.rstrip('/')
+    stop = asyncio.Event()
+    viewers, tasks, steps = [], [], []
+    plan = [('webrtc', i) for i in range(args.webrtc_peers)] + [('mjpeg', i) for i in range(args.mjpeg_clients)]
+    runners = {'webrtc': run_webrtc, 'mjpeg': run_mjpeg}
+
+    async with ClientSession(timeout=ClientTimeout(total=None, sock_connect=10)) as session:
+        min_mjpeg_fps = await mjpeg_threshold(session, base, args)
+        print(f"Keeping up means >= {args.min_fps:g} fps per WebRTC viewer, >= {min_mjpeg_fps:g} fps per MJPEG client")
+        monitor = ServerMonitor(session, base)
+        monitor_task = asyncio.create_task(monitor.run(stop))
+
+        def start(kind, index):
+            viewer = Viewer(kind, index)
+            viewers.append(viewer)
+            tasks.append(asyncio.create_task(runners[kind](session, base, viewer, stop, args.decode_every)))
+
+        try:
+            if args.ramp:
+                for kind, index in plan:
+                    start(kind, index)
+                    await asyncio.sleep(args.settle_s)
+                    window_start = time.time()
+                    await asyncio.sleep(args.step_s)
+                    step = step_report(viewers, monitor, window_start, time.time())
+                    steps.append(step)
+                    print_step(step)
+                    if not keeps_up(step, args.min_fps, min_mjpeg_fps) or step['rejected']:
+                        break
+            else:
+                for kind, index in plan:
+                    start(kind, index)
+                await asyncio.sleep(args.settle_s)
+                window_start = time.time()
+                await asyncio.sleep(args.duration)
+                step = step_report(viewers, monitor, window_start, time.time())
+                steps.append(step)
+                print_step(step)
+        finally:
+            stop.set()
+            await asyncio.gather(*tasks, monitor_task, return_exceptions=True)
+
+    keeping_up = [
+        s for s in steps if keeps_up(s, args.min_fps, min_mjpeg_fps) and not s['rejected'] and not s['failed']
+    ]
+    limit = keeping_up[-1] if keeping_up else None
+    return {
+        'url': base,
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'min_fps': args.min_fps,
+        'min_mjpeg_fps': min_mjpeg_fps,
+        'steps': steps,
+        'viewer_limit': {'webrtc': limit['webrtc'], 'mjpeg': limit['mjpeg']} if limit else None,
+        'errors': sorted({v.error for v in viewers if v.error}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WebRTC / MJPEG viewer load generator for webrtc_server.py")
+    parser.add_argument("--url", default='http://127.0.0.1:8080', help="Server base URL")
+    parser.add_argument("--webrtc-peers", type=int, default=2)
+    parser.add_argument("--mjpeg-clients", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=60.0, help="Measurement seconds (without --ramp)")
+    parser.add_argument("--ramp", action="store_true", help="Add viewers one at a time to find the limit")
+    parser.add_argument("--step-s", type=float, default=30.0, help="Measurement seconds per --ramp step")
+    parser.add_argument("--settle-s", type=float, default=5.0, help="Seconds after starting viewers before measuring")
+    parser.add_argument("--min-fps", type=float, default=10.0, help="A step keeps up while the mean WebRTC FPS reaches this")
+    parser.add_argument("--min-mjpeg-fps", type=float, default=None,
+                        help="Same for MJPEG clients (default: 80%% of the server's --mjpeg-max-fps)")
+    parser.add_argument("--decode-every", type=int, default=3,
+                        help="Decode every Nth frame for the latency stamp (0 = never; saves client CPU)")
+    parser.add_argument("--output", default=None, help="Write the JSON report here")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    limit = report['viewer_limit']
+    print(
+        f"\nViewer limit at >= {args.min_fps:g} fps WebRTC / {report['min_mjpeg_fps']:g} fps MJPEG: "
+        + (f"{limit['webrtc']} WebRTC + {limit['mjpeg']} MJPEG" if limit else "none (first step already fell short)")
+    )
+    if report['errors']:
+        print("Client errors: " + '; '.join(report['errors']))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"Report written to {args.output}")
+    sys.exit(0 if report['steps'] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+INT8 export of the detector for faster CPU inference on the Pi, plus an fp32 agreement check.
+
+  onnx: Ultralytics fp32 ONNX export -> onnxruntime static quantization (QDQ, per-channel),
+        calibrated on letterboxed sample images. The Detect head's box decoding stays fp32.
+  ncnn: Ultralytics fp32 NCNN export -> ncnn2table (KL calibration) -> ncnn2int8.
+        Needs the ncnn tools (ncnn2table, ncnn2int8) on PATH.
+
+Calibrate on real conveyor frames: the training images or the hard-example harvester's
+images/ directory (--harvest-dir on the server).
+
+The outputs load like any other export (webrtc_server.py --model ...). Pass the fp32 model
+as --model-reference plus --model-check-dir to make the server verify agreement at startup.
+
+Examples:
+  python deploy/quantize_model.py --weights deploy/models/best.pt --format onnx ncnn \
+      --calib harvest/images --imgsz 320 --check-dir validation/images
+  python deploy/quantize_model.py --check deploy/models/best_int8.onnx --reference deploy/models/best.onnx \
+      --check-dir validation/images
+"""
+
+import argparse
+import json
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def collect_images(inputs: list[str], limit: int | None = None, seed: int = 0) -> list[str]:
+    images = []
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            images.extend(str(p) for p in sorted(path.rglob('*')) if p.suffix.lower() in IMAGE_SUFFIXES)
+        elif path.suffix.lower() in IMAGE_SUFFIXES and path.exists():
+            images.append(str(path))
+    if limit and len(images) > limit:
+        images = random.Random(seed).sample(images, limit)
+    return images
+
+
+def letterbox(img, size: int):
+    """Ultralytics-style letterbox (gray 114 padding) -> 1x3xHxW float32 RGB in [0, 1]."""
+    h, w = img.shape[:2]
+    scale = min(size / h, size / w)
+    nh, nw = int(round(h * scale)), int(round(w * scale))
+    canvas = np.full((size, size, 3), 114, dtype=np.uint8)
+    top, left = (size - nh) // 2, (size - nw) // 2
+    canvas[top:top + nh, left:left + nw] = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_LINEAR)
+    return np.ascontiguousarray(canvas[:, :, ::-1].transpose(2, 0, 1)[None], dtype=np.float32) / 255.0
+
+
+def _iou(a, b) -> float:
+    ix1, iy1, ix2, iy2 = max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, ix2 - ix1) * max(0.0, iy2 - iy1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _predict(model, frame, imgsz: int, conf: float, fixed_shape: bool):
+    kwargs = {'conf': conf, 'verbose': False}
+    if not fixed_shape:
+        kwargs['imgsz'] = imgsz
+    t0 = time.perf_counter()
+    result = model(frame, **kwargs)[0]
+    elapsed = (time.perf_counter() - t0) * 1000.0
+    boxes = [
+        (int(b.cls), b.xyxy.tolist()[0])
+        for b in result.boxes
+    ]
+    return boxes, elapsed
+
+
+def match_detections(reference: list, candidate: list, iou_threshold: float = 0.5) -> tuple[int, list[float]]:
+    """Greedy same-class IoU matching of (cls, xyxy) boxes; returns (matches, matched IoUs)."""
+    matched = 0
+    ious = []
+    unused = list(candidate)
+    for cls_id, box in reference:
+        best, best_iou = None, iou_threshold
+        for cand in unused:
+            if cand[0] != cls_id:
+                continue
+            iou = _iou(box, cand[1])
+            if iou >= best_iou:
+                best, best_iou = cand, iou
+        if best is not None:
+            unused.remove(best)
+            matched += 1
+            ious.append(best_iou)
+    return matched, ious
+
+
+def agreement_report(matched: int, ref_total: int, cand_total: int, ious: list[float],
+                     cand_ms: list[float], ref_ms: list[float], min_reference_boxes: int = 1) -> dict:
+    """Recall / precision / latency summary. With fewer than min_reference_boxes reference
+    boxes the recall says nothing about the candidate, so the report is marked inconclusive."""
+    # The first call of each model includes lazy initialisation; leave it out of latency.
+    cand_mean = float(np.mean(cand_ms[1:] or cand_ms)) if cand_ms else 0.0
+    ref_mean = float(np.mean(ref_ms[1:] or ref_ms)) if ref_ms else 0.0
+    return {
+        'images': len(cand_ms),
+        'reference_boxes': ref_total,
+        'candidate_boxes': cand_total,
+        'inconclusive': ref_total < min_reference_boxes,
+        'recall': round(matched / ref_total, 4) if ref_total else 1.0,
+        'precision': round(matched / cand_total, 4) if cand_total else 1.0,
+        'mean_iou': round(float(np.mean(ious)), 4) if ious else None,
+        'candidate_ms': round(cand_mean, 2),
+        'reference_ms': round(ref_mean, 2),
+        'speedup': round(ref_mean / cand_mean, 2) if cand_mean > 0 else None,
+    }
+
+
+def compare_models(candidate, reference, images: list, imgsz: int = 320, conf: float = 0.5,
+                   iou_threshold: float = 0.5, candidate_fixed: bool = False, reference_fixed: bool = False,
+                   min_reference_boxes: int = 1) -> dict:
+    """Match candidate detections to the reference model's (same class, IoU >= threshold).
+
+    images are file paths or BGR arrays. recall = share of reference boxes the candidate
+    reproduces; precision = share of candidate boxes backed by a reference box;
+    speedup = reference / candidate mean latency.
+    """
+    matched = ref_total = cand_total = 0
+    ious = []
+    cand_ms = []
+    ref_ms = []
+    for image in images:
+        frame = cv2.imread(image) if isinstance(image, str) else image
+        if frame is None:
+            continue
+        ref_boxes, ref_elapsed = _predict(reference, frame, imgsz, conf, reference_fixed)
+        cand_boxes, cand_elapsed = _predict(candidate, frame, imgsz, conf, candidate_fixed)
+        ref_ms.append(ref_elapsed)
+        cand_ms.append(cand_elapsed)
+        ref_total += len(ref_boxes)
+        cand_total += len(cand_boxes)
+        frame_matched, frame_ious = match_detections(ref_boxes, cand_boxes, iou_threshold)
+        matched += frame_matched
+        ious.extend(frame_ious)
+    return agreement_report(matched, ref_total, cand_total, ious, cand_ms, ref_ms, min_reference_boxes)
+
+
+def _ultralytics_export(weights: str, fmt: str, imgsz: int, scratch_dir: Path) -> Path:
+    """fp32 export of a copy of weights in scratch_dir (Ultralytics writes next to the weights,
+    which would otherwise overwrite an existing export of the source model)."""
+    from ultralytics import YOLO
+
+    copy = shutil.copy2(weights, scratch_dir)
+    return Path(YOLO(copy).export(format=fmt, imgsz=imgsz))
+
+
+def quantize_onnx(weights: str, calib_images: list[str], imgsz: int, out_path: Path, quantize_head: bool = False) -> Path:
+    import onnx
+    from onnxruntime.quantization import CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    with tempfile.TemporaryDirectory(prefix='quantize_') as scratch:
+        fp32_path = Path(weights) if weights.lower().endswith('.onnx') else _ultralytics_export(weights, 'onnx', imgsz, Path(scratch))
+        fp32 = onnx.load(str(fp32_path))
+        input_name = fp32.graph.input[0].name
+
+        class _Reader(CalibrationDataReader):
+            def __init__(self):
+                self._paths = iter(calib_images)
+
+            def get_next(self):
+                for path in self._paths:
+                    img = cv2.imread(path)
+                    if img is not None:
+                        return {input_name: letterbox(img, imgsz)}
+                return None
+
+        exclude = []
+        if not quantize_head:
+            # YOLOv8 Detect head: the cv2/cv3 branch convs are quantized; the DFL conv, box decoding
+            # and concat stay fp32 (int8 there costs mAP for little speed).
+            head_prefix = max(
+                (n.name.split('/')[1] for n in fp32.graph.node if n.name.startswith('/model.') and n.name.count('/') > 1),
+                key=lambda part: int(part.split('.')[1]) if part.split('.')[1].isdigit() else -1,
+                default=None,
+            )
+            if head_prefix:
+                exclude = [
+                    n.name for n in fp32.graph.node
+                    if n.name.startswith(f'/{head_prefix}/') and (n.op_type != 'Conv' or '/dfl/' in n.name)
+                ]
+
+        prep_path = out_path.with_suffix('.prep.onnx')
+        quant_pre_process(str(fp32_path), str(prep_path))
+        quantize_static(
+            str(prep_path),
+            str(out_path),
+            _Reader(),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            calibrate_method=CalibrationMethod.MinMax,
+            nodes_to_exclude=exclude,
+        )
+        prep_path.unlink(missing_ok=True)
+
+        # Keep Ultralytics metadata (names, imgsz, stride) so YOLO() loads the int8 model like the fp32 one.
+        quantized = onnx.load(str(out_path))
+        del quantized.metadata_props[:]
+        for prop in fp32.metadata_props:
+            quantized.metadata_props.add(key=prop.key, value=prop.value)
+        quantized.metadata_props.add(key='quantization', value='int8')
+        onnx.save(quantized, str(out_path))
+        return out_path
+
+
+def quantize_ncnn(weights: str, calib_images: list[str], imgsz: int, out_dir: Path) -> Path:
+    import yaml
+
+    for tool in ('ncnn2table', 'ncnn2int8'):
+        if shutil.which(tool) is None:
+            raise RuntimeError(f"{tool} not found on PATH (build ncnn with NCNN_BUILD_TOOLS=ON)")
+
+    with tempfile.TemporaryDirectory(prefix='quantize_') as scratch:
+        weights_path = Path(weights)
+        fp32_dir = weights_path if weights_path.is_dir() else _ultralytics_export(weights, 'ncnn', imgsz, Path(scratch))
+        out_dir.mkdir(parents=True, exist_ok=True)
+        image_list = out_dir / 'calibration.txt'
+        image_list.write_text('\n'.join(calib_images) + '\n')
+        table = out_dir / 'model.table'
+        param, binary = fp32_dir / 'model.ncnn.param', fp32_dir / 'model.ncnn.bin'
+        subprocess.run([
+            'ncnn2table', str(param), str(binary), str(image_list), str(table),
+            'mean=[0,0,0]', 'norm=[0.003922,0.003922,0.003922]', f'shape=[{imgsz},{imgsz},3]',
+            'pixel=RGB', 'thread=4', 'method=kl',
+        ], check=True)
+        subprocess.run([
+            'ncnn2int8', str(param), str(binary),
+            str(out_dir / 'model.ncnn.param'), str(out_dir / 'model.ncnn.bin'), str(table),
+        ], check=True)
+        for extra in ('model_ncnn.py',):
+            if (fp32_dir / extra).exists():
+                shutil.copy2(fp32_dir / extra, out_dir / extra)
+        meta = yaml.safe_load((fp32_dir / 'metadata.yaml').read_text()) if (fp32_dir / 'metadata.yaml').exists() else {}
+        meta.setdefault('args', {})['int8'] = True
+        (out_dir / 'metadata.yaml').write_text(yaml.safe_dump(meta, sort_keys=False))
+        return out_dir
+
+
+def _is_fixed_shape(path: str) -> bool:
+    p = Path(path)
+    return p.suffix.lower() == '.onnx' or (p.is_dir() and (p / 'model.ncnn.param').exists())
+
+
+def run_check(candidate_path: str, reference_path: str, check_dir: str, imgsz: int, conf: float, limit: int) -> dict:
+    from ultralytics import YOLO
+
+    images = collect_images([check_dir], limit=limit)
+    report = compare_models(
+        YOLO(candidate_path, task='detect'),
+        YOLO(reference_path, task='detect'),
+        images,
+        imgsz=imgsz,
+        conf=conf,
+        candidate_fixed=_is_fixed_shape(candidate_path),
+        reference_fixed=_is_fixed_shape(reference_path),
+    )
+    report.update(candidate=candidate_path, reference=reference_path)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export INT8 ONNX / NCNN models and check them against fp32")
+    parser.add_argument("--weights", help="fp32 model (.pt, or an existing .onnx / NCNN directory for that format)")
+    parser.add_argument("--format", nargs='+', choices=['onnx', 'ncnn'], default=['onnx'])
+    parser.add_argument("--calib", nargs='+', default=[], help="Calibration image files/directories")
+    parser.add_argument("--calib-count", type=int, default=200, help="Random calibration sample size")
+    parser.add_argument("--imgsz", type=int, default=320)
+    parser.add_argument("--out-dir", default='deploy/models')
+    parser.add_argument("--quantize-head", action="store_true", help="Also quantize the Detect head (ONNX)")
+    parser.add_argument("--check", help="Only compare this model against --reference")
+    parser.add_argument("--reference", help="fp32 reference model for --check (defaults to --weights)")
+    parser.add_argument("--check-dir", help="Reference image directory for the agreement check")
+    parser.add_argument("--check-count", type=int, default=100)
+    parser.add_argument("--conf", type=float, default=0.5)
+    parser.add_argument("--min-recall", type=float, default=0.9,
+                        help="Exit non-zero when the int8 model reproduces fewer reference boxes than this")
+    args = parser.parse_args()
+
+    reports = []
+    if args.check:
+        reference = args.reference or args.weights
+        if not (reference and args.check_dir):
+            parser.error("--check needs --reference (or --weights) and --check-dir")
+        reports.append(run_check(args.check, reference, args.check_dir, args.imgsz, args.conf, args.check_count))
+    else:
+        if not args.weights or not args.calib:
+            parser.error("--weights and --calib are required for export")
+        calib_images = collect_images(args.calib, limit=args.calib_count)
+        if not calib_images:
+            parser.error("no calibration images found")
+        print(f"Calibrating on {len(calib_images)} images at {args.imgsz}px")
+        out_dir = Path(args.out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        stem = Path(args.weights).stem.replace('_ncnn_model', '')
+        for fmt in args.format:
+            if fmt == 'onnx':
+                out = quantize_onnx(args.weights, calib_images, args.imgsz, out_dir / f"{stem}_int8.onnx", args.quantize_head)
+            else:
+                out = quantize_ncnn(args.weights, calib_images, args.imgsz, out_dir / f"{stem}_int8_ncnn_model")
+            print(f"INT8 {fmt} model written to {out}")
+            if args.check_dir:
+                # Agreement with the fp32 weights bounds the accuracy cost of quantization.
+                reference = args.reference or args.weights
+                reports.append(run_check(str(out), reference, args.check_dir, args.imgsz, args.conf, args.check_count))
+
+    failed = False
+    for report in reports:
+        print(json.dumps(report, indent=2))
+        if report['inconclusive']:
+            failed = True
+            print(f"❌ {report['candidate']}: the reference found no boxes on the check images; nothing was compared")
+        elif report['recall'] < args.min_recall:
+            failed = True
+            print(f"❌ {report['candidate']}: recall vs fp32 {report['recall']:.3f} < {args.min_recall}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
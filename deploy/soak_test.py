@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Soak test: run webrtc_server.py for hours against a synthetic camera and churning fake clients.
+
+Starts the server as a subprocess (MQTT off, memory watchdog on), then keeps it busy with
+  - MJPEG readers and /ws?subscribe=detections subscribers that reconnect every --churn-s,
+  - optional aiortc peers that POST /offer, pull frames, and close (exercises pcs cleanup),
+while sampling the server's RSS, open fds, threads and CPU from /proc, plus the gc object
+total, asyncio task count and peer set sizes from /status every --sample-s.
+
+Samples go to <out>/samples.csv and a summary to <out>/summary.json: growth rates (least
+squares over the run after --warmup-min), whether peers drained after the clients
+stopped, and every memory-watchdog alert (fastest-growing object types). The exit code
+is 1 when RSS or fd growth exceeds the limits or peers did not drain.
+
+Example (on the Pi, 8 hours, 2 WebRTC peers):
+  python deploy/soak_test.py --model deploy/models/best.onnx --hours 8 --webrtc-peers 2 --out soak_runs/$(date +%F)
+  python deploy/soak_test.py --source clip.mp4 -- --persistent --cascade   # extra server args after --
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from aiohttp import ClientSession, ClientTimeout
+
+from debug_profiling import process_stats
+
+SERVER = Path(__file__).resolve().parent / 'webrtc_server.py'
+TOKEN = 'soak-test'
+
+
+def slope_per_hour(points: list[tuple[float, float]]) -> float | None:
+    """Least-squares slope of (seconds, value) points, per hour."""
+    points = [(t, v) for t, v in points if v is not None]
+    if len(points) < 3:
+        return None
+    n = len(points)
+    mean_t = sum(t for t, _ in points) / n
+    mean_v = sum(v for _, v in points) / n
+    var = sum((t - mean_t) ** 2 for t, _ in points)
+    if var == 0:
+        return None
+    return sum((t - mean_t) * (v - mean_v) for t, v in points) / var * 3600.0
+
+
+class Clients:
+    """Fake viewers that connect, read for a while, disconnect and come back."""
+
+    def __init__(self, base: str, churn_s: float):
+        self.base = base
+        self.churn_s = churn_s
+        self.stats = {'mjpeg_sessions': 0, 'mjpeg_bytes': 0, 'ws_sessions': 0, 'ws_messages': 0,
+                      'webrtc_sessions': 0, 'webrtc_frames': 0, 'errors': 0}
+        self.stopping = asyncio.Event()
+
+    def _hold(self) -> float:
+        return self.churn_s * random.uniform(0.5, 1.5)
+
+    async def _pause(self, seconds: float) -> None:
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def mjpeg(self, session: ClientSession) -> None:
+        while not self.stopping.is_set():
+            try:
+                deadline = time.monotonic() + self._hold()
+                async with session.get(f'{self.base}/mjpeg') as resp:
+                    self.stats['mjpeg_sessions'] += 1
+                    async for chunk in resp.content.iter_chunked(64 * 1024):
+                        self.stats['mjpeg_bytes'] += len(chunk)
+                        if time.monotonic() > deadline or self.stopping.is_set():
+                            break
+            except Exception:
+                self.stats['errors'] += 1
+            await self._pause(1.0)
+
+    async def ws(self, session: ClientSession) -> None:
+        while not self.stopping.is_set():
+            try:
+                deadline = time.monotonic() + self._hold()
+                async with session.ws_connect(f'{self.base}/ws?subscribe=detections') as ws:
+                    self.stats['ws_sessions'] += 1
+                    while time.monotonic() < deadline and not self.stopping.is_set():
+                        try:
+                            await ws.receive(timeout=5)
+                            self.stats['ws_messages'] += 1
+                        except asyncio.TimeoutError:
+                            pass
+            except Exception:
+                self.stats['errors'] += 1
+            await self._pause(1.0)
+
+    async def webrtc(self, session: ClientSession) -> None:
+        from aiortc import RTCPeerConnection, RTCSessionDescription
+
+        while not self.stopping.is_set():
+            pc = RTCPeerConnection()
+            try:
+                pc.addTransceiver('video', direction='recvonly')
+                tracks = asyncio.Queue()
+                pc.on('track', tracks.put_nowait)
+                await pc.setLocalDescription(await pc.createOffer())
+                async with session.post(f'{self.base}/offer', json={
+                    'sdp': pc.localDescription.sdp, 'type': pc.localDescription.type,
+                }) as resp:
+                    if resp.status != 200:
+                        raise RuntimeError(f'/offer returned {resp.status}')
+                    answer = await resp.json()
+                await pc.setRemoteDescription(RTCSessionDescription(sdp=answer['sdp'], type=answer['type']))
+                self.stats['webrtc_sessions'] += 1
+                track = await asyncio.wait_for(tracks.get(), 30)
+                deadline = time.monotonic() + self._hold()
+                while time.monotonic() < deadline and not self.stopping.is_set():
+                    await asyncio.wait_for(track.recv(), 10)
+                    self.stats['webrtc_frames'] += 1
+            except Exception:
+                self.stats['errors'] += 1
+            finally:
+                await pc.close()
+            await self._pause(2.0)
+
+
+async def fetch_status(session: ClientSession, base: str) -> dict:
+    try:
+        async with session.get(f'{base}/status') as resp:
+            return await resp.json()
+    except Exception:
+        return {}
+
+
+async def run(args, server: subprocess.Popen, out: Path) -> dict:
+    base = f'http://127.0.0.1:{args.port}'
+    samples = []
+    fields = ['elapsed_s', 'rss_mb', 'fds', 'threads', 'cpu_pct', 'gc_objects', 'asyncio_tasks',
+              'peer_connections', 'peer_sessions', 'mjpeg_clients', 'ws_subscribers']
+
+    async with ClientSession(timeout=ClientTimeout(total=None, sock_connect=10)) as session:
+        deadline = time.monotonic() + args.startup_timeout
+        while not await fetch_status(session, base):
+            if server.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f'server did not come up (see {out / "server.log"})')
+            await asyncio.sleep(2)
+        print(f"Server up (pid {server.pid}); soaking for {args.hours:g} h")
+
+        clients = Clients(base, args.churn_s)
+        tasks = [asyncio.create_task(clients.mjpeg(session)) for _ in range(args.mjpeg_clients)]
+        tasks += [asyncio.create_task(clients.ws(session)) for _ in range(args.ws_clients)]
+        tasks += [asyncio.create_task(clients.webrtc(session)) for _ in range(args.webrtc_peers)]
+
+        start = time.monotonic()
+        end = start + args.hours * 3600.0
+        last_cpu, last_t = process_stats(server.pid)['cpu_s'], time.monotonic()
+        with open(out / 'samples.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            while time.monotonic() < end and server.poll() is None:
+                status = await fetch_status(session, base)
+                current = (status.get('memory_watchdog') or {}).get('current') or {}
+                proc, now = process_stats(server.pid), time.monotonic()
+                cpu = proc.pop('cpu_s')
+                row = {
+                    'elapsed_s': round(now - start, 1),
+                    **proc,
+                    'cpu_pct': round(100.0 * (cpu - last_cpu) / (now - last_t), 1) if cpu is not None and last_cpu is not None else None,
+                    'gc_objects': current.get('gc_objects'),
+                    'asyncio_tasks': current.get('asyncio_tasks'),
+                    'peer_connections': status.get('peer_connections'),
+                    'peer_sessions': current.get('peer_sessions'),
+                    'mjpeg_clients': status.get('mjpeg_clients'),
+                    'ws_subscribers': status.get('ws_detection_subscribers'),
+                }
+                last_cpu, last_t = cpu, now
+                samples.append(row)
+                writer.writerow({k: row.get(k) for k in fields})
+                f.flush()
+                print(f"[{row['elapsed_s'] / 60:7.1f} min] rss {row['rss_mb']} MB  fds {row['fds']}  "
+                      f"threads {row['threads']}  cpu {row['cpu_pct']}%  objects {row['gc_objects']}  "
+                      f"peers {row['peer_connections']}")
+                await asyncio.sleep(args.sample_s)
+
+        clients.stopping.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Give the idle reaper and close handlers time to drop everything the clients held.
+        await asyncio.sleep(args.drain_s)
+        final = await fetch_status(session, base)
+
+    crashed = server.poll() is not None
+    steady = [s for s in samples if s['elapsed_s'] >= args.warmup_min * 60.0]
+
+    def growth(key):
+        rate = slope_per_hour([(s['elapsed_s'], s[key]) for s in steady])
+        return round(rate, 2) if rate is not None else None
+
+    watchdog = final.get('memory_watchdog') or {}
+    summary = {
+        'hours': round(samples[-1]['elapsed_s'] / 3600.0, 2) if samples else 0.0,
+        'server_crashed': crashed,
+        'samples': len(samples),
+        'rss_mb': {'start': samples[0]['rss_mb'] if samples else None, 'end': samples[-1]['rss_mb'] if samples else None},
+        'growth_per_hour': {k: growth(k) for k in ('rss_mb', 'fds', 'threads', 'gc_objects', 'asyncio_tasks')},
+        'after_drain': {
+            'peer_connections': final.get('peer_connections'),
+            'mjpeg_clients': final.get('mjpeg_clients'),
+            'ws_subscribers': final.get('ws_detection_subscribers'),
+            **(watchdog.get('current') or {}),
+        },
+        'watchdog_alerts': watchdog.get('alerts'),
+        'last_watchdog_alert': watchdog.get('last_alert'),
+        'clients': clients.stats,
+    }
+    rss_rate = summary['growth_per_hour']['rss_mb'] or 0.0
+    fd_rate = summary['growth_per_hour']['fds'] or 0.0
+    summary['failures'] = [msg for failed, msg in (
+        (crashed, 'server exited during the run'),
+        (rss_rate > args.max_rss_growth, f'RSS grew {rss_rate:.1f} MB/h (limit {args.max_rss_growth})'),
+        (fd_rate > args.max_fd_growth, f'fds grew {fd_rate:.1f}/h (limit {args.max_fd_growth})'),
+        (bool(final.get('peer_connections')), f"{final.get('peer_connections')} peer connection(s) left after drain"),
+    ) if failed]
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Long-run memory / fd / peer-cleanup soak test for webrtc_server.py")
+    parser.add_argument("--hours", type=float, default=4.0)
+    parser.add_argument("--model", default=os.environ.get("MODEL_PATH"), help="Model for the server (default: its own)")
+    parser.add_argument("--source", default='synthetic:belt?fps=15',
+                        help="Server --source: a synthetic:/replay: source (frame_sources.py) or a video file to loop")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--mjpeg-clients", type=int, default=2)
+    parser.add_argument("--ws-clients", type=int, default=2)
+    parser.add_argument("--webrtc-peers", type=int, default=1)
+    parser.add_argument("--churn-s", type=float, default=120.0, help="Mean seconds each client stays connected")
+    parser.add_argument("--sample-s", type=float, default=30.0)
+    parser.add_argument("--warmup-min", type=float, default=10.0, help="Ignore this much of the start for growth rates")
+    parser.add_argument("--drain-s", type=float, default=30.0, help="Wait after stopping clients before the final check")
+    parser.add_argument("--watchdog-mb", type=float, default=400.0, help="Server --memory-watchdog-mb")
+    parser.add_argument("--max-rss-growth", type=float, default=10.0, help="Fail above this many MB/h")
+    parser.add_argument("--max-fd-growth", type=float, default=5.0, help="Fail above this many fds/h")
+    parser.add_argument("--startup-timeout", type=float, default=180.0)
+    parser.add_argument("--out", default='soak_run')
+    parser.add_argument("server_args", nargs=argparse.REMAINDER, help="Extra webrtc_server.py arguments after --")
+    args = parser.parse_args()
+
+    out = Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+    cmd = [
+        sys.executable, str(SERVER),
+        '--source', args.source,
+        '--host', '127.0.0.1',
+        '--port', str(args.port),
+        '--control-token', TOKEN,
+        '--memory-watchdog-mb', str(args.watchdog_mb),
+        '--memory-watchdog-interval', str(max(5.0, args.sample_s)),
+    ]
+    if args.model:
+        cmd += ['--model', args.model]
+    cmd += [a for a in args.server_args if a != '--']
+    # Keep a unit's .env from pointing the soak server at the real broker and API.
+    env = dict(os.environ, MQTT_BROKER='', API_BASE_URL='')
+
+    print(' '.join(cmd))
+    with open(out / 'server.log', 'w') as log:
+        server = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=SERVER.parent.parent)
+        try:
+            summary = asyncio.run(run(args, server, out))
+        finally:
+            if server.poll() is None:
+                server.send_signal(signal.SIGINT)
+                try:
+                    server.wait(30)
+                except subprocess.TimeoutExpired:
+                    server.kill()
+
+    (out / 'summary.json').write_text(json.dumps(summary, indent=2))
+    print(json.dumps({k: summary[k] for k in ('hours', 'rss_mb', 'growth_per_hour', 'after_drain', 'failures')}, indent=2))
+    print(f"Samples: {out / 'samples.csv'}  Summary: {out / 'summary.json'}  Server log: {out / 'server.log'}")
+    sys.exit(1 if summary['failures'] else 0)
+
+
+if __name__ == "__main__":
+    main()
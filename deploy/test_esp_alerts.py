@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Local harness for the compact ESP32 alert protocol (see esp_alert_protocol.py).
+
+Self-test (no broker needed):
+  python deploy/test_esp_alerts.py --self-test
+
+Listen like the ESP32 would and report gaps, reordering and staleness:
+  python deploy/test_esp_alerts.py --mqtt-broker 192.168.1.43 --mqtt-esp-topic nutricycle/esp32
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from esp_alert_protocol import (
+    ALERT_FORMATS,
+    AlertGapTracker,
+    AlertSequencer,
+    decode_alert,
+    encode_alert,
+)
+
+
+def run_self_test() -> int:
+    sequencer = AlertSequencer()
+    failures = 0
+    for fmt in ALERT_FORMATS:
+        if fmt == 'json':
+            continue
+        capture_ts = time.time()
+        for alert, zone_mask in ((True, 0b01), (False, 0), (True, 0b11)):
+            seq = sequencer.next(fmt)
+            payload = encode_alert(fmt, seq, alert, capture_ts, capture_ts + 0.012, zone_mask)
+            decoded = decode_alert(payload)
+            ok = (
+                decoded['seq'] == seq
+                and decoded['alert'] == (1 if alert else 0)
+                and decoded['zone_mask'] == zone_mask
+                and decoded['pipeline_ms'] == 12
+                and abs(decoded['capture_ms'] - capture_ts * 1000.0) <= 1
+            )
+            failures += 0 if ok else 1
+            print(f"{'✅' if ok else '❌'} {fmt:6s} {len(payload):2d} bytes {payload!r} -> {decoded}")
+
+    tracker = AlertGapTracker()
+    verdicts = [tracker.observe(s) for s in (1, 2, 4, 3, 5, 5, 1)]
+    expected = ['ok', 'ok', 'gap', 'reordered', 'ok', 'duplicate', 'restart']
+    ok = (verdicts == expected and tracker.lost == 1 and tracker.reordered == 1
+          and tracker.duplicates == 1 and tracker.restarts == 1)
+    failures += 0 if ok else 1
+    print(f"{'✅' if ok else '❌'} gap tracking {verdicts}")
+
+    try:
+        decode_alert(b'not-an-alert')
+        failures += 1
+        print("❌ malformed payload accepted")
+    except ValueError:
+        print("✅ malformed payload rejected")
+
+    print("")
+    print("All checks passed" if not failures else f"{failures} check(s) failed")
+    return 1 if failures else 0
+
+
+def run_listener(opts) -> int:
+    import paho.mqtt.client as paho
+
+    tracker = AlertGapTracker()
+
+    def on_connect(client, userdata, *connect_args):
+        client.subscribe(opts.mqtt_esp_topic, qos=1)
+        print(f"Subscribed to {opts.mqtt_esp_topic}")
+
+    def on_message(client, userdata, message):
+        payload = message.payload
+        try:
+            alert = decode_alert(payload)
+        except ValueError:
+            try:
+                legacy = json.loads(payload.decode())
+                print(f"legacy json alert={legacy.get('alert')} machine={legacy.get('machine_id')}")
+            except Exception:
+                print(f"⚠️  undecodable payload: {payload!r}")
+            return
+        verdict = tracker.observe(alert['seq'])
+        staleness_ms = time.time() * 1000.0 - alert['capture_ms']
+        print(
+            f"seq={alert['seq']} alert={alert['alert']} zones=0b{alert['zone_mask']:b} "
+            f"pipeline={alert['pipeline_ms']}ms staleness={staleness_ms:.0f}ms {verdict} "
+            f"(lost={tracker.lost} reordered={tracker.reordered} restarts={tracker.restarts})"
+        )
+
+    callback_api = getattr(getattr(paho, 'CallbackAPIVersion', None), 'VERSION2', None)
+    client = paho.Client(callback_api_version=callback_api) if callback_api is not None else paho.Client()
+    if opts.mqtt_username:
+        client.username_pw_set(opts.mqtt_username, opts.mqtt_password)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(opts.mqtt_broker, port=opts.mqtt_port)
+    try:
+        client.loop_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"\nreceived={tracker.received} lost={tracker.lost} reordered={tracker.reordered} restarts={tracker.restarts}")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Decode and check compact ESP32 alerts")
+    parser.add_argument("--self-test", action="store_true", help="Run encode/decode and gap-tracking checks without a broker")
+    parser.add_argument("--mqtt-broker", default=None, help="MQTT broker host to listen on")
+    parser.add_argument("--mqtt-port", type=int, default=1883, help="MQTT broker port")
+    parser.add_argument("--mqtt-esp-topic", default="nutricycle/esp32", help="Topic the server publishes ESP32 alerts to")
+    parser.add_argument("--mqtt-username", default=None, help="MQTT username")
+    parser.add_argument("--mqtt-password", default=None, help="MQTT password")
+    opts = parser.parse_args()
+
+    if opts.self_test or not opts.mqtt_broker:
+        return run_self_test()
+    return run_listener(opts)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""
+Frame orientation and trigger-zone rules shared by webrtc_server.py and offline tools.
+
+Keeping these in one place means batch re-scoring of recorded footage (batch_infer.py)
+flips frames, filters detections and debounces the trigger exactly like the live server.
+"""
+
+import sys
+
+import cv2
+import numpy as np
+
+FLIP_MODES = ('none', 'vertical', 'horizontal', '180')
+_FLIP_CODES = {'vertical': 0, 'horizontal': 1, '180': -1}
+
+
+def apply_flip(frame, flip_mode: str):
+    """Return frame flipped per --flip (vertical=upside-down, horizontal, 180=rotate 180)."""
+    code = _FLIP_CODES.get(flip_mode)
+    if code is None or frame is None:
+        return frame
+    return cv2.flip(frame, code)
+
+
+class FramePreprocessor:
+    """Orient and resize camera frames in one pass into recycled output buffers.
+
+    Flip + resize is a single cv2.warpAffine (mirrored scale matrix) instead of a resize
+    followed by a flip. Output buffers come from a small pool; a buffer that a consumer
+    still references is never overwritten (a fresh one is allocated instead), so frames
+    handed out stay valid for as long as they are used.
+    """
+
+    def __init__(self, flip_mode: str, out_size: tuple[int, int] | None = None, pool_size: int = 8):
+        self.flip_mode = flip_mode if flip_mode in _FLIP_CODES else 'none'
+        self.out_size = out_size  # (width, height) or None to keep the source size
+        self._pool: list = [None] * max(1, int(pool_size))
+        self._next = 0
+        self._matrix = None
+        self._matrix_src = None
+        self.stats = {'frames': 0, 'pool_misses': 0}
+
+    @property
+    def passthrough(self) -> bool:
+        return self.flip_mode == 'none' and self.out_size is None
+
+    def buffer(self, shape: tuple):
+        """Next reusable output buffer of the given shape (also usable as a cap.read() target)."""
+        i = self._next
+        self._next = (i + 1) % len(self._pool)
+        buf = self._pool[i]
+        # Refs: the pool list and getrefcount's own argument. More means a consumer still holds it.
+        if buf is None or buf.shape != shape or sys.getrefcount(buf) > 3:
+            if buf is not None:
+                self.stats['pool_misses'] += 1
+            buf = np.empty(shape, dtype=np.uint8)
+            self._pool[i] = buf
+        return buf
+
+    def _affine(self, src_w: int, src_h: int, out_w: int, out_h: int):
+        if self._matrix_src != (src_w, src_h, out_w, out_h):
+            sx, sy = out_w / src_w, out_h / src_h
+            # Pixel-centre aligned scale, mirrored about the output centre when flipping.
+            mx = self.flip_mode in ('horizontal', '180')
+            my = self.flip_mode in ('vertical', '180')
+            tx = (out_w - 0.5 - 0.5 * sx) if mx else (0.5 * sx - 0.5)
+            ty = (out_h - 0.5 - 0.5 * sy) if my else (0.5 * sy - 0.5)
+            self._matrix = np.array([[-sx if mx else sx, 0.0, tx], [0.0, -sy if my else sy, ty]], dtype=np.float64)
+            self._matrix_src = (src_w, src_h, out_w, out_h)
+        return self._matrix
+
+    def process(self, src):
+        """Return the oriented/resized frame (src itself when nothing needs doing)."""
+        if src is None or self.passthrough:
+            return src
+        self.stats['frames'] += 1
+        src_h, src_w = src.shape[:2]
+        out_w, out_h = self.out_size or (src_w, src_h)
+        dst = self.buffer((out_h, out_w) + src.shape[2:])
+        if (out_w, out_h) == (src_w, src_h):
+            return cv2.flip(src, _FLIP_CODES[self.flip_mode], dst=dst)
+        if self.flip_mode == 'none':
+            return cv2.resize(src, (out_w, out_h), dst=dst, interpolation=cv2.INTER_AREA)
+        return cv2.warpAffine(src, self._affine(src_w, src_h, out_w, out_h), (out_w, out_h), dst=dst,
+                              flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def normalize_xyxy(xyxy) -> list[float] | None:
+    """Normalize YOLO bbox output into [x1, y1, x2, y2]."""
+    try:
+        if xyxy is None:
+            return None
+        # Common Ultralytics shape is [[x1, y1, x2, y2]]
+        if isinstance(xyxy, list) and len(xyxy) == 1 and isinstance(xyxy[0], list):
+            xyxy = xyxy[0]
+        if not isinstance(xyxy, list) or len(xyxy) < 4:
+            return None
+        return [float(xyxy[0]), float(xyxy[1]), float(xyxy[2]), float(xyxy[3])]
+    except Exception:
+        return None
+
+
+def detections_from_result(result, names=None) -> list[dict]:
+    """Convert one Ultralytics result into the server's detection dicts."""
+    dets = []
+    for b in result.boxes:
+        try:
+            cls_id = int(b.cls)
+            dets.append({
+                'cls': cls_id,
+                'name': names[cls_id] if names is not None else str(cls_id),
+                'conf': float(b.conf),
+                'xyxy': normalize_xyxy(b.xyxy.tolist() if hasattr(b, 'xyxy') else None),
+            })
+        except Exception:
+            continue
+    return dets
+
+
+def filter_trigger_detections(
+    dets: list,
+    width: int,
+    height: int,
+    line_trigger_enabled: bool = False,
+    line_y: float = 0.55,
+    side: str = 'top',
+    cls_filter: int | None = None,
+    min_conf: float = 0.5,
+) -> list:
+    """Return detections that are considered trigger-active under current mode."""
+    if not line_trigger_enabled:
+        return dets
+
+    if width <= 0 or height <= 0:
+        return []
+
+    line_y = max(0.0, min(1.0, float(line_y)))
+    line_y_px = line_y * float(height)
+
+    filtered = []
+    for d in dets:
+        try:
+            conf = float(d.get('conf', 0.0))
+            cls_id = int(d.get('cls', -1))
+            xyxy = normalize_xyxy(d.get('xyxy'))
+            if conf < min_conf:
+                continue
+            if cls_filter is not None and cls_id != int(cls_filter):
+                continue
+            if xyxy is None:
+                continue
+            y_center = (float(xyxy[1]) + float(xyxy[3])) / 2.0
+            in_after_line = y_center <= line_y_px if side == 'top' else y_center >= line_y_px
+            if in_after_line:
+                filtered.append(d)
+        except Exception:
+            continue
+
+    return filtered
+
+
+def draw_trigger_line(frame_bgr, line_y: float, side: str, active: bool) -> None:
+    """Draw horizontal trigger line and status label on the annotated frame."""
+    if frame_bgr is None or not hasattr(frame_bgr, 'shape'):
+        return
+
+    h, w = frame_bgr.shape[:2]
+    if h <= 0 or w <= 0:
+        return
+
+    line_y = max(0.0, min(1.0, float(line_y)))
+    y = int(line_y * h)
+
+    # Green when clear, red when trigger zone occupied.
+    color = (0, 0, 255) if active else (0, 255, 0)
+    cv2.line(frame_bgr, (0, y), (w - 1, y), color, 2)
+
+    label = f"TRIGGER LINE y={line_y:.2f} side={side} {'ACTIVE' if active else 'CLEAR'}"
+    label_y = y - 8 if y > 24 else y + 20
+    cv2.putText(
+        frame_bgr,
+        label,
+        (10, label_y),
+        cv2.FONT_HERSHEY_SIMPLEX,
+        0.6,
+        color,
+        2,
+    )
+
+
+class TriggerDebouncer:
+    """ON/OFF gate that flips only after stable_frames consecutive agreeing frames."""
+
+    def __init__(self):
+        self.state = False
+        self.on_streak = 0
+        self.off_streak = 0
+
+    def update(self, has_detection: bool, stable_frames: int = 1) -> bool:
+        """Feed one frame; return True when the trigger state changed."""
+        stable_frames = max(1, int(stable_frames))
+        if has_detection:
+            self.on_streak += 1
+            self.off_streak = 0
+        else:
+            self.off_streak += 1
+            self.on_streak = 0
+
+        if not self.state and has_detection and self.on_streak >= stable_frames:
+            self.state = True
+            return True
+        if self.state and not has_detection and self.off_streak >= stable_frames:
+            self.state = False
+            return True
+        return False
+
+
+def _line_zone_polygon(p0, p1, side: str) -> list[list[float]]:
+    """Half-plane on one side of the (extended) line p0-p1 as a normalized polygon."""
+    (x0, y0), (x1, y1) = p0, p1
+    if side in ('top', 'bottom'):
+        if x1 == x0:
+            raise ValueError("top/bottom line zones need a non-vertical line")
+        slope = (y1 - y0) / (x1 - x0)
+        ya, yb = y0 - slope * x0, y0 + slope * (1.0 - x0)
+        if side == 'top':
+            return [[0.0, -1.0], [1.0, -1.0], [1.0, yb], [0.0, ya]]
+        return [[0.0, ya], [1.0, yb], [1.0, 2.0], [0.0, 2.0]]
+    if side in ('left', 'right'):
+        if y1 == y0:
+            raise ValueError("left/right line zones need a non-horizontal line")
+        slope = (x1 - x0) / (y1 - y0)
+        xa, xb = x0 - slope * y0, x0 + slope * (1.0 - y0)
+        if side == 'left':
+            return [[-1.0, 0.0], [xa, 0.0], [xb, 1.0], [-1.0, 1.0]]
+        return [[xa, 0.0], [2.0, 0.0], [2.0, 1.0], [xb, 1.0]]
+    raise ValueError(f"Unknown line zone side: {side}")
+
+
+class TriggerZones:
+    """Several named trigger zones (polygons or slanted half-planes) with their own debounce.
+
+    Zones are given in normalized coordinates and rasterized once per frame size into a
+    uint16 lookup mask (bit i = zone i), so assigning every detection to zones is a single
+    vectorized gather at the box centres. Overlays are rendered once per (size, active mask)
+    and pasted onto frames.
+
+    Config (JSON list, at most 16 zones):
+      {"name": "gate1", "polygon": [[x, y], ...]}                  normalized polygon
+      {"name": "gate2", "line": [[x0, y0], [x1, y1]], "side": "top"} side of a slanted line
+    Optional per zone: "class" (id filter), "min_conf", "stable_frames", "topic" (MQTT).
+    """
+
+    MAX_ZONES = 16
+
+    def __init__(self, zones: list[dict], default_min_conf: float = 0.5, default_stable_frames: int = 3):
+        if not zones:
+            raise ValueError("at least one trigger zone is required")
+        if len(zones) > self.MAX_ZONES:
+            raise ValueError(f"at most {self.MAX_ZONES} trigger zones are supported")
+        self.zones = []
+        for i, z in enumerate(zones):
+            if 'polygon' in z:
+                polygon = [[float(x), float(y)] for x, y in z['polygon']]
+                line = None
+            elif 'line' in z:
+                line = [[float(x), float(y)] for x, y in z['line']]
+                polygon = _line_zone_polygon(line[0], line[1], z.get('side', 'top'))
+            else:
+                raise ValueError(f"zone {i} needs 'polygon' or 'line'")
+            if len(polygon) < 3:
+                raise ValueError(f"zone {i} polygon needs at least 3 points")
+            self.zones.append({
+                'index': i,
+                'name': str(z.get('name') or f'zone{i}'),
+                'polygon': polygon,
+                'line': line,
+                'cls': None if z.get('class') is None else int(z['class']),
+                'min_conf': float(z.get('min_conf', default_min_conf)),
+                'stable_frames': max(1, int(z.get('stable_frames', default_stable_frames))),
+                'inherit_min_conf': 'min_conf' not in z,
+                'inherit_stable_frames': 'stable_frames' not in z,
+                'topic': z.get('topic'),
+                'debouncer': TriggerDebouncer(),
+                'transitions': 0,
+            })
+        self._min_conf = np.array([z['min_conf'] for z in self.zones], dtype=np.float32)
+        self._cls = np.array([-1 if z['cls'] is None else z['cls'] for z in self.zones], dtype=np.int32)
+        self._bits = (1 << np.arange(len(self.zones))).astype(np.uint16)
+        self._masks: dict[tuple[int, int], np.ndarray] = {}
+        self._overlays: dict[tuple[int, int, int], tuple] = {}
+        self.last_counts = np.zeros(len(self.zones), dtype=np.int32)
+
+    @classmethod
+    def from_config(cls, value: str, **kwargs) -> 'TriggerZones':
+        """Build from a JSON file path or an inline JSON string."""
+        import json
+        from pathlib import Path
+
+        text = Path(value).read_text() if not value.lstrip().startswith('[') else value
+        return cls(json.loads(text), **kwargs)
+
+    def set_defaults(self, min_conf: float | None = None, stable_frames: int | None = None) -> None:
+        """Change the defaults for zones that do not set min_conf / stable_frames themselves."""
+        for zone in self.zones:
+            if min_conf is not None and zone['inherit_min_conf']:
+                zone['min_conf'] = float(min_conf)
+            if stable_frames is not None and zone['inherit_stable_frames']:
+                zone['stable_frames'] = max(1, int(stable_frames))
+        self._min_conf = np.array([z['min_conf'] for z in self.zones], dtype=np.float32)
+
+    @property
+    def state_mask(self) -> int:
+        """Debounced state of every zone as a bit mask (bit i = zone i active)."""
+        return sum(1 << z['index'] for z in self.zones if z['debouncer'].state)
+
+    def _pixel_polygon(self, zone: dict, width: int, height: int):
+        return np.array([[x * (width - 1), y * (height - 1)] for x, y in zone['polygon']], dtype=np.float64)
+
+    def mask(self, width: int, height: int) -> np.ndarray:
+        key = (width, height)
+        lut = self._masks.get(key)
+        if lut is None:
+            lut = np.zeros((height, width), dtype=np.uint16)
+            layer = np.zeros((height, width), dtype=np.uint8)
+            for zone in self.zones:
+                layer[:] = 0
+                cv2.fillPoly(layer, [np.round(self._pixel_polygon(zone, width, height)).astype(np.int32)], 1)
+                lut[layer.astype(bool)] |= np.uint16(1 << zone['index'])
+            self._masks[key] = lut
+        return lut
+
+    def occupancy(self, dets: list, width: int, height: int) -> np.ndarray:
+        """Per-zone count of qualifying detections whose box centre lies in the zone."""
+        counts = np.zeros(len(self.zones), dtype=np.int32)
+        boxes = [(normalize_xyxy(d.get('xyxy')), d) for d in dets]
+        boxes = [(b, d) for b, d in boxes if b is not None]
+        if not boxes or width <= 0 or height <= 0:
+            return counts
+        xyxy = np.array([b for b, _ in boxes], dtype=np.float32)
+        conf = np.array([float(d.get('conf', 0.0)) for _, d in boxes], dtype=np.float32)
+        cls_ids = np.array([int(d.get('cls', -1)) for _, d in boxes], dtype=np.int32)
+        cx = np.clip(((xyxy[:, 0] + xyxy[:, 2]) * 0.5).astype(np.int32), 0, width - 1)
+        cy = np.clip(((xyxy[:, 1] + xyxy[:, 3]) * 0.5).astype(np.int32), 0, height - 1)
+        hits = (self.mask(width, height)[cy, cx][:, None] & self._bits[None, :]) != 0
+        hits &= conf[:, None] >= self._min_conf[None, :]
+        hits &= (self._cls[None, :] < 0) | (cls_ids[:, None] == self._cls[None, :])
+        return hits.sum(axis=0)
+
+    def active_mask(self, dets: list, width: int, height: int) -> int:
+        """Instantaneous (not debounced) occupancy as a bit mask."""
+        counts = self.occupancy(dets, width, height)
+        return int(sum(1 << i for i, c in enumerate(counts) if c))
+
+    def update(self, dets: list, width: int, height: int) -> list[tuple[dict, bool, int]]:
+        """Feed one frame; return (zone, new_state, count) for every zone that changed."""
+        counts = self.occupancy(dets, width, height)
+        self.last_counts = counts
+        changed = []
+        for zone, count in zip(self.zones, counts):
+            if zone['debouncer'].update(bool(count), zone['stable_frames']):
+                zone['transitions'] += 1
+                changed.append((zone, zone['debouncer'].state, int(count)))
+        return changed
+
+    def zone_detections(self, zone: dict, dets: list, width: int, height: int) -> list:
+        """Detections counted for one zone (used for event payloads, not per frame)."""
+        out = []
+        for d in dets:
+            if self.occupancy([d], width, height)[zone['index']]:
+                out.append(d)
+        return out
+
+    def draw(self, frame_bgr, active_mask: int) -> None:
+        """Paste the cached zone overlay for this frame size and activity onto frame_bgr."""
+        if frame_bgr is None or not hasattr(frame_bgr, 'shape'):
+            return
+        h, w = frame_bgr.shape[:2]
+        key = (w, h, active_mask)
+        cached = self._overlays.get(key)
+        if cached is None:
+            if len(self._overlays) > 64:
+                self._overlays.clear()
+            canvas = np.zeros((h, w, 3), dtype=np.uint8)
+            drawn = np.zeros((h, w), dtype=np.uint8)
+            for zone in self.zones:
+                active = bool(active_mask & (1 << zone['index']))
+                color = (0, 0, 255) if active else (0, 255, 0)
+                if zone['line'] is not None:
+                    (x0, y0), (x1, y1) = zone['line']
+                    pts = np.array([[x0 * (w - 1), y0 * (h - 1)], [x1 * (w - 1), y1 * (h - 1)]], dtype=np.int32)
+                else:
+                    pts = np.round(self._pixel_polygon(zone, w, h)).astype(np.int32)
+                for target, value in ((canvas, color), (drawn, 255)):
+                    cv2.polylines(target, [pts], zone['line'] is None, value, 2)
+                    anchor = pts.min(axis=0)
+                    cv2.putText(target, f"{zone['name']} {'ACTIVE' if active else 'CLEAR'}",
+                                (int(max(5, anchor[0] + 5)), int(max(18, anchor[1] + 18))),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, value, 1)
+            ys, xs = np.nonzero(drawn)
+            cached = (ys, xs, canvas[ys, xs])
+            self._overlays[key] = cached
+        ys, xs, values = cached
+        frame_bgr[ys, xs] = values
+
+    def client_config(self) -> list[dict]:
+        return [{'name': z['name'], 'polygon': z['polygon'], 'line': z['line']} for z in self.zones]
+
+    def snapshot(self) -> list[dict]:
+        return [
+            {
+                'name': z['name'],
+                'state': z['debouncer'].state,
+                'transitions': z['transitions'],
+                'class': z['cls'],
+                'min_conf': z['min_conf'],
+                'stable_frames': z['stable_frames'],
+                'topic': z['topic'],
+            }
+            for z in self.zones
+        ]
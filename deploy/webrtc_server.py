@@ -9,51 +9,190 @@ Usage:
 
 import argparse
 import asyncio
+import collections
 import contextlib
+import fractions
+import functools
+import hmac
 import json
 import logging
 import os
+import shutil
+import subprocess
 import sys
+import threading
 import time
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Full, Queue
 
 import cv2
 import numpy as np
 from aiohttp import web, ClientSession
-from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack, RTCConfiguration, RTCIceServer
+import av
+from aiortc import (
+    MediaStreamTrack,
+    RTCConfiguration,
+    RTCIceServer,
+    RTCPeerConnection,
+    RTCRtpSender,
+    RTCSessionDescription,
+    VideoStreamTrack,
+)
 from aiortc.contrib.media import MediaBlackhole
+from aiortc.mediastreams import MediaStreamError
 from av import VideoFrame
 from ultralytics import YOLO
 
+from debug_profiling import MemoryTracker, MemoryWatchdog, StackSampler, process_stats
+from esp_alert_protocol import ALERT_FORMATS, AlertSequencer, encode_alert
+from frame_sources import open_frame_source
+from trigger_logic import (
+    FLIP_MODES,
+    FramePreprocessor,
+    TriggerDebouncer,
+    TriggerZones,
+    detections_from_result,
+    draw_trigger_line,
+    filter_trigger_detections,
+    normalize_xyxy as _normalize_xyxy,
+)
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Global args
 args = None
 model = None
+runtime_config = None  # RuntimeConfig: settings that can change without a restart
 shared_camera = None  # Singleton camera instance
 model_is_onnx = False
 model_is_ncnn = False
-
-# Event queue for detection events
-from asyncio import Queue
-event_queue: Queue = Queue(maxsize=32)  # non-blocking if full
+model_check = None  # Result of the --model-reference agreement check, shown in /status
 
 # Global detection state gate to avoid per-frame spam.
-# False means currently clear/no trigger, True means trigger active.
-last_has_detection = False
+# trigger_debouncer.state: False means currently clear/no trigger, True means trigger active.
+trigger_debouncer = TriggerDebouncer()
+# Multi-zone triggers from --trigger-zones (None = single --trigger-line-y line).
+trigger_zones: TriggerZones | None = None
 detection_state_lock = asyncio.Lock()
-detection_on_streak = 0
-detection_off_streak = 0
+
+# Per-topic sequence numbers for compact ESP32 alerts
+alert_sequencer = AlertSequencer()
 
 # In-memory latest annotated frame (JPEG bytes) for instant preview
 latest_frame_jpeg = None
-latest_frame_lock = asyncio.Lock()
+MJPEG_BOUNDARY = 'frame'
+
+
+def _parse_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lower() in ('1', 'true', 'yes', 'on', '0', 'false', 'no', 'off'):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(value, (int, float)) and value in (0, 1):
+        return bool(value)
+    raise ValueError(f"expected a boolean, got {value!r}")
+
+
+def _parse_optional(cast):
+    def parse(value):
+        return None if value is None or value == '' else cast(value)
+    return parse
+
+
+class RuntimeConfig:
+    """Versioned, immutable snapshot of the settings that can change while running.
+
+    Startup-only options stay on `args`. The trigger path takes `runtime_config` once per
+    frame and uses that object throughout, so a frame never mixes old and new values.
+    replace() validates a whole update before building the next version; publishing it
+    is a single reference assignment.
+    """
+
+    FIELDS = {
+        'conf': float,
+        'imgsz': int,
+        'flip': str,
+        'line_trigger_enabled': _parse_bool,
+        'trigger_line_y': float,
+        'after_line_side': str,
+        'trigger_stable_frames': int,
+        'trigger_min_conf': _parse_optional(float),
+        'trigger_class': _parse_optional(int),
+    }
+    __slots__ = ('version', 'updated_at', 'source', *FIELDS)
+
+    def __init__(self, version: int = 1, source: str = 'startup', **values):
+        object.__setattr__(self, 'version', int(version))
+        object.__setattr__(self, 'updated_at', time.time())
+        object.__setattr__(self, 'source', source)
+        for name, value in self._validate(values).items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RuntimeConfig is immutable; use replace()")
+
+    @classmethod
+    def from_args(cls, parsed) -> 'RuntimeConfig':
+        return cls(**{name: getattr(parsed, name) for name in cls.FIELDS})
+
+    @classmethod
+    def _validate(cls, values: dict) -> dict:
+        unknown = sorted(set(values) - set(cls.FIELDS))
+        if unknown:
+            raise ValueError(f"not runtime-configurable: {', '.join(unknown)}")
+        out = {}
+        for name, value in values.items():
+            try:
+                out[name] = cls.FIELDS[name](value)
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"{name}: {e}") from None
+        checks = {
+            'conf': lambda v: 0.0 < v <= 1.0,
+            'imgsz': lambda v: 32 <= v <= 2048,
+            'flip': lambda v: v in FLIP_MODES,
+            'trigger_line_y': lambda v: 0.0 <= v <= 1.0,
+            'after_line_side': lambda v: v in ('top', 'bottom'),
+            'trigger_stable_frames': lambda v: v >= 1,
+            'trigger_min_conf': lambda v: v is None or 0.0 < v <= 1.0,
+            'trigger_class': lambda v: v is None or v >= 0,
+        }
+        for name, value in out.items():
+            if name in checks and not checks[name](value):
+                raise ValueError(f"{name}: invalid value {value!r}")
+        return out
+
+    def replace(self, updates: dict, source: str) -> 'RuntimeConfig':
+        """Return the next version with updates applied (ValueError if any field is invalid)."""
+        values = {name: getattr(self, name) for name in self.FIELDS}
+        values.update(self._validate(updates))
+        return RuntimeConfig(version=self.version + 1, source=source, **values)
+
+    def diff(self, other: 'RuntimeConfig') -> dict:
+        return {
+            name: [getattr(other, name), getattr(self, name)]
+            for name in self.FIELDS
+            if getattr(other, name) != getattr(self, name)
+        }
+
+    @property
+    def trigger_conf(self) -> float:
+        return self.trigger_min_conf if self.trigger_min_conf is not None else self.conf
+
+    def as_dict(self) -> dict:
+        return {
+            'version': self.version,
+            'updated_at': self.updated_at,
+            'source': self.source,
+            **{name: getattr(self, name) for name in self.FIELDS},
+        }
 
 
 # Persist the latest known batchNumber locally so we don't need to call
 # protected endpoints like GET /batches?machineId=... just to resolve "latest".
-STATE_FILE = Path(__file__).with_name("device_state.json")
+# DEVICE_STATE_FILE lets test harnesses keep their batches out of the unit's real state.
+STATE_FILE = Path(os.environ.get("DEVICE_STATE_FILE") or Path(__file__).with_name("device_state.json"))
 _last_batch_cache = {}
 
 
@@ -249,69 +388,1063 @@ def _url_variants(server_url: str, path: str) -> list[str]:
     return [f"{base}{p}", f"{base}/api{p}"]
 
 
+# Commands that must bypass routine control traffic (telemetry, stage updates, batch resolution).
+SAFETY_COMMANDS = ('emergency_stop',)
+
+
+class CommandScheduler:
+    """Prioritized scheduler for control-plane work coming from MQTT and HTTP.
+
+    Safety work runs immediately as its own task and is never queued behind HTTP calls.
+    Routine work is serialized per lane key (batchNumber) so commands for the same batch
+    keep their arrival order, while different batches still run concurrently.
+    Safe to call submit_* from the paho MQTT thread.
+    """
+
+    def __init__(self, loop, safety_budget_ms: float = 50.0):
+        self.loop = loop
+        self.safety_budget_ms = float(safety_budget_ms)
+        self._lanes: dict[str, list] = {}
+        self._lane_tasks: dict[str, asyncio.Task] = {}
+        self.stats = {
+            'safety_commands': 0,
+            'safety_last_latency_ms': None,
+            'safety_max_latency_ms': 0.0,
+            'safety_budget_ms': self.safety_budget_ms,
+            'safety_budget_violations': 0,
+            'routine_submitted': 0,
+            'routine_completed': 0,
+            'routine_failed': 0,
+            'routine_dropped_by_safety': 0,
+        }
+
+    def record_safety_forward(self, command: str, received_at: float, source: str) -> float:
+        """Track receive-to-forward latency for a safety command (monotonic timestamps)."""
+        latency_ms = (time.monotonic() - received_at) * 1000.0
+        self.stats['safety_commands'] += 1
+        self.stats['safety_last_latency_ms'] = round(latency_ms, 3)
+        self.stats['safety_max_latency_ms'] = round(max(self.stats['safety_max_latency_ms'], latency_ms), 3)
+        if latency_ms > self.safety_budget_ms:
+            self.stats['safety_budget_violations'] += 1
+            logger.warning(
+                f"Safety command '{command}' ({source}) forwarded in {latency_ms:.1f}ms, "
+                f"over budget of {self.safety_budget_ms:.0f}ms"
+            )
+        else:
+            logger.info(f"Safety command '{command}' ({source}) forwarded in {latency_ms:.1f}ms")
+        return latency_ms
+
+    def submit_safety(self, coro_factory) -> None:
+        """Run safety work right away, preempting any pending routine work flagged as unsafe."""
+        def _schedule():
+            self.preempt()
+            self.loop.create_task(self._run_safety(coro_factory))
+        self._call_in_loop(_schedule)
+
+    def submit_routine(self, key: str | None, coro_factory, label: str = '', drop_on_safety: bool = False) -> None:
+        """Queue routine work on its lane; items in one lane run strictly in submit order."""
+        lane_key = key or '__latest__'
+
+        def _schedule():
+            self.stats['routine_submitted'] += 1
+            self._lanes.setdefault(lane_key, []).append((coro_factory, label, drop_on_safety))
+            if lane_key not in self._lane_tasks:
+                self._lane_tasks[lane_key] = self.loop.create_task(self._drain_lane(lane_key))
+        self._call_in_loop(_schedule)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            'routine_pending': sum(len(items) for items in self._lanes.values()),
+            'active_lanes': len(self._lane_tasks),
+        }
+
+    def _call_in_loop(self, fn) -> None:
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            fn()
+        else:
+            self.loop.call_soon_threadsafe(fn)
+
+    def preempt(self) -> None:
+        """Drop queued routine work that must not run after a safety command (loop thread only)."""
+        for lane_key, items in self._lanes.items():
+            kept = [item for item in items if not item[2]]
+            dropped = len(items) - len(kept)
+            if dropped:
+                self.stats['routine_dropped_by_safety'] += dropped
+                logger.warning(f"Safety command dropped {dropped} pending routine command(s) on lane {lane_key}")
+                items[:] = kept
+
+    async def _run_safety(self, coro_factory) -> None:
+        try:
+            await coro_factory()
+        except Exception as e:
+            logger.error(f"Safety command handling failed: {e}", exc_info=True)
+
+    async def _drain_lane(self, lane_key: str) -> None:
+        try:
+            while self._lanes.get(lane_key):
+                coro_factory, label, _ = self._lanes[lane_key].pop(0)
+                try:
+                    await coro_factory()
+                    self.stats['routine_completed'] += 1
+                except Exception as e:
+                    self.stats['routine_failed'] += 1
+                    logger.error(f"Routine command '{label}' failed on lane {lane_key}: {e}", exc_info=True)
+        finally:
+            self._lanes.pop(lane_key, None)
+            self._lane_tasks.pop(lane_key, None)
+
+
+class DetectionEventChannel:
+    """Lossless, coalescing channel between the inference paths and event_broadcaster.
+
+    put_nowait() never fails and never discards the newest state. When the publisher
+    falls behind (slow or disconnected broker), pending transitions accumulate up to
+    maxlen; beyond that the oldest are dropped. get_batch() hands every pending event to
+    the publisher at once so it can merge the run into the newest state.
+    """
+
+    def __init__(self, maxlen: int = 32):
+        self.maxlen = max(1, int(maxlen))
+        self._pending: list[dict] = []
+        self._ready = asyncio.Event()
+        self.stats = {
+            'events_received': 0,
+            'events_published': 0,
+            'events_merged': 0,
+            'events_dropped': 0,
+            'max_batch_size': 0,
+        }
+
+    def put_nowait(self, event: dict) -> None:
+        self.stats['events_received'] += 1
+        self._pending.append(event)
+        overflow = len(self._pending) - self.maxlen
+        if overflow > 0:
+            del self._pending[:overflow]
+            self.stats['events_dropped'] += overflow
+        self._ready.set()
+
+    def requeue(self, batch: list[dict]) -> None:
+        """Put an unpublished batch back in front of anything that arrived meanwhile."""
+        if not batch:
+            return
+        self._pending[:0] = batch
+        overflow = len(self._pending) - self.maxlen
+        if overflow > 0:
+            del self._pending[:overflow]
+            self.stats['events_dropped'] += overflow
+        self._ready.set()
+
+    async def get_batch(self) -> list[dict]:
+        """Wait for at least one event and return all pending events, oldest first."""
+        while not self._pending:
+            self._ready.clear()
+            await self._ready.wait()
+        batch, self._pending = self._pending, []
+        self._ready.clear()
+        return batch
+
+    def coalesce(self, batch: list[dict]) -> dict:
+        """Merge a run of transitions into the newest event, keeping a compact trail.
+
+        Requeued events may already be coalesced; their trails are carried over so a
+        failed publish never shortens the history.
+        """
+        newest = dict(batch[-1])
+        merged = batch[:-1]
+        if merged:
+            # The trail changes the full event, so it is sent again. The device alert depends only
+            # on the newest state: if that already went out it stays sent; otherwise it reuses the
+            # oldest alert number that never reached the device, so the device sees no gap.
+            if 'esp' in newest.get('_sent', ()):
+                newest['_sent'] = ['esp']
+            else:
+                newest.pop('_sent', None)
+                seq = next((e['alert_seq'] for e in batch if 'alert_seq' in e and 'esp' not in e.get('_sent', ())), None)
+                if seq is not None:
+                    newest['alert_seq'] = seq
+            trail = list(newest.get('merged_transitions', ()))
+            for e in merged:
+                trail.extend(e.get('merged_transitions', ()))
+                trail.append({'timestamp': e.get('timestamp'), 'has_detection': e.get('has_detection')})
+            newest['coalesced'] = newest.get('coalesced', 0) + sum(1 + e.get('coalesced', 0) for e in merged)
+            newest['merged_transitions'] = sorted(trail, key=lambda t: t.get('timestamp') or 0.0)
+            self.stats['events_merged'] += len(merged)
+        self.stats['max_batch_size'] = max(self.stats['max_batch_size'], len(batch))
+        return newest
+
+    def coalesce_zones(self, batch: list[dict]) -> list[dict]:
+        """coalesce() per trigger zone, so one zone's run never hides another zone's state."""
+        groups: dict = {}
+        for event in batch:
+            groups.setdefault(event.get('zone'), []).append(event)
+        return sorted((self.coalesce(g) for g in groups.values()), key=lambda e: e.get('timestamp') or 0.0)
+
+    def mark_published(self) -> None:
+        self.stats['events_published'] += 1
+
+    def snapshot(self) -> dict:
+        return {**self.stats, 'pending': len(self._pending), 'maxlen': self.maxlen}
+
+
+class LatencyGovernor:
+    """Trade stream and inference quality for trigger latency under a fixed budget.
+
+    Every processed frame reports its capture-to-decision latency and every MQTT publish
+    reports how long the broadcaster took on top. Each interval the p90 frame latency plus
+    the average publish lag is compared to the budget: over budget steps one level down
+    the ladder (stream resolution, then inference cadence, then imgsz); under
+    headroom * budget for recover_s steps one level back up.
+    """
+
+    STREAM_SCALES = (1.0, 0.75, 0.5)
+    INFER_EVERY = (1, 2, 3)
+
+    def __init__(self, budget_ms: float, imgsz: int, min_imgsz: int = 160, fixed_imgsz: bool = False,
+                 interval: float = 2.0, headroom: float = 0.6, recover_s: float = 10.0, min_samples: int = 5):
+        self.budget_ms = float(budget_ms)
+        self.interval = max(0.5, float(interval))
+        self.headroom = min(0.95, max(0.1, float(headroom)))
+        self.recover_s = max(self.interval, float(recover_s))
+        self.min_samples = max(1, int(min_samples))
+        self.min_imgsz = int(min_imgsz)
+        self.fixed_imgsz = bool(fixed_imgsz)
+        self.levels = self._build_levels(int(imgsz), self.min_imgsz, self.fixed_imgsz)
+        self.level = 0
+        self._samples: collections.deque = collections.deque(maxlen=240)
+        self._publish_lag_ms = 0.0
+        self._last_eval = time.monotonic()
+        self._calm_since = None
+        self.changes: collections.deque = collections.deque(maxlen=20)
+        self.stats = {
+            'estimate_ms': None,
+            'publishes': 0,
+            'last_publish_ms': None,
+            'max_publish_ms': 0.0,
+            'over_budget_publishes': 0,
+            'step_downs': 0,
+            'step_ups': 0,
+        }
+
+    @classmethod
+    def _build_levels(cls, imgsz: int, min_imgsz: int, fixed_imgsz: bool) -> list[dict]:
+        levels = [{'stream_scale': s, 'infer_every': 1, 'imgsz': imgsz} for s in cls.STREAM_SCALES]
+        levels += [{'stream_scale': cls.STREAM_SCALES[-1], 'infer_every': n, 'imgsz': imgsz} for n in cls.INFER_EVERY[1:]]
+        if not fixed_imgsz:
+            # Ultralytics pads to stride 32, so smaller sizes step by 64 down to the floor.
+            size = imgsz - 64
+            while size >= max(32, min_imgsz):
+                levels.append({'stream_scale': cls.STREAM_SCALES[-1], 'infer_every': cls.INFER_EVERY[-1], 'imgsz': size})
+                size -= 64
+        return levels
+
+    def rebase(self, imgsz: int) -> None:
+        """Rebuild the ladder around a new base imgsz (runtime config change), keeping the level."""
+        self.levels = self._build_levels(int(imgsz), self.min_imgsz, self.fixed_imgsz)
+        self.level = min(self.level, len(self.levels) - 1)
+        self._samples.clear()
+
+    @property
+    def current(self) -> dict:
+        return self.levels[self.level]
+
+    @property
+    def stream_scale(self) -> float:
+        return self.current['stream_scale']
+
+    @property
+    def infer_every(self) -> int:
+        return self.current['infer_every']
+
+    @property
+    def imgsz(self) -> int:
+        return self.current['imgsz']
+
+    def observe_frame(self, capture_ts: float | None) -> None:
+        """Record capture-to-decision latency for one processed frame (event loop only)."""
+        if capture_ts is None:
+            return
+        self._samples.append((time.time() - capture_ts) * 1000.0)
+        now = time.monotonic()
+        if now - self._last_eval >= self.interval:
+            self._last_eval = now
+            self._evaluate(now)
+
+    def observe_publish(self, event: dict) -> None:
+        """Record an MQTT publish: full capture-to-publish latency and broadcaster lag."""
+        now = time.time()
+        capture_ts = event.get('capture_timestamp') or event.get('timestamp') or now
+        total_ms = (now - capture_ts) * 1000.0
+        lag_ms = (now - (event.get('timestamp') or now)) * 1000.0
+        self._publish_lag_ms = 0.8 * self._publish_lag_ms + 0.2 * lag_ms
+        self.stats['publishes'] += 1
+        self.stats['last_publish_ms'] = round(total_ms, 1)
+        self.stats['max_publish_ms'] = round(max(self.stats['max_publish_ms'], total_ms), 1)
+        if total_ms > self.budget_ms:
+            self.stats['over_budget_publishes'] += 1
+            logger.warning(f"Trigger published {total_ms:.0f}ms after capture (budget {self.budget_ms:.0f}ms)")
+
+    def _evaluate(self, now: float) -> None:
+        if len(self._samples) < self.min_samples:
+            return
+        samples = sorted(self._samples)
+        estimate = samples[int(0.9 * (len(samples) - 1))] + self._publish_lag_ms
+        self.stats['estimate_ms'] = round(estimate, 1)
+        if estimate > self.budget_ms:
+            self._calm_since = None
+            if self.level < len(self.levels) - 1:
+                self._step(self.level + 1, estimate)
+        elif estimate < self.budget_ms * self.headroom:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.recover_s and self.level > 0:
+                self._step(self.level - 1, estimate)
+                self._calm_since = now
+        else:
+            self._calm_since = None
+
+    def _step(self, level: int, estimate: float) -> None:
+        before, after = self.current, self.levels[level]
+        down = level > self.level
+        self.level = level
+        # Samples measured at the old setting would otherwise drive the next decision.
+        self._samples.clear()
+        self.stats['step_downs' if down else 'step_ups'] += 1
+        self.changes.append({
+            'at': round(time.time(), 3),
+            'direction': 'down' if down else 'up',
+            'level': level,
+            'estimate_ms': round(estimate, 1),
+            'from': before,
+            'to': after,
+        })
+        msg = (
+            f"Latency governor {'down' if down else 'up'} to level {level}/{len(self.levels) - 1}: "
+            f"stream x{after['stream_scale']}, infer every {after['infer_every']}, imgsz {after['imgsz']} "
+            f"(p90 estimate {estimate:.0f}ms, budget {self.budget_ms:.0f}ms)"
+        )
+        (logger.warning if down else logger.info)(msg)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            'budget_ms': self.budget_ms,
+            'level': self.level,
+            'max_level': len(self.levels) - 1,
+            'current': self.current,
+            'publish_lag_ms': round(self._publish_lag_ms, 1),
+            'recent_changes': list(self.changes),
+        }
+
+
+# Set in main() when --latency-budget-ms > 0.
+latency_governor: LatencyGovernor | None = None
+
+
+# Channel for detection state events (never blocks the inference paths).
+event_queue = DetectionEventChannel(maxlen=32)
+
+
+# One row per processed frame; ~64 bytes each, so 65536 rows stay around 4 MB.
+DETECTION_HISTORY_DTYPE = np.dtype([
+    ('timestamp', 'f8'),
+    ('frame_id', 'i8'),
+    ('batch', 'S36'),
+    ('count', 'u2'),
+    ('trigger_count', 'u2'),
+    ('max_conf', 'f4'),
+    ('top_cls', 'i2'),
+    ('state', 'u1'),
+    ('transition', 'u1'),
+])
+
+
+class DetectionHistory:
+    """Fixed-memory ring of per-frame detection summaries, queryable by time range.
+
+    Rows are appended in timestamp order, so the ring is two sorted segments and a
+    range query is two binary searches. When spill_dir is set, every full segment of
+    segment_size rows is written to disk as a compact .npy file (oldest deleted past
+    max_disk_mb) and reloaded on startup so history survives restarts.
+
+    append() runs on the event loop and query() on an executor thread; a lock covers the
+    ring only, so disk reads never hold up appends.
+    """
+
+    def __init__(self, capacity: int, spill_dir: str | None = None, segment_size: int = 4096, max_disk_mb: float = 200.0):
+        self.capacity = max(1, int(capacity))
+        self.buffer = np.zeros(self.capacity, dtype=DETECTION_HISTORY_DTYPE)
+        self.size = 0
+        self.head = 0  # next write index
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        self.segment_size = max(1, min(int(segment_size), self.capacity))
+        self.max_disk_bytes = int(max(1.0, float(max_disk_mb)) * 1024 * 1024)
+        self._unspilled = 0
+        self._last_ts = float('-inf')
+        self._lock = threading.Lock()
+        self.stats = {'rows_written': 0, 'segments_spilled': 0, 'segments_loaded': 0, 'spill_errors': 0}
+        if self.spill_dir:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            self._load_spilled_tail()
+
+    def append(self, timestamp: float, frame_id: int | None, batch: str | None, dets: list,
+               trigger_count: int, state: bool, transition: bool) -> None:
+        top = max(dets, key=lambda d: d.get('conf', 0.0), default=None)
+        spill = None
+        with self._lock:
+            # Keep timestamps non-decreasing so binary search stays valid even when
+            # concurrent paths finish inference out of capture order.
+            timestamp = max(float(timestamp), self._last_ts)
+            self._last_ts = timestamp
+            row = self.buffer[self.head]
+            row['timestamp'] = timestamp
+            row['frame_id'] = -1 if frame_id is None else int(frame_id)
+            row['batch'] = (batch or '').encode('utf-8')[:36]
+            row['count'] = min(len(dets), 0xFFFF)
+            row['trigger_count'] = min(int(trigger_count), 0xFFFF)
+            row['max_conf'] = float(top.get('conf', 0.0)) if top else 0.0
+            row['top_cls'] = int(top.get('cls', -1)) if top else -1
+            row['state'] = 1 if state else 0
+            row['transition'] = 1 if transition else 0
+            self.head = (self.head + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+            self.stats['rows_written'] += 1
+            self._unspilled += 1
+            if self.spill_dir and self._unspilled >= self.segment_size:
+                self._unspilled = 0
+                spill = self._ordered()[-self.segment_size:].copy()
+        if spill is not None:
+            self._spill(spill)
+
+    @staticmethod
+    def _filter(rows: np.ndarray, batch: str | None, transitions_only: bool) -> np.ndarray:
+        if batch:
+            rows = rows[rows['batch'] == batch.encode('utf-8')[:36]]
+        if transitions_only:
+            rows = rows[rows['transition'] == 1]
+        return rows
+
+    def query(self, since: float | None = None, until: float | None = None, batch: str | None = None,
+              transitions_only: bool = False, limit: int = 5000) -> np.ndarray:
+        """Newest limit matching rows in [since, until], oldest first. Blocking when spilled
+        segments are read; run it off the event loop."""
+        lo = float('-inf') if since is None else float(since)
+        hi = float('inf') if until is None else float(until)
+        parts = []
+        with self._lock:
+            oldest_in_ring = float(self._segments()[0]['timestamp'][0]) if self.size else float('inf')
+            for segment in self._segments():
+                ts = segment['timestamp']
+                start = int(np.searchsorted(ts, lo, side='left'))
+                end = int(np.searchsorted(ts, hi, side='right'))
+                if end > start:
+                    # Boolean filters copy; plain slices are views the next append may overwrite.
+                    parts.append(self._filter(segment[start:end], batch, transitions_only).copy())
+        found = sum(len(p) for p in parts)
+        if self.spill_dir and lo < oldest_in_ring and (not limit or found < limit):
+            remaining = limit - found if limit else 0
+            parts[:0] = self._query_spilled(lo, min(hi, oldest_in_ring), batch, transitions_only, remaining)
+        rows = np.concatenate(parts) if parts else np.zeros(0, dtype=DETECTION_HISTORY_DTYPE)
+        return rows[-limit:] if limit and len(rows) > limit else rows
+
+    @staticmethod
+    def to_records(rows: np.ndarray) -> list[dict]:
+        return [
+            {
+                'timestamp': float(r['timestamp']),
+                'frame_id': None if int(r['frame_id']) < 0 else int(r['frame_id']),
+                'batch': r['batch'].decode('utf-8', 'replace') or None,
+                'count': int(r['count']),
+                'trigger_count': int(r['trigger_count']),
+                'max_conf': round(float(r['max_conf']), 4),
+                'top_cls': None if int(r['top_cls']) < 0 else int(r['top_cls']),
+                'state': int(r['state']),
+                'transition': bool(r['transition']),
+            }
+            for r in rows
+        ]
+
+    def snapshot(self) -> dict:
+        ordered = self._ordered()
+        return {
+            **self.stats,
+            'capacity': self.capacity,
+            'size': self.size,
+            'oldest': float(ordered['timestamp'][0]) if self.size else None,
+            'newest': float(ordered['timestamp'][-1]) if self.size else None,
+            'spill_dir': str(self.spill_dir) if self.spill_dir else None,
+        }
+
+    def _segments(self) -> list[np.ndarray]:
+        """Ring contents as (at most two) chronologically sorted views, oldest first."""
+        if self.size < self.capacity:
+            return [self.buffer[:self.size]]
+        return [self.buffer[self.head:], self.buffer[:self.head]]
+
+    def _ordered(self) -> np.ndarray:
+        segments = self._segments()
+        return segments[0] if len(segments) == 1 else np.concatenate(segments)
+
+    def _segment_files(self) -> list[Path]:
+        return sorted(self.spill_dir.glob('detections_*.npy'))
+
+    @staticmethod
+    def _segment_bounds(path: Path) -> tuple[float, float]:
+        _, first, last = path.stem.split('_')
+        return float(first) / 1000.0, float(last) / 1000.0
+
+    def flush(self) -> int:
+        """Write the rows not yet in a full spilled segment, synchronously (on shutdown).
+
+        Returns the number of rows written; without it a restart loses up to segment_size rows.
+        """
+        if not self.spill_dir:
+            return 0
+        with self._lock:
+            count, self._unspilled = min(self._unspilled, self.size), 0
+            rows = self._ordered()[-count:].copy() if count else None
+        if rows is not None:
+            self._write_segment(rows)
+        return count
+
+    def _write_segment(self, rows: np.ndarray) -> None:
+        try:
+            first = int(rows['timestamp'][0] * 1000)
+            last = int(rows['timestamp'][-1] * 1000)
+            np.save(self.spill_dir / f'detections_{first:013d}_{last:013d}.npy', rows)
+            self.stats['segments_spilled'] += 1
+            files = self._segment_files()
+            total = sum(f.stat().st_size for f in files)
+            while files and total > self.max_disk_bytes:
+                oldest = files.pop(0)
+                total -= oldest.stat().st_size
+                oldest.unlink()
+        except Exception as e:
+            self.stats['spill_errors'] += 1
+            logger.warning(f"Detection history spill failed: {e}")
+
+    def _spill(self, rows: np.ndarray) -> None:
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self._write_segment, rows)
+        except RuntimeError:
+            self._write_segment(rows)
+
+    def _query_spilled(self, lo: float, hi: float, batch: str | None, transitions_only: bool,
+                       limit: int) -> list[np.ndarray]:
+        """Matching spilled rows, oldest first; reads newest segments first and stops at limit (0 = all)."""
+        parts = []
+        found = 0
+        for path in reversed(self._segment_files()):
+            try:
+                first, last = self._segment_bounds(path)
+                if last < lo or first > hi:
+                    continue
+                rows = np.load(path)
+            except Exception:
+                continue
+            ts = rows['timestamp']
+            start = int(np.searchsorted(ts, lo, side='left'))
+            end = int(np.searchsorted(ts, hi, side='left'))
+            if end > start:
+                rows = self._filter(rows[start:end], batch, transitions_only)
+                parts.insert(0, rows)
+                found += len(rows)
+                if limit and found >= limit:
+                    break
+        return parts
+
+    def _load_spilled_tail(self) -> None:
+        """Refill the ring from the newest spilled segments after a restart."""
+        loaded = []
+        total = 0
+        for path in reversed(self._segment_files()):
+            if total >= self.capacity:
+                break
+            try:
+                rows = np.load(path)
+            except Exception:
+                continue
+            loaded.insert(0, rows)
+            total += len(rows)
+            self.stats['segments_loaded'] += 1
+        if not loaded:
+            return
+        rows = np.concatenate(loaded)[-self.capacity:]
+        self.buffer[:len(rows)] = rows
+        self.size = len(rows)
+        self.head = self.size % self.capacity
+        self._last_ts = float(rows['timestamp'][-1])
+        logger.info(f"Detection history restored {self.size} rows from {self.spill_dir}")
+
+
+# Created in main() once --history-* options are known (None = disabled).
+detection_history: DetectionHistory | None = None
+
+
+class ClipRecorder:
+    """Pre/post-roll clips around trigger transitions, built from already-encoded preview JPEGs.
+
+    The hot path only appends (timestamp, jpeg) references to a deque capped by age and
+    bytes; no extra encoding happens there. On a transition the pre-roll is snapshotted,
+    post-roll frames are collected as they arrive, and the finished clip is handed to a
+    worker thread through a bounded queue (dropped if full) that writes an MJPG .avi plus a
+    .json sidecar and enforces the disk quota.
+    """
+
+    def __init__(self, out_dir: str, pre_s: float = 5.0, post_s: float = 3.0, fps: float = 5.0,
+                 buffer_mb: float = 32.0, max_disk_mb: float = 500.0, machine_id: str | None = None):
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.pre_s = max(0.0, float(pre_s))
+        self.post_s = max(0.0, float(post_s))
+        self.fps = max(0.5, float(fps))
+        self.min_interval = 1.0 / self.fps
+        self.buffer_bytes = int(max(1.0, float(buffer_mb)) * 1024 * 1024)
+        self.max_disk_bytes = int(max(1.0, float(max_disk_mb)) * 1024 * 1024)
+        self.machine_id = machine_id or 'machine'
+        self._ring = collections.deque()
+        self._ring_bytes = 0
+        self._last_added = float('-inf')
+        self._pending: list[dict] = []
+        self._jobs: Queue = Queue(maxsize=4)
+        self.stats = {'clips_written': 0, 'clips_dropped': 0, 'write_errors': 0, 'frames_buffered': 0, 'buffer_bytes': 0}
+        self._worker = threading.Thread(target=self._writer_loop, name='clip-writer', daemon=True)
+        self._worker.start()
+
+    def add_frame(self, jpeg: bytes, ts: float) -> None:
+        """Event loop thread only; O(1) apart from trimming expired frames."""
+        if ts - self._last_added < self.min_interval:
+            return
+        self._last_added = ts
+        self._ring.append((ts, jpeg))
+        self._ring_bytes += len(jpeg)
+        while self._ring and (ts - self._ring[0][0] > self.pre_s or self._ring_bytes > self.buffer_bytes):
+            _, old = self._ring.popleft()
+            self._ring_bytes -= len(old)
+        self.stats['frames_buffered'] = len(self._ring)
+        self.stats['buffer_bytes'] = self._ring_bytes
+
+        if not self._pending:
+            return
+        still_pending = []
+        for clip in self._pending:
+            clip['frames'].append((ts, jpeg))
+            if ts >= clip['until']:
+                self._submit(clip)
+            else:
+                still_pending.append(clip)
+        self._pending = still_pending
+
+    def trigger(self, event: dict, batch: str | None) -> None:
+        """Start a clip for a trigger transition (event loop thread only)."""
+        ts = float(event.get('capture_timestamp') or time.time())
+        if len(self._pending) >= self._jobs.maxsize:
+            self.stats['clips_dropped'] += 1
+            return
+        clip = {
+            'frames': list(self._ring),
+            'until': ts + self.post_s,
+            'meta': {
+                'machine_id': self.machine_id,
+                'batch': batch,
+                'trigger_timestamp': ts,
+                'has_detection': bool(event.get('has_detection')),
+                'count': event.get('count', 0),
+                'zone_mask': event.get('zone_mask', 0),
+                'frame_id': event.get('frame_id'),
+            },
+        }
+        if self.post_s <= 0:
+            self._submit(clip)
+        else:
+            self._pending.append(clip)
+
+    def _submit(self, clip: dict) -> None:
+        try:
+            self._jobs.put_nowait(clip)
+        except Full:
+            self.stats['clips_dropped'] += 1
+
+    def _clip_name(self, meta: dict) -> str:
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(meta['trigger_timestamp']))
+        ms = int((meta['trigger_timestamp'] % 1) * 1000)
+        batch = ''.join(c if c.isalnum() or c in '-_' else '_' for c in str(meta.get('batch') or 'nobatch'))
+        edge = 'on' if meta['has_detection'] else 'off'
+        return f"{self.machine_id}_{batch}_{stamp}-{ms:03d}_{edge}"
+
+    def _writer_loop(self) -> None:
+        while True:
+            try:
+                clip = self._jobs.get(timeout=1.0)
+            except Empty:
+                continue
+            try:
+                self._write_clip(clip)
+                self.stats['clips_written'] += 1
+                self._enforce_quota()
+            except Exception as e:
+                self.stats['write_errors'] += 1
+                logger.warning(f"Clip write failed: {e}")
+
+    def _write_clip(self, clip: dict) -> None:
+        frames = clip['frames']
+        if not frames:
+            return
+        name = self._clip_name(clip['meta'])
+        video_path = self.out_dir / f"{name}.avi"
+        writer = None
+        size = None
+        try:
+            for _, jpeg in frames:
+                img = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if img is None:
+                    continue
+                if writer is None:
+                    size = (img.shape[1], img.shape[0])
+                    writer = cv2.VideoWriter(str(video_path), cv2.VideoWriter_fourcc(*'MJPG'), self.fps, size)
+                elif (img.shape[1], img.shape[0]) != size:
+                    img = cv2.resize(img, size)
+                writer.write(img)
+        finally:
+            if writer is not None:
+                writer.release()
+        meta = dict(clip['meta'], start_timestamp=frames[0][0], end_timestamp=frames[-1][0],
+                    frames=len(frames), fps=self.fps, video=video_path.name)
+        (self.out_dir / f"{name}.json").write_text(json.dumps(meta, indent=2))
+        logger.info(f"🎞️ Saved trigger clip {video_path.name} ({len(frames)} frames)")
+
+    def _enforce_quota(self) -> None:
+        files = sorted(
+            (p for p in self.out_dir.iterdir() if p.suffix in ('.avi', '.json')),
+            key=lambda p: p.stat().st_mtime,
+        )
+        total = sum(p.stat().st_size for p in files)
+        while files and total > self.max_disk_bytes:
+            oldest = files.pop(0)
+            total -= oldest.stat().st_size
+            oldest.unlink(missing_ok=True)
+
+    def snapshot(self) -> dict:
+        return dict(self.stats, pending=len(self._pending), queued=self._jobs.qsize(), out_dir=str(self.out_dir))
+
+
+# Created in main() when --clip-dir is set (None = disabled).
+clip_recorder: ClipRecorder | None = None
+
+
+class HardExampleHarvester:
+    """Opt-in sampler of frames worth relabelling for the next training round.
+
+    A frame qualifies when a detection's confidence sits just above --conf (within band)
+    or when the trigger flips back within flicker_s of its previous transition. Selected
+    frames go through a bounded queue to a worker thread that writes YOLO-format
+    images/<name>.jpg + labels/<name>.txt pairs (model predictions as draft labels).
+    A full queue drops the harvest; inference is never blocked.
+    """
+
+    def __init__(self, out_dir: str, conf: float, band: float = 0.1, flicker_s: float = 2.0,
+                 min_interval_s: float = 5.0, max_disk_mb: float = 1000.0, queue_size: int = 8):
+        self.out_dir = Path(out_dir)
+        self.images_dir = self.out_dir / 'images'
+        self.labels_dir = self.out_dir / 'labels'
+        self.images_dir.mkdir(parents=True, exist_ok=True)
+        self.labels_dir.mkdir(parents=True, exist_ok=True)
+        self.band = max(0.0, float(band))
+        self.set_conf(conf)
+        self.flicker_s = max(0.0, float(flicker_s))
+        self.min_interval_s = max(0.0, float(min_interval_s))
+        self.max_disk_bytes = int(max(1.0, float(max_disk_mb)) * 1024 * 1024)
+        self._last_harvest = float('-inf')
+        self._last_transition = float('-inf')
+        self._jobs: Queue = Queue(maxsize=max(1, int(queue_size)))
+        self._disk_bytes = None
+        self.stats = {'harvested': 0, 'uncertain': 0, 'flicker': 0, 'dropped_queue_full': 0, 'rate_limited': 0, 'write_errors': 0}
+        self._worker = threading.Thread(target=self._writer_loop, name='harvest-writer', daemon=True)
+        self._worker.start()
+
+    def set_conf(self, conf: float) -> None:
+        """Follow the detection threshold (startup and runtime config updates)."""
+        self.conf_lo = float(conf)
+        self.conf_hi = float(conf) + self.band
+
+    def consider(self, frame, dets: list, capture_ts: float, transitioned: bool) -> None:
+        """Cheap per-frame check on the event loop thread; never blocks."""
+        reason = None
+        if transitioned:
+            if capture_ts - self._last_transition <= self.flicker_s:
+                reason = 'flicker'
+            self._last_transition = capture_ts
+        if reason is None:
+            for d in dets:
+                if self.conf_lo <= float(d.get('conf', 0.0)) < self.conf_hi:
+                    reason = 'uncertain'
+                    break
+        if reason is None:
+            return
+        if capture_ts - self._last_harvest < self.min_interval_s:
+            self.stats['rate_limited'] += 1
+            return
+        try:
+            # Camera frames come from a recycled pool; keep a private copy for the writer thread.
+            self._jobs.put_nowait((frame.copy(), list(dets), capture_ts, reason))
+        except Full:
+            self.stats['dropped_queue_full'] += 1
+            return
+        self._last_harvest = capture_ts
+        self.stats[reason] += 1
+
+    def _writer_loop(self) -> None:
+        while True:
+            try:
+                frame, dets, capture_ts, reason = self._jobs.get(timeout=1.0)
+            except Empty:
+                continue
+            try:
+                self._write_example(frame, dets, capture_ts, reason)
+                self.stats['harvested'] += 1
+            except Exception as e:
+                self.stats['write_errors'] += 1
+                logger.warning(f"Hard-example write failed: {e}")
+
+    def _write_example(self, frame, dets: list, capture_ts: float, reason: str) -> None:
+        h, w = frame.shape[:2]
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(capture_ts))
+        name = f"{stamp}-{int((capture_ts % 1) * 1000):03d}_{reason}"
+        lines = []
+        for d in dets:
+            xyxy = _normalize_xyxy(d.get('xyxy'))
+            if xyxy is None or w <= 0 or h <= 0:
+                continue
+            x1, y1, x2, y2 = (max(0.0, min(v, lim)) for v, lim in zip(xyxy, (w, h, w, h)))
+            lines.append(
+                f"{int(d.get('cls', 0))} {(x1 + x2) / 2 / w:.6f} {(y1 + y2) / 2 / h:.6f} "
+                f"{(x2 - x1) / w:.6f} {(y2 - y1) / h:.6f}"
+            )
+        image_path = self.images_dir / f"{name}.jpg"
+        label_path = self.labels_dir / f"{name}.txt"
+        if not cv2.imwrite(str(image_path), frame, [cv2.IMWRITE_JPEG_QUALITY, 95]):
+            raise RuntimeError(f"cv2.imwrite failed for {image_path}")
+        label_path.write_text('\n'.join(lines) + ('\n' if lines else ''))
+        self._enforce_quota(image_path.stat().st_size + label_path.stat().st_size)
+
+    def _enforce_quota(self, added: int) -> None:
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(p.stat().st_size for p in self.images_dir.iterdir()) + sum(
+                p.stat().st_size for p in self.labels_dir.iterdir())
+        else:
+            self._disk_bytes += added
+        if self._disk_bytes <= self.max_disk_bytes:
+            return
+        for image in sorted(self.images_dir.glob('*.jpg'), key=lambda p: p.stat().st_mtime):
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            label = self.labels_dir / f"{image.stem}.txt"
+            for path in (image, label):
+                if path.exists():
+                    self._disk_bytes -= path.stat().st_size
+                    path.unlink(missing_ok=True)
+
+    def snapshot(self) -> dict:
+        return dict(self.stats, queued=self._jobs.qsize(), disk_bytes=self._disk_bytes,
+                    conf_band=[self.conf_lo, self.conf_hi], out_dir=str(self.out_dir))
+
+
+# Created in main() when --harvest-dir is set (None = disabled).
+hard_example_harvester: HardExampleHarvester | None = None
+
+
+class LatestBroadcast:
+    """Latest-value fan-out: publish() never blocks and each waiter only sees the newest value.
+
+    Slow consumers skip intermediate values instead of buffering them.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.value = None
+        self.subscribers = 0
+        self._waiter = asyncio.Event()
+
+    def publish(self, value) -> None:
+        self.value = value
+        self.version += 1
+        waiter, self._waiter = self._waiter, asyncio.Event()
+        waiter.set()
+
+    async def wait_newer(self, version: int):
+        """Wait until a value newer than version is published; return (version, value)."""
+        while self.version <= version:
+            await self._waiter.wait()
+        return self.version, self.value
+
+
+# Latest MJPEG multipart chunk, built once per new frame and shared by every /mjpeg client.
+mjpeg_frames = LatestBroadcast()
+
+
+def _mjpeg_chunk(jpeg: bytes) -> bytes:
+    return (
+        f'--{MJPEG_BOUNDARY}\r\n'
+        'Content-Type: image/jpeg\r\n'
+        f'Content-Length: {len(jpeg)}\r\n\r\n'
+    ).encode('ascii') + jpeg + b'\r\n'
+
+
+def _set_latest_frame_jpeg(jpeg: bytes) -> None:
+    """Store the newest preview JPEG and wake MJPEG subscribers (event loop thread only)."""
+    global latest_frame_jpeg
+    latest_frame_jpeg = jpeg
+    if clip_recorder is not None:
+        clip_recorder.add_frame(jpeg, time.time())
+    if mjpeg_frames.subscribers > 0:
+        mjpeg_frames.publish(_mjpeg_chunk(jpeg))
+
+
+# Per-frame detection metadata streamed to /ws subscribers (compact JSON, built once per frame).
+detection_metadata = LatestBroadcast()
+
+
+def _publish_detection_metadata(frame_id, capture_ts, width: int, height: int, dets: list, zone_mask: int, state: bool,
+                                config_version: int = 0) -> None:
+    if detection_metadata.subscribers <= 0:
+        return
+    boxes = []
+    for d in dets:
+        xyxy = _normalize_xyxy(d.get('xyxy'))
+        if xyxy is None:
+            continue
+        boxes.append([
+            int(round(xyxy[0])), int(round(xyxy[1])), int(round(xyxy[2])), int(round(xyxy[3])),
+            int(d.get('cls', -1)),
+            int(round(float(d.get('conf', 0.0)) * 100)),
+        ])
+    detection_metadata.publish(json.dumps({
+        'type': 'det',
+        'f': frame_id,
+        't': int((capture_ts or time.time()) * 1000),
+        'w': width,
+        'h': height,
+        'z': int(zone_mask),
+        's': 1 if state else 0,
+        'cv': config_version,
+        'd': boxes,
+    }, separators=(',', ':')))
+
+
 async def _enqueue_detection_state_if_changed(
     dets: list,
     width: int,
     height: int,
     frame_id: int | None,
-    queue: Queue | None,
+    queue: DetectionEventChannel | None,
+    capture_ts: float | None = None,
+    frame=None,
+    config: RuntimeConfig | None = None,
 ) -> None:
-    """Emit one event only when trigger state changes (0->1 or 1->0)."""
-    global last_has_detection, detection_on_streak, detection_off_streak
+    """Emit one event only when trigger state changes (0->1 or 1->0).
 
+    With --trigger-zones every zone debounces on its own and emits its own events.
+    config is the RuntimeConfig the caller read for this frame.
+    """
     if queue is None:
         return
+    cfg = config or runtime_config
+
+    if trigger_zones is not None:
+        async with detection_state_lock:
+            zone_changes = trigger_zones.update(dets, width, height)
+            zone_mask = trigger_zones.state_mask
+        trigger_count = int(trigger_zones.last_counts.sum())
+        active_mask = int(sum(1 << i for i, c in enumerate(trigger_zones.last_counts) if c))
+        transitioned = bool(zone_changes)
+        state_now = bool(zone_mask)
+    else:
+        trigger_dets = _filter_trigger_detections(dets, width, height, cfg)
+        stable_frames = cfg.trigger_stable_frames if cfg.line_trigger_enabled else 1
+
+        async with detection_state_lock:
+            transitioned = trigger_debouncer.update(bool(trigger_dets), stable_frames)
+            state_now = trigger_debouncer.state
+        trigger_count = len(trigger_dets)
+        active_mask = 1 if trigger_dets else 0
+        zone_mask = 1 if state_now else 0
+
+    now = time.time()
+    if latency_governor is not None:
+        latency_governor.observe_frame(capture_ts)
+    _publish_detection_metadata(frame_id, capture_ts, width, height, dets, active_mask, state_now, cfg.version)
+    if detection_history is not None:
+        detection_history.append(
+            timestamp=capture_ts if capture_ts is not None else now,
+            frame_id=frame_id,
+            batch=_last_batch_cache.get(getattr(args, 'machine_id', None)),
+            dets=dets,
+            trigger_count=trigger_count,
+            state=state_now,
+            transition=transitioned,
+        )
+    if hard_example_harvester is not None and frame is not None:
+        hard_example_harvester.consider(frame, dets, capture_ts if capture_ts is not None else now, transitioned)
+    if not transitioned:
+        return
 
-    trigger_dets = _filter_trigger_detections(dets, width, height)
-    has_detection = bool(trigger_dets)
-    stable_frames = (
-        max(1, int(getattr(args, 'trigger_stable_frames', 3)))
-        if getattr(args, 'line_trigger_enabled', False)
-        else 1
-    )
-
-    async with detection_state_lock:
-        if has_detection:
-            detection_on_streak += 1
-            detection_off_streak = 0
-        else:
-            detection_off_streak += 1
-            detection_on_streak = 0
-
-        if not last_has_detection and has_detection and detection_on_streak >= stable_frames:
-            last_has_detection = True
-        elif last_has_detection and (not has_detection) and detection_off_streak >= stable_frames:
-            last_has_detection = False
-        else:
-            return
-
-        state_now = last_has_detection
-
-    event = {
-        'timestamp': time.time(),
+    base_event = {
+        'timestamp': now,
+        'capture_timestamp': capture_ts if capture_ts is not None else now,
         'frame_id': frame_id,
         'width': width,
         'height': height,
-        'detections': trigger_dets if state_now else [],
-        'count': len(trigger_dets) if state_now else 0,
-        'has_detection': state_now,
-        'line_trigger_enabled': bool(getattr(args, 'line_trigger_enabled', False)),
+        'zone_mask': zone_mask,
+        'line_trigger_enabled': cfg.line_trigger_enabled,
+        'config_version': cfg.version,
         'machine_id': getattr(args, 'machine_id', None)
     }
-    try:
+    if trigger_zones is None:
+        events = [dict(
+            base_event,
+            detections=trigger_dets if state_now else [],
+            count=trigger_count if state_now else 0,
+            has_detection=state_now,
+        )]
+    else:
+        events = []
+        for zone, zone_state, count in zone_changes:
+            zone_dets = trigger_zones.zone_detections(zone, dets, width, height) if zone_state else []
+            events.append(dict(
+                base_event,
+                detections=zone_dets,
+                count=count if zone_state else 0,
+                has_detection=zone_state,
+                zone=zone['name'],
+                zone_index=zone['index'],
+                zone_topic=zone['topic'],
+            ))
+    batch = _last_batch_cache.get(getattr(args, 'machine_id', None))
+    for event in events:
         queue.put_nowait(event)
-    except Exception:
-        # queue full, drop event to avoid blocking
-        pass
+        if clip_recorder is not None:
+            clip_recorder.trigger(event, batch)
 
 
-def _run_model_inference(frame, conf_threshold: float, imgsz: int):
-    """Run inference with safe sizing behavior for fixed-shape ONNX exports."""
-    if model_is_onnx:
+def _run_model_inference(frame, conf_threshold: float, imgsz: int, model_instance=None, is_onnx: bool | None = None):
+    """Run inference with safe sizing behavior for fixed-shape ONNX exports.
+
+    Callers that must not see a model swap mid-frame pass the model (and its ONNX flag)
+    they read once for that frame.
+    """
+    model_instance = model if model_instance is None else model_instance
+    is_onnx = model_is_onnx if is_onnx is None else is_onnx
+    if is_onnx:
         # Many ONNX exports are fixed-size (commonly 640x640).
         # Let Ultralytics use model-native sizing instead of forcing --imgsz.
-        return model(frame, conf=conf_threshold, verbose=False)
-    return model(frame, conf=conf_threshold, imgsz=imgsz, verbose=False)
+        return model_instance(frame, conf=conf_threshold, verbose=False)
+    return model_instance(frame, conf=conf_threshold, imgsz=imgsz, verbose=False)
 
 
 def _is_ncnn_export_path(path: str) -> bool:
@@ -320,109 +1453,106 @@ def _is_ncnn_export_path(path: str) -> bool:
     return p.is_dir() and (p / "model.ncnn.param").exists() and (p / "model.ncnn.bin").exists()
 
 
-def _normalize_xyxy(xyxy) -> list[float] | None:
-    """Normalize YOLO bbox output into [x1, y1, x2, y2]."""
-    try:
-        if xyxy is None:
-            return None
-        # Common Ultralytics shape is [[x1, y1, x2, y2]]
-        if isinstance(xyxy, list) and len(xyxy) == 1 and isinstance(xyxy[0], list):
-            xyxy = xyxy[0]
-        if not isinstance(xyxy, list) or len(xyxy) < 4:
-            return None
-        return [float(xyxy[0]), float(xyxy[1]), float(xyxy[2]), float(xyxy[3])]
-    except Exception:
-        return None
+def _load_model(path: str):
+    """Load a .pt / .onnx / NCNN model; returns (model, is_onnx, is_ncnn)."""
+    is_ncnn = _is_ncnn_export_path(path)
+    loaded = YOLO(path, task='detect') if is_ncnn else YOLO(path)
+    return loaded, path.lower().endswith('.onnx'), is_ncnn
 
 
-def _filter_trigger_detections(dets: list, width: int, height: int) -> list:
+def _filter_trigger_detections(dets: list, width: int, height: int, config: RuntimeConfig | None = None) -> list:
     """Return detections that are considered trigger-active under current mode."""
-    if not getattr(args, 'line_trigger_enabled', False):
-        return dets
-
-    if width <= 0 or height <= 0:
-        return []
-
-    trigger_line_y = float(getattr(args, 'trigger_line_y', 0.55))
-    trigger_line_y = max(0.0, min(1.0, trigger_line_y))
-    line_y_px = trigger_line_y * float(height)
-    side = getattr(args, 'after_line_side', 'top')
-    cls_filter = getattr(args, 'trigger_class', None)
-    min_conf = getattr(args, 'trigger_min_conf', None)
-    if min_conf is None:
-        min_conf = float(getattr(args, 'conf', 0.5))
+    cfg = config or runtime_config
+    return filter_trigger_detections(
+        dets,
+        width,
+        height,
+        line_trigger_enabled=cfg.line_trigger_enabled,
+        line_y=cfg.trigger_line_y,
+        side=cfg.after_line_side,
+        cls_filter=cfg.trigger_class,
+        min_conf=cfg.trigger_conf,
+    )
 
-    filtered = []
-    for d in dets:
-        try:
-            conf = float(d.get('conf', 0.0))
-            cls_id = int(d.get('cls', -1))
-            xyxy = _normalize_xyxy(d.get('xyxy'))
-            if conf < min_conf:
-                continue
-            if cls_filter is not None and cls_id != int(cls_filter):
-                continue
-            if xyxy is None:
-                continue
-            y_center = (float(xyxy[1]) + float(xyxy[3])) / 2.0
-            in_after_line = y_center <= line_y_px if side == 'top' else y_center >= line_y_px
-            if in_after_line:
-                filtered.append(d)
-        except Exception:
-            continue
 
-    return filtered
+def _server_annotation_enabled() -> bool:
+    """True when boxes are burned into frames on the Pi (vs. drawn by clients from /ws)."""
+    return getattr(args, 'annotate', 'server') == 'server'
 
 
-def _draw_trigger_overlay(frame_bgr, dets: list | None = None) -> None:
-    """Draw horizontal trigger line and status label on the annotated frame."""
-    if not getattr(args, 'line_trigger_enabled', False):
-        return
+def _draw_trigger_overlay(frame_bgr, dets: list | None = None, config: RuntimeConfig | None = None) -> None:
+    """Draw the trigger zones, or the trigger line and its status label, on the annotated frame."""
     if frame_bgr is None or not hasattr(frame_bgr, 'shape'):
         return
-
-    h, w = frame_bgr.shape[:2]
-    if h <= 0 or w <= 0:
+    cfg = config or runtime_config
+    if trigger_zones is not None:
+        h, w = frame_bgr.shape[:2]
+        trigger_zones.draw(frame_bgr, trigger_zones.active_mask(dets or [], w, h))
+        return
+    if not cfg.line_trigger_enabled:
         return
 
-    trigger_line_y = float(getattr(args, 'trigger_line_y', 0.55))
-    trigger_line_y = max(0.0, min(1.0, trigger_line_y))
-    y = int(trigger_line_y * h)
-
+    h, w = frame_bgr.shape[:2]
     active = False
     if dets is not None:
         try:
-            active = bool(_filter_trigger_detections(dets, w, h))
+            active = bool(_filter_trigger_detections(dets, w, h, cfg))
         except Exception:
             active = False
+    draw_trigger_line(frame_bgr, cfg.trigger_line_y, cfg.after_line_side, active)
 
-    # Green when clear, red when trigger zone occupied.
-    color = (0, 0, 255) if active else (0, 255, 0)
-    cv2.line(frame_bgr, (0, y), (w - 1, y), color, 2)
-
-    side = getattr(args, 'after_line_side', 'top')
-    label = f"TRIGGER LINE y={trigger_line_y:.2f} side={side} {'ACTIVE' if active else 'CLEAR'}"
-    label_y = y - 8 if y > 24 else y + 20
-    cv2.putText(
-        frame_bgr,
-        label,
-        (10, label_y),
-        cv2.FONT_HERSHEY_SIMPLEX,
-        0.6,
-        color,
-        2,
-    )
+
+def _set_v4l2_flip(index: int, flip_mode: str) -> bool:
+    """Ask the camera driver to flip in hardware (v4l2-ctl); False when unsupported."""
+    if os.name == 'nt' or shutil.which('v4l2-ctl') is None:
+        return False
+    hflip = 1 if flip_mode in ('horizontal', '180') else 0
+    vflip = 1 if flip_mode in ('vertical', '180') else 0
+    device = f'/dev/video{index}'
+    try:
+        result = subprocess.run(
+            ['v4l2-ctl', '-d', device, '--set-ctrl', f'horizontal_flip={hflip},vertical_flip={vflip}'],
+            capture_output=True, text=True, timeout=2,
+        )
+        if result.returncode != 0:
+            return False
+        check = subprocess.run(
+            ['v4l2-ctl', '-d', device, '--get-ctrl', 'horizontal_flip,vertical_flip'],
+            capture_output=True, text=True, timeout=2,
+        )
+        return check.returncode == 0 and f'horizontal_flip: {hflip}' in check.stdout and f'vertical_flip: {vflip}' in check.stdout
+    except Exception:
+        return False
 
 
 class SharedCamera:
-    """Singleton camera instance shared across all video tracks."""
+    """Singleton camera instance shared across all video tracks.
+
+    When the last reference is released the device lingers for --camera-linger seconds,
+    draining frames at a low rate, so the next viewer or `start` skips the slow V4L2 open.
+    """
     _instance = None
     _lock = asyncio.Lock()
+    _linger_task = None
+    stats = {
+        'opens': 0,
+        'closes': 0,
+        'warm_reuses': 0,
+        'last_open_ms': None,
+        'last_close_ms': None,
+        'lingering': False,
+    }
     
     def __init__(self, source):
         self.source = source
+        self.loop_file = isinstance(source, str) and os.path.isfile(source)
+        self._io_lock = threading.Lock()
+        # Synthetic / replay sources (load and soak tests) stand in for the capture device.
+        synthetic = open_frame_source(source, int(getattr(args, 'capture_width', 640)), int(getattr(args, 'capture_height', 480)))
         # Open camera with DirectShow on Windows, V4L2 on Linux for better USB camera support
-        if isinstance(source, int):
+        if synthetic is not None:
+            self.cap = synthetic
+        elif isinstance(source, int):
             backend = cv2.CAP_DSHOW if os.name == 'nt' else cv2.CAP_V4L2
             self.cap = cv2.VideoCapture(source, backend)
         else:
@@ -463,56 +1593,811 @@ class SharedCamera:
                 self.desired_height,
             )
         
-        logger.info(f"✅ Shared camera opened: {self.width}x{self.height} @ {self.fps}fps")
+        # Orientation happens once here, so every consumer gets upright frames.
+        # Prefer the driver's flip controls (free); otherwise flip + resize in one pass.
+        self.flip_mode, self.hw_flip, self.preprocessor = self._orientation(runtime_config.flip)
+        self._raw = None
+        
+        flip_how = 'camera controls' if self.hw_flip else ('software' if self.flip_mode != 'none' else 'off')
+        logger.info(f"✅ Shared camera opened: {self.width}x{self.height} @ {self.fps}fps (flip {self.flip_mode}: {flip_how})")
         self.ref_count = 0
     
     @classmethod
     async def get_instance(cls, source):
         """Get or create the singleton camera instance."""
         async with cls._lock:
+            if cls._linger_task is not None:
+                cls._linger_task.cancel()
+                cls._linger_task = None
+                cls.stats['lingering'] = False
+                cls.stats['warm_reuses'] += 1
+                logger.info("📹 Reusing lingering camera (no reopen)")
             if cls._instance is None:
-                cls._instance = SharedCamera(source)
+                start = time.perf_counter()
+                loop = asyncio.get_running_loop()
+                cls._instance = await loop.run_in_executor(None, SharedCamera, source)
+                open_ms = (time.perf_counter() - start) * 1000.0
+                cls.stats['opens'] += 1
+                cls.stats['last_open_ms'] = round(open_ms, 1)
+                logger.info(f"📹 Camera open took {open_ms:.0f} ms")
             cls._instance.ref_count += 1
             logger.info(f"Camera reference count: {cls._instance.ref_count}")
             return cls._instance
     
     @classmethod
-    async def release_instance(cls):
-        """Decrease reference count and release if no more users."""
+    async def release_instance(cls, linger: bool = True):
+        """Decrease reference count; linger (or release) once there are no more users."""
         async with cls._lock:
             if cls._instance:
-                cls._instance.ref_count -= 1
+                cls._instance.ref_count = max(0, cls._instance.ref_count - 1)
                 logger.info(f"Camera reference count: {cls._instance.ref_count}")
-                if cls._instance.ref_count <= 0:
-                    cls._instance.cap.release()
-                    logger.info("📹 Shared camera released")
-                    cls._instance = None
+                if cls._instance.ref_count > 0:
+                    return
+                linger_s = float(getattr(args, 'camera_linger', 0.0)) if linger else 0.0
+                if linger_s > 0:
+                    if cls._linger_task is None:
+                        cls.stats['lingering'] = True
+                        cls._linger_task = asyncio.create_task(cls._linger(cls._instance, linger_s))
+                        logger.info(f"📹 Camera idle; keeping it warm for {linger_s:.0f}s")
+                    return
+                await cls._close_locked()
+
+    @classmethod
+    async def _close_locked(cls):
+        if cls._linger_task is not None and cls._linger_task is not asyncio.current_task():
+            cls._linger_task.cancel()
+        cls._linger_task = None
+        cls.stats['lingering'] = False
+        instance, cls._instance = cls._instance, None
+        if instance is None:
+            return
+        start = time.perf_counter()
+        await asyncio.get_running_loop().run_in_executor(None, instance.close)
+        close_ms = (time.perf_counter() - start) * 1000.0
+        cls.stats['closes'] += 1
+        cls.stats['last_close_ms'] = round(close_ms, 1)
+        logger.info(f"📹 Shared camera released ({close_ms:.0f} ms)")
+
+    @classmethod
+    async def _linger(cls, instance, linger_s: float):
+        """Drain buffered frames at a low rate until someone reuses the camera or linger expires."""
+        interval = 1.0 / max(0.1, float(getattr(args, 'camera_linger_drain_fps', 2.0)))
+        deadline = time.monotonic() + linger_s
+        loop = asyncio.get_running_loop()
+        try:
+            while time.monotonic() < deadline:
+                await loop.run_in_executor(None, instance.grab)
+                await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            return
+        async with cls._lock:
+            if cls._instance is instance and instance.ref_count <= 0 and cls._linger_task is asyncio.current_task():
+                await cls._close_locked()
+
+    @classmethod
+    async def close_now(cls):
+        """Release the device immediately regardless of references (shutdown)."""
+        async with cls._lock:
+            await cls._close_locked()
+
+    def _orientation(self, flip_mode: str):
+        hw_flip = False
+        if isinstance(self.source, int) and getattr(args, 'camera_flip', 'auto') == 'auto':
+            hw_flip = _set_v4l2_flip(self.source, flip_mode) and flip_mode != 'none'
+        preprocessor = FramePreprocessor(
+            'none' if hw_flip else flip_mode,
+            (self.desired_width, self.desired_height) if self.force_resize else None,
+        )
+        return flip_mode, hw_flip, preprocessor
+
+    def set_flip(self, flip_mode: str) -> None:
+        """Change orientation on the open device (runtime config update; blocking)."""
+        # The driver controls and the software preprocessor change under one lock, so no
+        # frame is read with the new hardware flip and the old software one (or vice versa).
+        with self._io_lock:
+            if flip_mode == self.flip_mode:
+                return
+            orientation = self._orientation(flip_mode)
+            if self.hw_flip and not orientation[1] and isinstance(self.source, int):
+                # Falling back to software: make sure the driver is no longer flipping too.
+                _set_v4l2_flip(self.source, 'none')
+            self.flip_mode, self.hw_flip, self.preprocessor = orientation
+            self._raw = None
+        logger.info(f"Camera flip now {flip_mode} ({'camera controls' if self.hw_flip else 'software'})")
+
+    def grab(self):
+        """Discard one frame so the driver queue stays fresh while lingering."""
+        with self._io_lock:
+            return self.cap.grab()
+
+    def close(self):
+        with self._io_lock:
+            self.cap.release()
     
     def read(self):
-        """Thread-safe camera read."""
-        ret, frame = self.cap.read()
-        if not ret:
-            return ret, frame
-        if self.force_resize and frame is not None:
-            frame = cv2.resize(
-                frame,
-                (self.desired_width, self.desired_height),
-                interpolation=cv2.INTER_AREA,
+        """Thread-safe camera read returning an oriented frame at capture size."""
+        with self._io_lock:
+            passthrough = self.preprocessor.passthrough
+            # The raw capture buffer is reused and never handed out; consumers get pooled outputs.
+            ret, raw = self.cap.read() if passthrough else self.cap.read(self._raw)
+            if (not ret or raw is None) and self.loop_file:
+                # Video-file sources (soak / load tests) restart instead of ending the stream.
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ret, raw = self.cap.read() if passthrough else self.cap.read(self._raw)
+            if passthrough:
+                return ret, raw
+            self._raw = raw
+            if not ret or raw is None:
+                return ret, None
+            return ret, self.preprocessor.process(raw)
+
+
+class DetectionCascade:
+    """Two-stage detection: a cheap pass on every frame, a precise pass only where needed.
+
+    Stage 1 runs at stage1_imgsz (or on a separate small model) with a low candidate
+    threshold, and frames without candidates stop there. Candidates near the final
+    threshold or inside the trigger region are re-checked by stage 2 at the normal imgsz,
+    on a padded crop around them (the whole frame when the crop would cover most of it).
+    Confident stage-1 boxes outside that crop are kept as they are. The merged boxes come
+    back as an Ultralytics Results list, so rendering and the trigger path are unchanged.
+    Runs on the trigger executor thread.
+    """
+
+    def __init__(self, stage1_imgsz: int = 192, candidate_conf: float = 0.15, margin: float = 0.15,
+                 stage1_model=None, stage1_onnx: bool = False, crop_pad: float = 0.5, max_crop_fraction: float = 0.5):
+        self.stage1_imgsz = int(stage1_imgsz)
+        self.candidate_conf = float(candidate_conf)
+        self.margin = float(margin)
+        self.stage1_model = stage1_model
+        self.stage1_onnx = bool(stage1_onnx)
+        self.crop_pad = float(crop_pad)
+        self.max_crop_fraction = float(max_crop_fraction)
+        self.stats = {
+            'frames': 0,
+            'clear_frames': 0,
+            'stage1_only_frames': 0,
+            'crop_runs': 0,
+            'full_frame_runs': 0,
+            'escalated_near_threshold': 0,
+            'escalated_trigger_region': 0,
+            'stage1_ms_avg': 0.0,
+            'stage2_ms_avg': 0.0,
+        }
+
+    @staticmethod
+    def _boxes(result) -> np.ndarray:
+        """(N, 6) float32 rows of x1, y1, x2, y2, conf, cls."""
+        data = getattr(result.boxes, 'data', None)
+        if data is None or len(data) == 0:
+            return np.zeros((0, 6), dtype=np.float32)
+        data = data.cpu().numpy() if hasattr(data, 'cpu') else np.asarray(data)
+        return data[:, :6].astype(np.float32)
+
+    @staticmethod
+    def _results(frame, boxes: np.ndarray, names):
+        from ultralytics.engine.results import Results
+
+        return [Results(frame, path='', names=names, boxes=boxes)]
+
+    @staticmethod
+    def _in_trigger_region(boxes: np.ndarray, width: int, height: int, cfg: RuntimeConfig) -> np.ndarray:
+        cx = np.clip(((boxes[:, 0] + boxes[:, 2]) * 0.5).astype(np.int32), 0, width - 1)
+        cy = np.clip(((boxes[:, 1] + boxes[:, 3]) * 0.5).astype(np.int32), 0, height - 1)
+        if trigger_zones is not None:
+            return trigger_zones.mask(width, height)[cy, cx] != 0
+        if not cfg.line_trigger_enabled:
+            # No trigger region configured: the whole frame counts.
+            return np.ones(len(boxes), dtype=bool)
+        return np.array([
+            bool(filter_trigger_detections(
+                [{'conf': 1.0, 'cls': int(b[5]), 'xyxy': b[:4].tolist()}],
+                width,
+                height,
+                line_trigger_enabled=True,
+                line_y=cfg.trigger_line_y,
+                side=cfg.after_line_side,
+                cls_filter=cfg.trigger_class,
+                min_conf=0.0,
+            ))
+            for b in boxes
+        ], dtype=bool)
+
+    def _crop(self, boxes: np.ndarray, width: int, height: int, imgsz: int) -> tuple[int, int, int, int] | None:
+        """Padded window around boxes (at least imgsz square), or None when most of the frame."""
+        x1, y1 = boxes[:, 0].min(), boxes[:, 1].min()
+        x2, y2 = boxes[:, 2].max(), boxes[:, 3].max()
+        pad_x = max((x2 - x1) * self.crop_pad, (imgsz - (x2 - x1)) / 2.0, 0.0)
+        pad_y = max((y2 - y1) * self.crop_pad, (imgsz - (y2 - y1)) / 2.0, 0.0)
+        x1, x2 = int(max(0, x1 - pad_x)), int(min(width, x2 + pad_x))
+        y1, y2 = int(max(0, y1 - pad_y)), int(min(height, y2 + pad_y))
+        if (x2 - x1) * (y2 - y1) > self.max_crop_fraction * width * height:
+            return None
+        return x1, y1, x2, y2
+
+    def run(self, frame, cfg: RuntimeConfig, imgsz: int, stage2_model, stage2_onnx: bool):
+        height, width = frame.shape[:2]
+        names = getattr(stage2_model, 'names', None)
+        stats = self.stats
+        stats['frames'] += 1
+
+        t0 = time.perf_counter()
+        stage1_model = self.stage1_model if self.stage1_model is not None else stage2_model
+        stage1_onnx = self.stage1_onnx if self.stage1_model is not None else stage2_onnx
+        first = self._boxes(_run_model_inference(frame, self.candidate_conf, self.stage1_imgsz, stage1_model, stage1_onnx)[0])
+        stats['stage1_ms_avg'] = round(0.9 * stats['stage1_ms_avg'] + 0.1 * (time.perf_counter() - t0) * 1000.0, 2)
+        if not len(first):
+            stats['clear_frames'] += 1
+            return self._results(frame, first, names)
+
+        near = first[:, 4] < cfg.conf + self.margin
+        region = self._in_trigger_region(first, width, height, cfg)
+        escalate = near | region
+        accepted = first[~escalate & (first[:, 4] >= cfg.conf)]
+        if not escalate.any():
+            stats['stage1_only_frames'] += 1
+            return self._results(frame, accepted, names)
+        stats['escalated_near_threshold'] += int(near.any())
+        stats['escalated_trigger_region'] += int(region.any())
+
+        t1 = time.perf_counter()
+        crop = self._crop(first[escalate], width, height, imgsz)
+        if crop is None:
+            stats['full_frame_runs'] += 1
+            merged = self._boxes(_run_model_inference(frame, cfg.conf, imgsz, stage2_model, stage2_onnx)[0])
+        else:
+            stats['crop_runs'] += 1
+            x1, y1, x2, y2 = crop
+            second = self._boxes(_run_model_inference(frame[y1:y2, x1:x2], cfg.conf, imgsz, stage2_model, stage2_onnx)[0])
+            second[:, [0, 2]] += x1
+            second[:, [1, 3]] += y1
+            cx = (accepted[:, 0] + accepted[:, 2]) * 0.5
+            cy = (accepted[:, 1] + accepted[:, 3]) * 0.5
+            outside = (cx < x1) | (cx >= x2) | (cy < y1) | (cy >= y2)
+            merged = np.concatenate([second, accepted[outside]])
+        stats['stage2_ms_avg'] = round(0.9 * stats['stage2_ms_avg'] + 0.1 * (time.perf_counter() - t1) * 1000.0, 2)
+        return self._results(frame, merged, names)
+
+    def snapshot(self) -> dict:
+        frames = max(1, self.stats['frames'])
+        stage2 = self.stats['crop_runs'] + self.stats['full_frame_runs']
+        return {
+            **self.stats,
+            'stage1_imgsz': self.stage1_imgsz,
+            'candidate_conf': self.candidate_conf,
+            'separate_stage1_model': self.stage1_model is not None,
+            'clear_rate': round(self.stats['clear_frames'] / frames, 3),
+            'stage1_only_rate': round(self.stats['stage1_only_frames'] / frames, 3),
+            'stage2_rate': round(stage2 / frames, 3),
+        }
+
+
+# Set in main() with --cascade.
+detection_cascade: DetectionCascade | None = None
+
+
+class TriggerPipeline:
+    """Single inference producer that runs ahead of every viewer.
+
+    One task reads the newest camera frame, runs the model on a dedicated thread and feeds
+    _enqueue_detection_state_if_changed before any viewer sees that frame. Viewers (WebRTC
+    tracks, the relay, /mjpeg) only render results that already exist; one rendering per
+    frame is shared by all of them and runs on the default executor. While the trigger path
+    is loaded (inference near the frame interval, or the latency governor stepped down)
+    viewers drop to viewer_min_fps and the skipped frames are counted.
+    """
+
+    def __init__(self, source, idle_fps: float = 2.0, viewer_min_fps: float = 5.0, yield_load: float = 0.7):
+        self.source = source
+        self.idle_fps = max(0.1, float(idle_fps))
+        self.viewer_min_fps = max(0.5, float(viewer_min_fps))
+        self.yield_load = float(yield_load)
+        self.camera = None
+        self.latest: dict | None = None
+        self.load = 0.0
+        self._refs = 0
+        self._viewers = 0
+        self._task: asyncio.Task | None = None
+        self._stopping: asyncio.Task | None = None
+        self._start_lock = asyncio.Lock()
+        self._render_lock = asyncio.Lock()
+        self._new_frame = asyncio.Condition()
+        self._rendered: tuple[int, np.ndarray] | None = None
+        self._idle_render: asyncio.Task | None = None
+        self._pressure = False
+        # Ultralytics models are not safe to call from several threads at once.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='trigger')
+        self.stats = {
+            'frames': 0,
+            'inferences': 0,
+            'inference_ms_avg': 0.0,
+            'trigger_fps': 0.0,
+            'viewer_frames_rendered': 0,
+            'viewer_frames_degraded': 0,
+            'mjpeg_frames_degraded': 0,
+            'pressure_episodes': 0,
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def acquire(self, viewer: bool = False) -> None:
+        """Take a reference; the first one opens the camera and starts the trigger loop."""
+        async with self._start_lock:
+            if self._task is None:
+                if self._stopping is not None:
+                    # Let the previous loop release its camera reference first.
+                    await asyncio.gather(self._stopping, return_exceptions=True)
+                    self._stopping = None
+                self.camera = await SharedCamera.get_instance(self.source)
+                self._task = asyncio.create_task(self._run())
+            self._refs += 1
+            if viewer:
+                self._viewers += 1
+
+    def release(self, viewer: bool = False) -> None:
+        self._refs = max(0, self._refs - 1)
+        if viewer:
+            self._viewers = max(0, self._viewers - 1)
+        if self._refs == 0 and self._task is not None:
+            self._stopping, self._task = self._task, None
+            self._stopping.cancel()
+
+    def under_pressure(self) -> bool:
+        pressure = self.load >= self.yield_load or (latency_governor is not None and latency_governor.level > 0)
+        if pressure != self._pressure:
+            self._pressure = pressure
+            if pressure:
+                self.stats['pressure_episodes'] += 1
+                logger.warning(
+                    f"Trigger path under load ({self.load:.0%} busy): viewers limited to {self.viewer_min_fps:g} FPS"
+                )
+            else:
+                logger.info("Trigger path load back to normal: viewers at full rate")
+        return pressure
+
+    async def run_on_inference_thread(self, fn, *fn_args):
+        """Run fn on the thread that calls the active model, between the pipeline's own frames."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *fn_args)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        camera = self.camera
+        frame_id = 0
+        fps_window, fps_start = 0, time.monotonic()
+        logger.info("Trigger pipeline started")
+        try:
+            while True:
+                cycle_start = time.perf_counter()
+                ret, frame = await loop.run_in_executor(None, camera.read)
+                capture_ts = time.time()
+                if not ret:
+                    await asyncio.sleep(0.1)
+                    continue
+                frame_id += 1
+                # One config and model snapshot per frame: updates and swaps apply from the next frame.
+                cfg = runtime_config
+                active_model, active_onnx = model, model_is_onnx
+                infer_every = latency_governor.infer_every if latency_governor is not None else 1
+                inferred = self.latest is None or infer_every <= 1 or frame_id % infer_every == 0
+                if inferred:
+                    imgsz = latency_governor.imgsz if latency_governor is not None else cfg.imgsz
+                    t0 = time.perf_counter()
+                    try:
+                        if detection_cascade is not None:
+                            results = await loop.run_in_executor(
+                                self._executor, detection_cascade.run, frame, cfg, imgsz, active_model, active_onnx,
+                            )
+                        else:
+                            results = await loop.run_in_executor(
+                                self._executor, _run_model_inference, frame, cfg.conf, imgsz, active_model, active_onnx,
+                            )
+                    except Exception as e:
+                        logger.warning(f"Trigger inference error: {e}")
+                        await asyncio.sleep(1.0)
+                        continue
+                    inference_ms = (time.perf_counter() - t0) * 1000.0
+                    dets = detections_from_result(results[0], getattr(active_model, 'names', None))
+                    # The trigger decision is made before any viewer can see this frame.
+                    await _enqueue_detection_state_if_changed(
+                        dets=dets,
+                        width=camera.width,
+                        height=camera.height,
+                        frame_id=frame_id,
+                        queue=event_queue,
+                        capture_ts=capture_ts,
+                        frame=frame,
+                        config=cfg,
+                    )
+                    self.stats['inferences'] += 1
+                    self.stats['inference_ms_avg'] = round(0.9 * self.stats['inference_ms_avg'] + 0.1 * inference_ms, 2)
+                    cycle_ms = (time.perf_counter() - cycle_start) * 1000.0
+                    self.load = 0.8 * self.load + 0.2 * min(1.0, inference_ms / max(cycle_ms, 1e-3))
+                else:
+                    results, dets = self.latest['results'], self.latest['dets']
+
+                self.latest = {
+                    'seq': frame_id,
+                    'frame': frame,
+                    'results': results,
+                    'dets': dets,
+                    'inferred': inferred,
+                    'capture_ts': capture_ts,
+                    'config': cfg,
+                    'model': active_model,
+                }
+                self.stats['frames'] += 1
+                fps_window += 1
+                now = time.monotonic()
+                if now - fps_start >= 1.0:
+                    self.stats['trigger_fps'] = round(fps_window / (now - fps_start), 1)
+                    fps_window, fps_start = 0, now
+                async with self._new_frame:
+                    self._new_frame.notify_all()
+
+                if not self._viewers:
+                    # Nobody renders for viewers: keep the preview and clip ring fresh in the
+                    # background and idle at --keepalive-fps.
+                    if self._idle_render is None or self._idle_render.done():
+                        self._idle_render = asyncio.create_task(self.render(self.latest))
+                    elapsed = time.perf_counter() - cycle_start
+                    await asyncio.sleep(max(0.0, 1.0 / self.idle_fps - elapsed))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.latest = None
+            self._rendered = None
+            self.camera = None
+            async with self._new_frame:
+                self._new_frame.notify_all()
+            with contextlib.suppress(Exception):
+                await SharedCamera.release_instance()
+            logger.info("Trigger pipeline stopped")
+
+    def _render_sync(self, item: dict) -> tuple[np.ndarray, bytes | None]:
+        """Annotate, scale and JPEG-encode one frame (executor thread)."""
+        frame, results = item['frame'], item['results']
+        if _server_annotation_enabled():
+            # Frames between inferences get the previous boxes drawn onto the new image.
+            annotated = results[0].plot() if item['inferred'] else results[0].plot(img=frame)
+            _draw_trigger_overlay(annotated, item['dets'], item['config'])
+            cv2.putText(
+                annotated,
+                f"FPS: {self.stats['trigger_fps']:.1f} | Inference: {self.stats['inference_ms_avg']:.0f}ms",
+                (10, 30),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.7,
+                (0, 255, 0),
+                2
+            )
+        else:
+            # In client-annotation mode viewers draw boxes from /ws metadata; send raw frames.
+            annotated = frame
+        stream_scale = latency_governor.stream_scale if latency_governor is not None else 1.0
+        if stream_scale < 1.0:
+            h, w = annotated.shape[:2]
+            # Even dimensions keep yuv420p encoders happy.
+            size = (int(w * stream_scale) & ~1, int(h * stream_scale) & ~1)
+            annotated = cv2.resize(annotated, size, interpolation=cv2.INTER_AREA)
+        ok, buf = cv2.imencode('.jpg', annotated)
+        return annotated, (buf.tobytes() if ok else None)
+
+    async def render(self, item: dict) -> np.ndarray:
+        """Rendered BGR frame for item, computed once and shared by every viewer."""
+        async with self._render_lock:
+            if self._rendered is not None and self._rendered[0] == item['seq']:
+                return self._rendered[1]
+            annotated, jpeg = await asyncio.get_running_loop().run_in_executor(None, self._render_sync, item)
+            if jpeg is not None:
+                _set_latest_frame_jpeg(jpeg)
+            self._rendered = (item['seq'], annotated)
+            return annotated
+
+    async def next_viewer_frame(self, last_seq: int, last_sent: float) -> tuple[dict, np.ndarray]:
+        """Wait for a frame newer than last_seq, skipping frames while the trigger path is loaded."""
+        while True:
+            async with self._new_frame:
+                await self._new_frame.wait_for(
+                    lambda: not self.running or (self.latest is not None and self.latest['seq'] > last_seq)
+                )
+            item = self.latest
+            if item is None:
+                raise RuntimeError("Trigger pipeline stopped")
+            last_seq = item['seq']
+            if self.under_pressure() and time.monotonic() - last_sent < 1.0 / self.viewer_min_fps:
+                self.stats['viewer_frames_degraded'] += 1
+                continue
+            self.stats['viewer_frames_rendered'] += 1
+            return item, await self.render(item)
+
+    def mjpeg_interval(self, min_interval: float) -> float:
+        """Interval an /mjpeg client should wait between frames given current load."""
+        if self.under_pressure() and min_interval < 1.0 / self.viewer_min_fps:
+            self.stats['mjpeg_frames_degraded'] += 1
+            return 1.0 / self.viewer_min_fps
+        return min_interval
+
+    async def close(self) -> None:
+        for task in (self._task, self._stopping):
+            if task is not None:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError, Exception):
+                    await task
+        self._task = self._stopping = None
+        self._executor.shutdown(wait=False)
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            'running': self.running,
+            'refs': self._refs,
+            'viewers': self._viewers,
+            'load': round(self.load, 3),
+            'under_pressure': self._pressure,
+            'viewer_min_fps': self.viewer_min_fps,
+            'yield_load': self.yield_load,
+        }
+
+
+# Set in main(); every inference (keepalive and viewers) goes through it.
+trigger_pipeline: TriggerPipeline | None = None
+
+
+class ModelSwapper:
+    """Replace the running model without stopping detection.
+
+    request() loads the candidate on the default executor, warms it up on live frames and
+    compares it with the current model on a sample of live frames. Both models see each
+    frame as a single full pass at the configured imgsz and conf (the pipeline's own
+    results may come from a governor-reduced size or the cascade, so they are not reused);
+    the current model runs on the pipeline's inference thread between its frames. Sampling
+    continues until the current model has produced min_boxes boxes: a belt that stayed
+    empty proves nothing, and such a check is reported inconclusive. When recall and
+    precision reach their minimums (or force is set) the model globals are replaced in one
+    synchronous step between frames; the previous model stays loaded for rollback().
+    """
+
+    def __init__(self, current_path: str, min_recall: float = 0.9, min_precision: float = 0.8,
+                 min_boxes: int = 10, sample_frames: int = 20, warmup_frames: int = 3,
+                 sample_interval: float = 0.2, sample_timeout: float = 30.0):
+        self.current_path = current_path
+        self.min_recall = float(min_recall)
+        self.min_precision = float(min_precision)
+        self.min_boxes = max(1, int(min_boxes))
+        self.sample_frames = max(1, int(sample_frames))
+        self.warmup_frames = max(0, int(warmup_frames))
+        self.sample_interval = float(sample_interval)
+        self.sample_timeout = float(sample_timeout)
+        self.previous = None  # (model, path, is_onnx, is_ncnn)
+        self.state = 'idle'
+        self.history: collections.deque = collections.deque(maxlen=10)
+        self._pending = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def busy(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def request(self, path: str, force: bool = False) -> None:
+        """Start a background swap to path (ValueError / RuntimeError when it cannot start)."""
+        if self.busy:
+            raise RuntimeError(f"swap to {self._pending} already in progress")
+        if not path or not Path(path).exists():
+            raise ValueError(f"model not found: {path}")
+        self._pending = path
+        self._task = asyncio.create_task(self._swap(path, bool(force)))
+
+    def rollback(self) -> dict:
+        """Swap back to the previous model (which becomes the rollback target in turn)."""
+        if self.busy:
+            raise RuntimeError(f"swap to {self._pending} in progress")
+        if self.previous is None:
+            raise ValueError("no previous model to roll back to")
+        previous_model, path, is_onnx, is_ncnn = self.previous
+        report = {'path': path, 'previous_path': self.current_path, 'started_at': time.time(), 'result': 'rolled_back'}
+        report['swap_us'] = self._install(previous_model, path, is_onnx, is_ncnn)
+        self.history.append(report)
+        return report
+
+    def _install(self, new_model, path: str, is_onnx: bool, is_ncnn: bool) -> float:
+        """Replace the model globals; runs on the event loop, so no frame sees a mix."""
+        global model, model_is_onnx, model_is_ncnn, detection_cascade
+        t0 = time.perf_counter()
+        self.previous = (model, self.current_path, model_is_onnx, model_is_ncnn)
+        model, model_is_onnx, model_is_ncnn = new_model, is_onnx, is_ncnn
+        if detection_cascade is not None and detection_cascade.stage1_model is None and (is_onnx or is_ncnn):
+            # Same rule as at startup: stage 1 reuses the main model at a smaller imgsz.
+            detection_cascade = None
+            logger.warning(f"{path} is a fixed-shape export and there is no --cascade-model; cascade disabled")
+        self.current_path = path
+        swap_us = round((time.perf_counter() - t0) * 1e6, 1)
+        if latency_governor is not None:
+            latency_governor.fixed_imgsz = is_onnx or is_ncnn
+            latency_governor.rebase(runtime_config.imgsz)
+        logger.info(f"🔁 Model now {path} (previous {self.previous[1]} kept for rollback)")
+        return swap_us
+
+    async def _sample_live(self, count: int, deadline: float) -> list:
+        """Distinct live frames from the trigger pipeline (fewer if deadline passes first)."""
+        frames, last_seq = [], None
+        while len(frames) < count and time.monotonic() < deadline:
+            item = trigger_pipeline.latest
+            if item is not None and item['seq'] != last_seq:
+                last_seq = item['seq']
+                frames.append(item['frame'])
+            await asyncio.sleep(self.sample_interval)
+        return frames
+
+    async def _validate(self, candidate, fixed_shape: bool, reference, reference_fixed: bool,
+                        frames: list, cfg: RuntimeConfig, deadline: float) -> dict:
+        """Compare candidate and reference on frames, sampling more until min_boxes or deadline."""
+        from quantize_model import _predict, agreement_report, match_detections
+
+        loop = asyncio.get_running_loop()
+        matched = ref_total = cand_total = 0
+        ious, cand_ms, ref_ms = [], [], []
+        while frames:
+            for frame in frames:
+                ref_boxes, ref_elapsed = await trigger_pipeline.run_on_inference_thread(
+                    _predict, reference, frame, cfg.imgsz, cfg.conf, reference_fixed,
+                )
+                cand_boxes, cand_elapsed = await loop.run_in_executor(
+                    None, _predict, candidate, frame, cfg.imgsz, cfg.conf, fixed_shape,
+                )
+                ref_ms.append(ref_elapsed)
+                cand_ms.append(cand_elapsed)
+                ref_total += len(ref_boxes)
+                cand_total += len(cand_boxes)
+                frame_matched, frame_ious = match_detections(ref_boxes, cand_boxes)
+                matched += frame_matched
+                ious.extend(frame_ious)
+            if ref_total >= self.min_boxes:
+                break
+            frames = await self._sample_live(self.sample_frames, deadline)
+        return agreement_report(matched, ref_total, cand_total, ious, cand_ms, ref_ms, min_reference_boxes=self.min_boxes)
+
+    async def _swap(self, path: str, force: bool) -> None:
+        loop = asyncio.get_running_loop()
+        report = {'path': path, 'previous_path': self.current_path, 'started_at': time.time(), 'force': force, 'result': None}
+        start = time.perf_counter()
+        logger.info(f"Model swap to {path} started")
+        try:
+            # Hold the pipeline open so there are live frames even without viewers or keepalive.
+            await trigger_pipeline.acquire()
+        except RuntimeError as e:
+            report.update(result='failed', error=f"camera unavailable: {e}")
+            self.history.append(report)
+            self._pending = None
+            logger.error(f"Model swap to {path} failed: {report['error']}")
+            return
+        try:
+            self.state = 'loading'
+            t0 = time.perf_counter()
+            candidate, is_onnx, is_ncnn = await loop.run_in_executor(None, _load_model, path)
+            report['load_ms'] = round((time.perf_counter() - t0) * 1000.0, 1)
+            fixed_shape = is_onnx or is_ncnn
+            reference, reference_fixed = model, model_is_onnx or model_is_ncnn
+
+            self.state = 'sampling'
+            deadline = time.monotonic() + self.sample_timeout
+            samples = await self._sample_live(self.warmup_frames + self.sample_frames, deadline)
+            if len(samples) <= self.warmup_frames:
+                raise RuntimeError(f"only {len(samples)} live frames within {self.sample_timeout:.0f}s")
+
+            cfg = runtime_config
+            self.state = 'warming'
+            t0 = time.perf_counter()
+            from quantize_model import _predict
+            for frame in samples[:self.warmup_frames]:
+                await loop.run_in_executor(None, _predict, candidate, frame, cfg.imgsz, cfg.conf, fixed_shape)
+            report['warmup_ms'] = round((time.perf_counter() - t0) * 1000.0, 1)
+
+            self.state = 'validating'
+            validation = await self._validate(
+                candidate, fixed_shape, reference, reference_fixed, samples[self.warmup_frames:], cfg,
+                time.monotonic() + self.sample_timeout,
             )
-        return ret, frame
+            report['validation'] = validation
+            if validation['inconclusive']:
+                reason = (f"inconclusive: current model found {validation['reference_boxes']} boxes "
+                          f"on {validation['images']} live frames (< {self.min_boxes})")
+            elif validation['recall'] < self.min_recall:
+                reason = f"recall {validation['recall']:.1%} of current detections (< {self.min_recall:.0%})"
+            elif validation['precision'] < self.min_precision:
+                reason = f"precision {validation['precision']:.1%} against current detections (< {self.min_precision:.0%})"
+            else:
+                reason = None
+            report['passed'] = reason is None
+            if reason is not None and not force:
+                report['result'] = 'rejected'
+                report['error'] = reason
+                logger.error(f"❌ Model swap to {path} rejected: {reason}")
+                return
+
+            report['swap_us'] = self._install(candidate, path, is_onnx, is_ncnn)
+            report['result'] = 'swapped'
+            logger.info(f"Model swap to {path} done: {validation}")
+        except Exception as e:
+            report.update(result='failed', error=f"{type(e).__name__}: {e}")
+            logger.error(f"Model swap to {path} failed: {report['error']}")
+        finally:
+            trigger_pipeline.release()
+            report['total_ms'] = round((time.perf_counter() - start) * 1000.0, 1)
+            self.history.append(report)
+            self.state = 'idle'
+            self._pending = None
+
+    def snapshot(self) -> dict:
+        return {
+            'current_path': self.current_path,
+            'rollback_path': self.previous[1] if self.previous else None,
+            'state': self.state,
+            'pending': self._pending,
+            'min_recall': self.min_recall,
+            'min_precision': self.min_precision,
+            'min_boxes': self.min_boxes,
+            'history': list(self.history),
+        }
+
+
+model_swapper: ModelSwapper | None = None
+
+runtime_config_lock = asyncio.Lock()
+
+
+def _fixed_config_fields() -> dict:
+    """RuntimeConfig fields the running setup ignores, with the reason they cannot change."""
+    fixed = {}
+    if model_is_onnx or model_is_ncnn:
+        fixed['imgsz'] = 'fixed by the loaded ONNX/NCNN export'
+    if trigger_zones is not None:
+        fixed['trigger_line_y'] = fixed['after_line_side'] = 'not used with --trigger-zones (edit the zone config)'
+    return fixed
+
+
+async def apply_runtime_config(updates: dict, source: str, expected_version: int | None = None):
+    """Validate and publish a new RuntimeConfig version; returns (config, changed fields).
+
+    Raises ValueError for invalid settings and RuntimeError when expected_version is stale.
+    """
+    global runtime_config
+    async with runtime_config_lock:
+        current = runtime_config
+        if expected_version is not None and int(expected_version) != current.version:
+            raise RuntimeError(f"config is at version {current.version}, not {expected_version}")
+        new = current.replace(updates, source)
+        changed = new.diff(current)
+        if not changed:
+            return current, {}
+        fixed = _fixed_config_fields()
+        rejected = [name for name in changed if name in fixed]
+        if rejected:
+            raise ValueError('; '.join(f"{name}: {fixed[name]}" for name in rejected))
+        camera = SharedCamera._instance
+        if 'flip' in changed and camera is not None:
+            await asyncio.get_running_loop().run_in_executor(None, camera.set_flip, new.flip)
+        if 'imgsz' in changed and latency_governor is not None:
+            latency_governor.rebase(new.imgsz)
+        if trigger_zones is not None and changed.keys() & {'conf', 'trigger_min_conf', 'trigger_stable_frames'}:
+            # Zones without their own min_conf / stable_frames follow the global settings.
+            trigger_zones.set_defaults(min_conf=new.trigger_conf, stable_frames=new.trigger_stable_frames)
+        if 'conf' in changed and hard_example_harvester is not None:
+            hard_example_harvester.set_conf(new.conf)
+        runtime_config = new
+    logger.info(
+        f"⚙️ Runtime config v{new.version} from {source}: "
+        + ', '.join(f"{name} {old}->{value}" for name, (old, value) in changed.items())
+    )
+    return new, changed
 
 
 class YOLOVideoTrack(VideoStreamTrack):
-    """Video track that captures from shared camera and applies YOLO inference."""
+    """Video track streaming the shared camera with YOLO results from the trigger pipeline."""
     
-    def __init__(self, camera, flip_mode, model_instance, conf_threshold, event_queue=None, imgsz=320):
+    def __init__(self, camera):
         super().__init__()
         self.camera = camera
-        self.flip_mode = flip_mode
-        self.model = model_instance
-        self.conf = conf_threshold
-        self.event_queue = event_queue
-        self.imgsz = imgsz
         
         self.width = camera.width
         self.height = camera.height
@@ -522,12 +2407,26 @@ class YOLOVideoTrack(VideoStreamTrack):
         self.frame_count = 0
         self.last_fps_time = time.time()
         self.fps_counter = 0
+        self._pipeline_acquired = False
+        self._last_seq = 0
+        self._last_sent = 0.0
+
+        # Per-peer budget accounting reported in /status.
+        self.last_frame_at = time.monotonic()
+        self.process_ms_avg = 0.0
+        self.encode_ms_avg = 0.0
+        self._handed_off_at = None
         
         logger.info(f"🎬 Video track created for client")
     
     def stop(self):
-        """Release camera reference when track stops."""
+        """Release camera reference when track stops (safe to call more than once)."""
+        if self.readyState != 'live':
+            return
         super().stop()
+        if self._pipeline_acquired:
+            self._pipeline_acquired = False
+            trigger_pipeline.release(viewer=True)
         try:
             loop = asyncio.get_running_loop()
             loop.create_task(SharedCamera.release_instance())
@@ -536,102 +2435,48 @@ class YOLOVideoTrack(VideoStreamTrack):
             asyncio.run(SharedCamera.release_instance())
         
     async def recv(self):
-        """Receive the next frame (with YOLO inference applied)."""
+        """Receive the next frame (newest trigger-pipeline result, rendered for viewers)."""
         try:
+            if not self._pipeline_acquired:
+                await trigger_pipeline.acquire(viewer=True)
+                self._pipeline_acquired = True
+            if self._handed_off_at is not None:
+                # aiortc encodes and sends the previous frame before asking for the next one,
+                # so the gap since hand-off approximates this peer's encode cost.
+                gap_ms = (time.perf_counter() - self._handed_off_at) * 1000.0
+                self.encode_ms_avg = 0.9 * self.encode_ms_avg + 0.1 * gap_ms
             pts, time_base = await self.next_timestamp()
-            
-            # Run blocking I/O in executor to avoid blocking event loop
-            loop = asyncio.get_event_loop()
-            ret, frame = await loop.run_in_executor(None, self.camera.read)
-            
-            if not ret:
-                logger.warning("Failed to read frame from camera")
-                # Return black frame on failure
-                frame = np.zeros((self.height, self.width, 3), dtype=np.uint8)
-            
-            # Apply flip if requested
-            if self.flip_mode != 'none':
-                if self.flip_mode == 'vertical':
-                    frame = cv2.flip(frame, 0)
-                elif self.flip_mode == 'horizontal':
-                    frame = cv2.flip(frame, 1)
-                elif self.flip_mode == '180':
-                    frame = cv2.flip(frame, -1)
-            
-            # Run YOLO inference
-            t0 = time.time()
-            results = _run_model_inference(frame, conf_threshold=self.conf, imgsz=self.imgsz)
-            annotated = results[0].plot()
-            inference_time = time.time() - t0
-
-            # Update latest annotated frame for instant preview (non-blocking)
-            try:
-                ret, buf = cv2.imencode('.jpg', annotated)
-                if ret:
-                    async with latest_frame_lock:
-                        globals()['latest_frame_jpeg'] = buf.tobytes()
-            except Exception:
-                pass
-
-            # Build detection list
-            dets = []
-            for b in results[0].boxes:
-                try:
-                    xyxy = _normalize_xyxy(b.xyxy.tolist() if hasattr(b, 'xyxy') else None)
-                    dets.append({
-                        'cls': int(b.cls),
-                        'name': self.model.names[int(b.cls)] if hasattr(self.model, 'names') else str(int(b.cls)),
-                        'conf': float(b.conf),
-                        'xyxy': xyxy,
-                    })
-                except Exception:
-                    continue
+            process_start = time.perf_counter()
 
-            _draw_trigger_overlay(annotated, dets)
+            # Inference and the trigger decision already happened in the trigger pipeline;
+            # this only waits for a newer result (fewer while the trigger path is loaded).
+            item, annotated = await trigger_pipeline.next_viewer_frame(self._last_seq, self._last_sent)
+            self._last_seq = item['seq']
+            self._last_sent = time.monotonic()
 
-            # Emit detection updates only on state transitions (no spam per frame).
-            await _enqueue_detection_state_if_changed(
-                dets=dets,
-                width=self.width,
-                height=self.height,
-                frame_id=self.frame_count,
-                queue=self.event_queue,
-            )
-            
-            # Add FPS overlay
             self.fps_counter += 1
             current_time = time.time()
             if current_time - self.last_fps_time >= 1.0:
-                fps = self.fps_counter / (current_time - self.last_fps_time)
+                self.measured_fps = self.fps_counter / (current_time - self.last_fps_time)
                 self.last_fps_time = current_time
                 self.fps_counter = 0
-                self.measured_fps = fps
-                logger.info(f"Streaming at {fps:.1f} FPS, inference: {inference_time*1000:.0f}ms")
-            else:
-                fps = self.measured_fps
-            
-            cv2.putText(
-                annotated,
-                f"FPS: {fps:.1f} | Inference: {inference_time*1000:.0f}ms",
-                (10, 30),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.7,
-                (0, 255, 0),
-                2
-            )
-            
-            # Convert BGR to RGB for WebRTC
-            frame_rgb = cv2.cvtColor(annotated, cv2.COLOR_BGR2RGB)
-            
-            # Create VideoFrame
-            new_frame = VideoFrame.from_ndarray(frame_rgb, format="rgb24")
+                logger.info(
+                    f"Streaming at {self.measured_fps:.1f} FPS, "
+                    f"inference: {trigger_pipeline.stats['inference_ms_avg']:.0f}ms"
+                )
+
+            # Encoders convert to yuv420p anyway; bgr24 skips a separate RGB copy.
+            new_frame = VideoFrame.from_ndarray(annotated, format="bgr24")
             new_frame.pts = pts
             new_frame.time_base = time_base
             
             self.frame_count += 1
+            self.last_frame_at = time.monotonic()
+            self._handed_off_at = time.perf_counter()
+            self.process_ms_avg = 0.9 * self.process_ms_avg + 0.1 * (self._handed_off_at - process_start) * 1000.0
             
             if self.frame_count == 1:
-                logger.info(f"First frame sent: {self.width}x{self.height}")
+                logger.info(f"First frame sent: {annotated.shape[1]}x{annotated.shape[0]}")
             
             return new_frame
         except Exception as e:
@@ -639,8 +2484,353 @@ class YOLOVideoTrack(VideoStreamTrack):
             raise
 
 
+VIDEO_TIME_BASE = fractions.Fraction(1, 90000)
+
+
+class RelayedVideoTrack(MediaStreamTrack):
+    """Per-peer track handing out already-encoded H.264 packets from VideoRelay.
+
+    aiortc packetizes av.Packet objects directly, so peers never run their own encoder.
+    """
+
+    kind = 'video'
+
+    def __init__(self, relay, pc=None):
+        super().__init__()
+        self.relay = relay
+        self.pc = pc
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=relay.max_queue)
+        self.waiting_for_keyframe = True
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_dropped = 0
+        self.last_frame_at = time.monotonic()
+
+    def push(self, packet, is_keyframe: bool) -> None:
+        if self.waiting_for_keyframe:
+            # A decoder joining mid-GOP cannot use delta frames; start at a keyframe.
+            if not is_keyframe:
+                return
+            self.waiting_for_keyframe = False
+        try:
+            self.queue.put_nowait(packet)
+        except asyncio.QueueFull:
+            # Peer cannot keep up: drop its backlog and resume from the next keyframe.
+            self.packets_dropped += self.queue.qsize() + 1
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.waiting_for_keyframe = True
+            self.relay.request_keyframe()
+
+    async def recv(self):
+        if self.readyState != 'live':
+            raise MediaStreamError
+        packet = await self.queue.get()
+        self.packets_sent += 1
+        self.bytes_sent += packet.size
+        self.last_frame_at = time.monotonic()
+        return packet
+
+    def stop(self):
+        if self.readyState == 'live':
+            super().stop()
+        self.relay.unsubscribe(self)
+
+
+class VideoRelay:
+    """Run the processed stream through one H.264 encoder and relay packets to every peer.
+
+    Adding a viewer costs a queue and RTP packetization instead of a full encoder.
+    New peers trigger a keyframe; the group bitrate follows the worst receiver's loss.
+    """
+
+    def __init__(self, bitrate_kbps: int = 600, min_kbps: int = 150, max_kbps: int = 1500,
+                 keyframe_interval: float = 2.0, encoder: str = 'libx264', max_queue: int = 60):
+        self.target_bitrate = int(bitrate_kbps) * 1000
+        self._bitrate_estimate = self.target_bitrate
+        self.min_bitrate = int(min_kbps) * 1000
+        self.max_bitrate = max(self.min_bitrate, int(max_kbps) * 1000)
+        self.keyframe_interval = max(0.5, float(keyframe_interval))
+        self.encoder_name = encoder
+        self.max_queue = max(2, int(max_queue))
+        self.subscribers: set[RelayedVideoTrack] = set()
+        self._task: asyncio.Task | None = None
+        self._codec = None
+        self._codec_bitrate = None
+        self._force_keyframe = True
+        self._last_keyframe = 0.0
+        self.stats = {
+            'frames_encoded': 0,
+            'keyframes': 0,
+            'encoder_reopens': 0,
+            'encode_ms_avg': 0.0,
+            'bytes_encoded': 0,
+        }
+
+    def request_keyframe(self) -> None:
+        self._force_keyframe = True
+
+    async def subscribe(self, pc=None) -> RelayedVideoTrack:
+        track = RelayedVideoTrack(self, pc)
+        self.subscribers.add(track)
+        self.request_keyframe()
+        if self._task is None or self._task.done():
+            try:
+                camera = await SharedCamera.get_instance(args.source)
+            except RuntimeError:
+                self.subscribers.discard(track)
+                raise
+            source = YOLOVideoTrack(camera=camera)
+            self._task = asyncio.create_task(self._run(source))
+        logger.info(f"Relay subscriber added ({len(self.subscribers)} active)")
+        return track
+
+    def unsubscribe(self, track: RelayedVideoTrack) -> None:
+        if track in self.subscribers:
+            self.subscribers.discard(track)
+            logger.info(f"Relay subscriber removed ({len(self.subscribers)} active)")
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            'encoder': self.encoder_name,
+            'bitrate_kbps': round(self.target_bitrate / 1000),
+            'running': bool(self._task and not self._task.done()),
+            'subscribers': len(self.subscribers),
+        }
+
+    async def _run(self, source) -> None:
+        loop = asyncio.get_running_loop()
+        last_bitrate_check = time.monotonic()
+        logger.info(f"Video relay started (encoder={self.encoder_name})")
+        try:
+            # Exits once the last subscriber leaves; the source releases its camera reference.
+            while self.subscribers:
+                frame = await source.recv()
+                now = time.monotonic()
+                force = self._force_keyframe or (now - self._last_keyframe) >= self.keyframe_interval
+                self._force_keyframe = False
+                t0 = time.perf_counter()
+                packets = await loop.run_in_executor(None, self._encode, frame, force)
+                encode_ms = (time.perf_counter() - t0) * 1000.0
+                self.stats['frames_encoded'] += 1
+                self.stats['encode_ms_avg'] = round(0.9 * self.stats['encode_ms_avg'] + 0.1 * encode_ms, 2)
+                for packet in packets:
+                    is_keyframe = bool(packet.is_keyframe)
+                    if is_keyframe:
+                        self._last_keyframe = now
+                        self.stats['keyframes'] += 1
+                    self.stats['bytes_encoded'] += packet.size
+                    for track in list(self.subscribers):
+                        track.push(packet, is_keyframe)
+                if now - last_bitrate_check >= 2.0:
+                    last_bitrate_check = now
+                    await self._adapt_bitrate()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Video relay failed: {e}", exc_info=True)
+        finally:
+            source.stop()
+            self._codec = None
+            logger.info("Video relay stopped")
+
+    def _open_codec(self, width: int, height: int) -> None:
+        codec = av.CodecContext.create(self.encoder_name, 'w')
+        codec.width = width
+        codec.height = height
+        codec.pix_fmt = 'yuv420p'
+        codec.bit_rate = self.target_bitrate
+        codec.framerate = fractions.Fraction(30, 1)
+        codec.time_base = VIDEO_TIME_BASE
+        if self.encoder_name == 'libx264':
+            # Same constraints aiortc uses for browser-compatible H.264 (baseline, packetization-mode=1).
+            codec.options = {'level': '31', 'tune': 'zerolatency', 'preset': 'ultrafast'}
+            codec.profile = 'Baseline'
+        self._codec = codec
+        self._codec_bitrate = self.target_bitrate
+        self.stats['encoder_reopens'] += 1
+
+    def _encode(self, frame, force_keyframe: bool) -> list:
+        """Encode one frame (executor thread); reopens the codec on size or bitrate changes."""
+        codec = self._codec
+        if (
+            codec is None
+            or codec.width != frame.width
+            or codec.height != frame.height
+            or self._codec_bitrate != self.target_bitrate
+        ):
+            self._open_codec(frame.width, frame.height)
+            codec = self._codec
+            force_keyframe = True
+        if frame.format.name != 'yuv420p':
+            pts, time_base = frame.pts, frame.time_base
+            frame = frame.reformat(format='yuv420p')
+            frame.pts, frame.time_base = pts, time_base
+        if force_keyframe:
+            try:
+                frame.pict_type = av.video.frame.PictureType.I
+            except AttributeError:
+                frame.pict_type = 'I'
+        packets = codec.encode(frame)
+        for packet in packets:
+            if packet.time_base is None:
+                packet.time_base = VIDEO_TIME_BASE
+        return packets
+
+    async def _adapt_bitrate(self) -> None:
+        """Step the shared bitrate down on loss at any receiver, up when all are clean."""
+        losses = []
+        for track in list(self.subscribers):
+            if track.pc is None:
+                continue
+            try:
+                report = await track.pc.getStats()
+            except Exception:
+                continue
+            for stat in report.values():
+                if getattr(stat, 'type', None) == 'remote-inbound-rtp':
+                    losses.append(float(getattr(stat, 'fractionLost', 0.0) or 0.0))
+        if not losses:
+            return
+        worst = max(losses)
+        if worst > 0.10:
+            self._bitrate_estimate = max(self.min_bitrate, int(self._bitrate_estimate * 0.8))
+        elif worst < 0.02:
+            self._bitrate_estimate = min(self.max_bitrate, int(self._bitrate_estimate * 1.05))
+        # Reopening the encoder costs a keyframe, so only apply changes of 10% or more.
+        if abs(self._bitrate_estimate - self.target_bitrate) >= 0.1 * self.target_bitrate:
+            logger.info(
+                f"Relay bitrate {self.target_bitrate // 1000} -> {self._bitrate_estimate // 1000} kbps "
+                f"(worst loss {worst:.1%} across {len(losses)} peer(s))"
+            )
+            self.target_bitrate = self._bitrate_estimate
+
+
+# Created in main() when --webrtc-relay is enabled.
+video_relay: VideoRelay | None = None
+
+
+def _prefer_h264(pc, sender) -> None:
+    """Restrict the sender's transceiver to H.264 so relayed packets can be sent as-is."""
+    capabilities = RTCRtpSender.getCapabilities('video')
+    h264 = [c for c in capabilities.codecs if c.mimeType.lower() == 'video/h264']
+    for transceiver in pc.getTransceivers():
+        if transceiver.sender is sender and h264:
+            transceiver.setCodecPreferences(h264)
+
+
+def _offer_has_h264(sdp: str) -> bool:
+    """True when the offer's SDP lists an H.264 payload the relay can be sent as."""
+    return any(line.lower().startswith('a=rtpmap:') and ' h264/' in line.lower() for line in sdp.splitlines())
+
+
 # Track active peer connections
 pcs = set()
+# Per-peer bookkeeping for admission control, idle eviction and /status budgets.
+peer_sessions: dict = {}
+_peer_counter = 0
+
+
+def _control_auth_error(request, required: bool = False) -> web.Response | None:
+    """Check the --control-token bearer token; None when the request may proceed."""
+    token = getattr(args, 'control_token', None)
+    if not token:
+        return web.Response(status=403, text='Set --control-token to enable this endpoint') if required else None
+    auth = request.headers.get('Authorization', '')
+    if not auth.startswith('Bearer '):
+        return web.Response(status=401, text='Missing Authorization')
+    if not hmac.compare_digest(auth[len('Bearer '):].strip().encode(), token.encode()):
+        return web.Response(status=403, text='Forbidden')
+    return None
+
+
+def _viewer_limit_response(kind: str, limit: int) -> web.Response:
+    retry_after = int(getattr(args, 'viewer_retry_after', 30))
+    logger.warning(f"Rejecting {kind} viewer: limit of {limit} reached")
+    return web.json_response(
+        {'error': 'viewer_limit', 'kind': kind, 'limit': limit, 'fallback': '/mjpeg' if kind == 'webrtc' else None},
+        status=503,
+        headers={'Retry-After': str(retry_after)},
+    )
+
+
+async def _close_peer(pc, reason: str) -> None:
+    """Close a peer and stop its outgoing tracks (aiortc does not stop sender tracks itself)."""
+    session = peer_sessions.pop(pc, None)
+    pcs.discard(pc)
+    if session and session.get('track') is not None:
+        session['track'].stop()
+    with contextlib.suppress(Exception):
+        await pc.close()
+    if session:
+        logger.info(f"Peer {session['id']} closed ({reason}); {len(pcs)} active")
+
+
+async def _peer_budget(pc, session: dict) -> dict:
+    track = session.get('track')
+    entry = {
+        'id': session['id'],
+        'remote': session.get('remote'),
+        'state': pc.connectionState,
+        'age_s': round(time.monotonic() - session['created'], 1),
+        'idle_s': round(time.monotonic() - track.last_frame_at, 1) if track is not None else None,
+        'frames_sent': getattr(track, 'frame_count', getattr(track, 'packets_sent', 0)),
+        'bytes_sent': getattr(track, 'bytes_sent', None),
+        'encode_ms_avg': round(getattr(track, 'encode_ms_avg', 0.0), 2) if hasattr(track, 'encode_ms_avg') else None,
+        'process_ms_avg': round(getattr(track, 'process_ms_avg', 0.0), 2) if hasattr(track, 'process_ms_avg') else None,
+    }
+    if isinstance(track, RelayedVideoTrack):
+        entry['packets_dropped'] = track.packets_dropped
+        entry['encode_ms_avg'] = video_relay.stats['encode_ms_avg'] if video_relay else None
+    with contextlib.suppress(Exception):
+        report = await pc.getStats()
+        for stat in report.values():
+            if getattr(stat, 'type', None) == 'outbound-rtp':
+                entry['bytes_sent'] = getattr(stat, 'bytesSent', entry['bytes_sent'])
+                entry['packets_sent'] = getattr(stat, 'packetsSent', None)
+    return entry
+
+
+async def peer_idle_reaper() -> None:
+    """Evict peers that never connected or stopped pulling frames for --peer-idle-timeout seconds."""
+    while True:
+        await asyncio.sleep(10)
+        timeout = float(getattr(args, 'peer_idle_timeout', 60))
+        if timeout <= 0:
+            continue
+        now = time.monotonic()
+        for pc, session in list(peer_sessions.items()):
+            track = session.get('track')
+            last_active = track.last_frame_at if track is not None else session['created']
+            if now - session['created'] < timeout:
+                continue
+            if pc.connectionState != 'connected' or now - last_active > timeout:
+                await _close_peer(pc, reason=f'idle > {timeout:.0f}s')
+
+# Set in main() with --memory-watchdog-mb.
+memory_watchdog: MemoryWatchdog | None = None
+
+
+async def memory_watchdog_task() -> None:
+    """Sample RSS / fds / object totals every --memory-watchdog-interval seconds (census off-loop)."""
+    loop = asyncio.get_running_loop()
+    interval = max(5.0, float(getattr(args, 'memory_watchdog_interval', 60.0)))
+    while True:
+        # The likeliest long-run leaks: peers never discarded, tasks never finished, stuck subscribers.
+        gauges = {
+            'peer_connections': len(pcs),
+            'peer_sessions': len(peer_sessions),
+            'asyncio_tasks': len(asyncio.all_tasks()),
+            'ws_subscribers': detection_metadata.subscribers,
+            'mjpeg_clients': mjpeg_frames.subscribers,
+        }
+        try:
+            await loop.run_in_executor(None, memory_watchdog.check, gauges)
+        except Exception as e:
+            logger.warning(f"Memory watchdog check failed: {e}")
+        await asyncio.sleep(interval)
+
 
 async def index(request):
     """Serve the HTML client."""
@@ -655,41 +2845,65 @@ async def offer(request):
     params = await request.json()
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
 
+    max_peers = int(getattr(args, 'max_webrtc_peers', 0))
+    if max_peers > 0 and len(pcs) >= max_peers:
+        return _viewer_limit_response('webrtc', max_peers)
+
+    global _peer_counter
+    _peer_counter += 1
     ice_servers = _build_ice_servers_for_aiortc()
     configuration = RTCConfiguration(iceServers=ice_servers)
     pc = RTCPeerConnection(configuration=configuration)
     pcs.add(pc)
+    session = {'id': _peer_counter, 'created': time.monotonic(), 'remote': request.remote, 'track': None}
+    peer_sessions[pc] = session
     
     @pc.on("connectionstatechange")
     async def on_connectionstatechange():
         logger.info(f"Connection state: {pc.connectionState}")
         if pc.connectionState == "failed" or pc.connectionState == "closed":
-            await pc.close()
-            pcs.discard(pc)
-    
-    # Get shared camera instance
-    try:
-        camera = await SharedCamera.get_instance(args.source)
-    except RuntimeError as e:
-        logger.error(f"Failed to get camera: {e}")
-        return web.Response(status=503, text="Camera unavailable")
+            await _close_peer(pc, reason=pc.connectionState)
     
-    # Create video track with shared camera
-    video_track = YOLOVideoTrack(
-        camera=camera,
-        flip_mode=args.flip,
-        model_instance=model,
-        conf_threshold=args.conf,
-        event_queue=event_queue,
-        imgsz=args.imgsz
-    )
-    
-    pc.addTrack(video_track)
-    
-    await pc.setRemoteDescription(offer)
+    relay = video_relay
+    if relay is not None and not _offer_has_h264(offer.sdp):
+        # Relayed packets are H.264 only; give this peer its own transcoding track instead.
+        logger.warning("Offer has no H.264 codec; using a transcoding track for this peer")
+        relay = None
+
+    if relay is not None:
+        # Relay mode: share one encoder across every peer.
+        try:
+            video_track = await relay.subscribe(pc)
+        except RuntimeError as e:
+            logger.error(f"Failed to get camera: {e}")
+            await _close_peer(pc, reason='camera unavailable')
+            return web.Response(status=503, text="Camera unavailable")
+        session['track'] = video_track
+
+        sender = pc.addTrack(video_track)
+        # Preferences must be in place before the offer is applied, or the answer may pick VP8.
+        _prefer_h264(pc, sender)
+        await pc.setRemoteDescription(offer)
+    else:
+        # Get shared camera instance
+        try:
+            camera = await SharedCamera.get_instance(args.source)
+        except RuntimeError as e:
+            logger.error(f"Failed to get camera: {e}")
+            await _close_peer(pc, reason='camera unavailable')
+            return web.Response(status=503, text="Camera unavailable")
+
+        # Create video track with shared camera
+        video_track = YOLOVideoTrack(camera=camera)
+        session['track'] = video_track
+
+        pc.addTrack(video_track)
+
+        await pc.setRemoteDescription(offer)
+
     answer = await pc.createAnswer()
     await pc.setLocalDescription(answer)
-    
+
     return web.Response(
         content_type="application/json",
         text=json.dumps({
@@ -701,7 +2915,7 @@ async def offer(request):
 
 async def on_shutdown(app):
     """Close all peer connections on shutdown."""
-    coros = [pc.close() for pc in pcs]
+    coros = [_close_peer(pc, reason='shutdown') for pc in list(pcs)]
     await asyncio.gather(*coros)
     pcs.clear()
 
@@ -729,7 +2943,7 @@ async def on_shutdown(app):
 
 
 def main():
-    global args, model, model_is_onnx, model_is_ncnn
+    global args, runtime_config, model, model_is_onnx, model_is_ncnn, model_check, model_swapper, detection_cascade, memory_watchdog, trigger_zones, latency_governor, trigger_pipeline, detection_history, video_relay, clip_recorder, hard_example_harvester
 
     # MQTT client (optional)
     mqtt_client = None
@@ -811,6 +3025,7 @@ def main():
         mqtt_broker = getattr(args, 'mqtt_broker', None)
         mqtt_topic = getattr(args, 'mqtt_topic', 'nutricycle/detections')
         mqtt_esp_topic = getattr(args, 'mqtt_esp_topic', 'nutricycle/esp32')
+        esp_alert_format = getattr(args, 'esp_alert_format', 'json')
         mqtt_control_topic = getattr(args, 'mqtt_control_topic', 'nutricycle/rpi/control/+')
         mqtt_esp_command_topic = getattr(args, 'mqtt_esp_command_topic', 'nutricycle/esp32/{machineId}/command')
         mqtt_port = getattr(args, 'mqtt_port', 1883)
@@ -820,6 +3035,11 @@ def main():
 
         # Get reference to the running event loop so MQTT thread can schedule async tasks
         loop = asyncio.get_event_loop()
+        scheduler = app.get('command_scheduler') or CommandScheduler(
+            loop, getattr(args, 'safety_latency_budget_ms', 50.0)
+        )
+        mqtt_connected = asyncio.Event()
+        app['mqtt_connected'] = mqtt_connected
 
 
         # Resume or create a specific batch by batch_number
@@ -921,12 +3141,14 @@ def main():
                     pass
                 app_ref.pop('camera_keepalive_task', None)
                 logger.info(f"Stopped keepalive ({reason})")
-            await SharedCamera.release_instance()
+            # The keepalive holds a trigger-pipeline reference, not a camera one: cancelling it
+            # releases the pipeline, which closes the camera once no viewer needs it either.
 
         # Callback for handling incoming MQTT control commands
         def on_esp32_control(client, userdata, message):
             # No machine_status changes here; only batch_states are updated
             """Handle control and process-stage commands via MQTT."""
+            received_at = time.monotonic()
             try:
                 topic = message.topic
                 if topic != mqtt_control_topic and '/rpi/control/' not in topic:
@@ -940,34 +3162,77 @@ def main():
                     command = 'feed_completed'
                 logger.info(f"Received ESP32 command via MQTT: {command}")
 
-                if command == 'emergency_stop':
+                if command in SAFETY_COMMANDS:
+                    # Forward to the ESP32 straight from the MQTT thread, before any
+                    # local teardown or HTTP side effects get a chance to delay it.
+                    target_machine = payload.get('machineId') or machine_id
+                    if not target_machine:
+                        logger.error('Missing machineId for emergency stop forward')
+                    elif mqtt_client:
+                        esp_topic = mqtt_esp_command_topic.replace('{machineId}', target_machine)
+                        forward_payload = {
+                            'machine_id': target_machine,
+                            'command': command,
+                            'batchNumber': payload.get('batchNumber'),
+                            'timestamp': time.time(),
+                        }
+                        mqtt_client.publish(esp_topic, json.dumps(forward_payload), qos=mqtt_qos)
+                        scheduler.record_safety_forward(command, received_at, source='mqtt')
+
                     async def handle_emergency_stop():
+                        await stop_local_keepalive_now(app, reason=command)
+
+                    scheduler.submit_safety(handle_emergency_stop)
+
+                    batch_number = payload.get('batchNumber') or _get_last_batch_number(machine_id)
+                    if batch_number:
+                        async def patch_idle_after_stop():
+                            await patch_batch_status(batch_number, 'idle', server_url)
+                        scheduler.submit_routine(batch_number, patch_idle_after_stop, label=f'{command}:idle')
+                    return
+
+                if command in ('config', 'model_swap', 'model_rollback'):
+                    # These change what the unit detects, so they are never accepted unauthenticated.
+                    control_token = getattr(args, 'control_token', None)
+                    if not control_token:
+                        logger.warning(f"Rejected MQTT {command} command: set --control-token to enable it")
+                        return
+                    if not hmac.compare_digest(str(payload.get('token') or '').encode(), control_token.encode()):
+                        logger.warning(f"Rejected MQTT {command} command: bad or missing token")
+                        return
+
+                if command in ('model_swap', 'model_rollback'):
+                    # {"command": "model_swap", "path": "...", "force": false, "token": ...}
+                    async def handle_model():
                         try:
-                            await stop_local_keepalive_now(app, reason='emergency_stop')
-
-                            target_machine = payload.get('machineId') or machine_id
-                            if not target_machine:
-                                raise RuntimeError('Missing machineId for emergency stop forward')
-                            esp_topic = mqtt_esp_command_topic.replace('{machineId}', target_machine)
-                            forward_payload = {
-                                'machine_id': target_machine,
-                                'command': 'emergency_stop',
-                                'batchNumber': payload.get('batchNumber'),
-                                'timestamp': time.time(),
-                            }
+                            if command == 'model_rollback':
+                                model_swapper.rollback()
+                            else:
+                                model_swapper.request(payload.get('path'), force=bool(payload.get('force', False)))
+                        except (ValueError, RuntimeError) as e:
+                            logger.warning(f"MQTT {command} rejected: {e}")
 
-                            if mqtt_client:
-                                mqtt_client.publish(esp_topic, json.dumps(forward_payload), qos=mqtt_qos)
+                    scheduler.submit_routine('model', handle_model, label=command)
+                    return
 
-                            batch_number = payload.get('batchNumber') or _get_last_batch_number(machine_id)
-                            if batch_number:
-                                await patch_batch_status(batch_number, 'idle', server_url)
-                        except Exception as inner_error:
-                            logger.error(f"Emergency stop handling failed: {inner_error}", exc_info=True)
+                if command == 'config':
+                    # {"command": "config", "settings": {...}, "token": ..., "expected_version": N}
+                    async def handle_config():
+                        try:
+                            await apply_runtime_config(
+                                payload.get('settings') or {},
+                                source='mqtt',
+                                expected_version=payload.get('expected_version'),
+                            )
+                        except (ValueError, RuntimeError) as e:
+                            logger.warning(f"MQTT config command rejected: {e}")
 
-                    asyncio.run_coroutine_threadsafe(handle_emergency_stop(), loop)
+                    scheduler.submit_routine('config', handle_config, label='config')
                     return
 
+                # Routine work for one batch runs in arrival order on the same lane.
+                lane = payload.get('batchNumber') or _get_last_batch_number(machine_id)
+
                 # --- PATCH telemetry/feed fields (including estimatedWeight) to last-known batch if present ---
                 if any(k in payload for k in ('humidity', 'temperature', 'feedOutput', 'compostOutput', 'feedStatus', 'estimatedWeight')):
                     async def patch_latest_batch():
@@ -1008,7 +3273,7 @@ def main():
                                             logger.warning(f"Failed to patch batch {batch_num} on {patch_url}: {patch_resp.status} {text}")
                         except Exception as e:
                             logger.error(f"Failed to patch latest batch: {e}", exc_info=True)
-                    asyncio.run_coroutine_threadsafe(patch_latest_batch(), loop)
+                    scheduler.submit_routine(lane, patch_latest_batch, label='telemetry')
 
                 # --- CONTINUE UNFINISHED ACTIVITY LOGIC ---
                 batch_number = payload.get('batchNumber')
@@ -1016,6 +3281,12 @@ def main():
                     on_esp32_control.batch_states = {}
                 batch_states = on_esp32_control.batch_states
 
+                async def stop_keepalive_for_stop():
+                    await stop_local_keepalive_now(app, reason='stop_command')
+
+                async def stop_keepalive_for_completion():
+                    await stop_local_keepalive_now(app, reason='batch_completed')
+
                 if command == 'start':
                     async def handle_start():
                         await start_local_keepalive_now(app, reason='start_command')
@@ -1038,12 +3309,10 @@ def main():
                                 )
                         else:
                             logger.warning("Start sent but no batchNumber available")
-                    asyncio.run_coroutine_threadsafe(handle_start(), loop)
+                    # A queued start must never restart the machine after an emergency stop.
+                    scheduler.submit_routine(lane, handle_start, label='start', drop_on_safety=True)
                 elif command == 'stop' and batch_number:
-                    asyncio.run_coroutine_threadsafe(
-                        stop_local_keepalive_now(app, reason='stop_command'),
-                        loop,
-                    )
+                    scheduler.submit_routine(lane, stop_keepalive_for_stop, label='stop')
 
                     # Mark batch as idle (not finished, can be resumed)
                     if batch_number in batch_states:
@@ -1052,15 +3321,9 @@ def main():
                         batch_states[batch_number]['finished'] = False
                         # Do not mark as finished, so it can be resumed
                 elif command == 'stop':
-                    asyncio.run_coroutine_threadsafe(
-                        stop_local_keepalive_now(app, reason='stop_command'),
-                        loop,
-                    )
+                    scheduler.submit_routine(lane, stop_keepalive_for_stop, label='stop')
                 elif command in ('feed_completed', 'reset') and batch_number:
-                    asyncio.run_coroutine_threadsafe(
-                        stop_local_keepalive_now(app, reason='batch_completed'),
-                        loop,
-                    )
+                    scheduler.submit_routine(lane, stop_keepalive_for_completion, label=command)
 
                     # Mark as finished
                     machine_status = 'finished'
@@ -1069,10 +3332,7 @@ def main():
                         batch_states[batch_number]['in_progress'] = False
                         batch_states[batch_number]['status'] = 'finished'
                 elif command in ('feed_completed', 'reset'):
-                    asyncio.run_coroutine_threadsafe(
-                        stop_local_keepalive_now(app, reason='batch_completed'),
-                        loop,
-                    )
+                    scheduler.submit_routine(lane, stop_keepalive_for_completion, label=command)
 
                 # --- ORIGINAL LOGIC ---
                 if command in ('start', 'stop', 'sorting', 'sorting_compost', 'sorting_animal_feed', 'grinding', 'dehydration', 'feed_completed'):
@@ -1087,7 +3347,7 @@ def main():
                             logger.info(f"{command} received; using latest batch {resolved}. Posting to server now.")
                             stage_value = payload.get('stage') or command
                             await post_stage_update(stage_value, resolved, server_url, machine_id)
-                        asyncio.run_coroutine_threadsafe(handle_sorting(), loop)
+                        scheduler.submit_routine(lane, handle_sorting, label=command)
                     elif command in ('grinding', 'dehydration', 'feed_completed'):
                         async def handle_stage_patch():
                             resolved = await _ensure_latest_batch_number(server_url, machine_id, hint_batch_number=batch_number)
@@ -1098,7 +3358,7 @@ def main():
                             stage_value = payload.get('stage') or command
                             await post_stage_update(stage_value, resolved, server_url, machine_id)
 
-                        asyncio.run_coroutine_threadsafe(handle_stage_patch(), loop)
+                        scheduler.submit_routine(lane, handle_stage_patch, label=command)
                     elif command == 'start':
                         # Already handled above
                         pass
@@ -1106,9 +3366,9 @@ def main():
                         # For 'stop', set batch status to idle
                         if batch_number:
                             logger.info(f"Stop command received for batch {batch_number}. Setting status to 'idle' via PATCH.")
-                            asyncio.run_coroutine_threadsafe(
-                                patch_batch_status(batch_number, 'idle', server_url), loop
-                            )
+                            async def stop_given_batch():
+                                await patch_batch_status(batch_number, 'idle', server_url)
+                            scheduler.submit_routine(lane, stop_given_batch, label='stop:idle')
                         else:
                             logger.info("No batchNumber provided in ESP32 message for stop. Will stop cached latest batch.")
                             async def stop_cached_batch():
@@ -1117,7 +3377,7 @@ def main():
                                     logger.warning("No cached batch to stop.")
                                     return
                                 await patch_batch_status(cached, 'idle', server_url)
-                            asyncio.run_coroutine_threadsafe(stop_cached_batch(), loop)
+                            scheduler.submit_routine(lane, stop_cached_batch, label='stop:idle')
                 else:
                     logger.warning(f"Unknown command from ESP32: {command}")
             except Exception as e:
@@ -1207,11 +3467,25 @@ def main():
                 # Set callback for incoming control messages
                 mqtt_client.on_message = on_esp32_control
 
-                mqtt_client.connect(mqtt_broker, port=mqtt_port)
+                def on_mqtt_connect(client, userdata, *connect_args):
+                    # connect_args is (flags, rc) on the v1 callback API, (flags, reason_code, properties) on v2.
+                    rc = connect_args[1] if len(connect_args) > 1 else 0
+                    if getattr(rc, 'is_failure', rc != 0):
+                        logger.error(f"MQTT broker refused the connection: {rc}")
+                        return
+                    # (Re)subscribe on every connect so control survives broker restarts.
+                    client.subscribe(mqtt_control_topic, qos=mqtt_qos)
+                    logger.info(f"Subscribed to MQTT topic: {mqtt_control_topic}")
+                    loop.call_soon_threadsafe(mqtt_connected.set)
+
+                def on_mqtt_disconnect(client, userdata, *disconnect_args):
+                    logger.warning("MQTT broker disconnected; holding detection events until reconnect")
+                    loop.call_soon_threadsafe(mqtt_connected.clear)
+
+                mqtt_client.on_connect = on_mqtt_connect
+                mqtt_client.on_disconnect = on_mqtt_disconnect
 
-                # Subscribe to ESP32 control topic
-                mqtt_client.subscribe(mqtt_control_topic, qos=mqtt_qos)
-                logger.info(f"Subscribed to MQTT topic: {mqtt_control_topic}")
+                mqtt_client.connect(mqtt_broker, port=mqtt_port)
 
                 mqtt_client.loop_start()
                 app['mqtt_client'] = mqtt_client  # store on app for control handler
@@ -1220,108 +3494,96 @@ def main():
                 logger.error(f"Failed to connect MQTT: {e}")
                 mqtt_client = None
 
+        def _check_queued(info, qos: int) -> None:
+            # paho keeps QoS>0 messages published while disconnected (rc NO_CONN) and sends them
+            # on reconnect; only a message it did not queue needs another attempt.
+            if info.rc != paho.MQTT_ERR_SUCCESS and not (info.rc == paho.MQTT_ERR_NO_CONN and qos > 0):
+                raise RuntimeError(f"publish not queued, rc={info.rc}")
+
         while True:
-            evt = await event_queue.get()
-            msg = json.dumps(evt)
-            # Publish to MQTT
-            if mqtt_client:
-                try:
-                    mqtt_client.publish(mqtt_topic, msg, qos=mqtt_qos)
-                    # Publish compact state to ESP32: 1 when detected, 0 when clear.
-                    mqtt_client.publish(
-                        mqtt_esp_topic,
-                        json.dumps({
-                            'machine_id': evt.get('machine_id'),
-                            'alert': 1 if evt.get('has_detection') else 0,
-                        }),
-                        qos=1,
-                    )
-                except Exception as e:
-                    logger.warning(f"MQTT publish failed: {e}")
-            # Log one line per transition only.
-            logger.info(
-                f"Detection state: {'1 (detected)' if evt.get('has_detection') else '0 (clear)'} "
-                f"machine={evt.get('machine_id')} line_mode={evt.get('line_trigger_enabled')}"
-            )
+            batch = await event_queue.get_batch()
+            if mqtt_client and not mqtt_connected.is_set():
+                # Hold events while the broker is away; they are merged and sent on reconnect.
+                event_queue.requeue(batch)
+                await mqtt_connected.wait()
+                continue
+
+            events = event_queue.coalesce_zones(batch)
+            for i, evt in enumerate(events):
+                zone = evt.get('zone')
+                esp_topic = evt.get('zone_topic') or (f"{mqtt_esp_topic}/{zone}" if zone else mqtt_esp_topic)
+                if mqtt_client and esp_alert_format != 'json' and 'alert_seq' not in evt:
+                    # Numbered once per event: a retried publish repeats the same seq, which the
+                    # device can drop as a duplicate instead of counting a lost alert.
+                    evt['alert_seq'] = alert_sequencer.next(esp_topic)
+                # Publish to MQTT: the full event, then compact state to the ESP32 (1 detected, 0 clear).
+                # A retry skips whichever of the two paho already accepted ('_sent').
+                if mqtt_client:
+                    sent = evt.setdefault('_sent', [])
+                    try:
+                        if 'telemetry' not in sent:
+                            msg = json.dumps({k: v for k, v in evt.items() if k != '_sent'})
+                            _check_queued(mqtt_client.publish(mqtt_topic, msg, qos=mqtt_qos), mqtt_qos)
+                            sent.append('telemetry')
+                        if 'esp' not in sent:
+                            if esp_alert_format == 'json':
+                                esp_payload = {
+                                    'machine_id': evt.get('machine_id'),
+                                    'alert': 1 if evt.get('has_detection') else 0,
+                                }
+                                if zone:
+                                    esp_payload['zone'] = zone
+                                esp_payload = json.dumps(esp_payload)
+                            else:
+                                esp_payload = encode_alert(
+                                    esp_alert_format,
+                                    evt['alert_seq'],
+                                    bool(evt.get('has_detection')),
+                                    capture_ts=evt.get('capture_timestamp') or evt.get('timestamp'),
+                                    publish_ts=time.time(),
+                                    zone_mask=evt.get('zone_mask', 0),
+                                )
+                            _check_queued(mqtt_client.publish(esp_topic, esp_payload, qos=1), 1)
+                            sent.append('esp')
+                    except Exception as e:
+                        logger.warning(f"MQTT publish failed: {e}")
+                        # Keep the newest state for the next attempt rather than losing it.
+                        event_queue.requeue(events[i:])
+                        await asyncio.sleep(0.5)
+                        break
+                event_queue.mark_published()
+                if mqtt_client and latency_governor is not None:
+                    latency_governor.observe_publish(evt)
+                # Log one line per transition only.
+                logger.info(
+                    f"Detection state: {'1 (detected)' if evt.get('has_detection') else '0 (clear)'} "
+                    f"machine={evt.get('machine_id')} line_mode={evt.get('line_trigger_enabled')}"
+                    + (f" zone={zone}" if zone else '')
+                    + (f" merged={evt['coalesced']}" if evt.get('coalesced') else '')
+                )
 
     # will register these tasks later on app startup
 
 
     async def camera_keepalive(app):
-        """Continuously read camera frames and run YOLO inference even with no clients.
-        This keeps the SharedCamera instance alive and publishes detection events to the
-        existing event_queue so other systems (MQTT, logs) keep receiving detections.
+        """Keep the trigger pipeline running (camera + YOLO inference) even with no clients.
+        Detection events keep flowing to the existing event_queue so other systems (MQTT,
+        logs) receive them; without viewers the pipeline idles at --keepalive-fps.
         """
         try:
-            camera = await SharedCamera.get_instance(args.source)
+            await trigger_pipeline.acquire()
         except RuntimeError as e:
             logger.error(f"Keepalive failed to open camera: {e}")
             return
 
         logger.info("🔁 Camera keepalive started (persistent mode)")
         try:
-            # run at a lower FPS than live streaming to reduce CPU; configurable via --keepalive-fps
-            interval = 1.0 / max(1, getattr(args, 'keepalive_fps', 2))
-            while True:
-                loop = asyncio.get_event_loop()
-                ret, frame = await loop.run_in_executor(None, camera.read)
-                if not ret:
-                    await asyncio.sleep(0.1)
-                    continue
-
-                try:
-                    t0 = time.time()
-                    results = _run_model_inference(frame, conf_threshold=args.conf, imgsz=args.imgsz)
-                    inference_time = time.time() - t0
-
-                    annotated = results[0].plot()
-
-                    # Update latest annotated frame for instant preview
-                    try:
-                        ret, buf = cv2.imencode('.jpg', annotated)
-                        if ret:
-                            async with latest_frame_lock:
-                                globals()['latest_frame_jpeg'] = buf.tobytes()
-                    except Exception:
-                        pass
-
-                    dets = []
-                    for b in results[0].boxes:
-                        try:
-                            xyxy = _normalize_xyxy(b.xyxy.tolist() if hasattr(b, 'xyxy') else None)
-                            dets.append({
-                                'cls': int(b.cls),
-                                'name': model.names[int(b.cls)] if hasattr(model, 'names') else str(int(b.cls)),
-                                'conf': float(b.conf),
-                                'xyxy': xyxy,
-                            })
-                        except Exception:
-                            continue
-
-                    _draw_trigger_overlay(annotated, dets)
-
-                    await _enqueue_detection_state_if_changed(
-                        dets=dets,
-                        width=camera.width,
-                        height=camera.height,
-                        frame_id=None,
-                        queue=event_queue,
-                    )
-
-                    # throttle keepalive loop to configured FPS
-                    await asyncio.sleep(interval)
-
-                except asyncio.CancelledError:
-                    break
-                except Exception as e:
-                    logger.warning(f"Keepalive inference error: {e}")
-                    await asyncio.sleep(1.0)
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            pass
         finally:
-            # Ensure the camera reference is released when the keepalive task stops
-            try:
-                await SharedCamera.release_instance()
-            except Exception:
-                pass
+            # Drop the keepalive reference; the pipeline stops once viewers are gone too.
+            trigger_pipeline.release()
             logger.info("🔁 Camera keepalive stopped")
 
 
@@ -1375,13 +3637,72 @@ def main():
     parser = argparse.ArgumentParser(description="WebRTC YOLO streaming server", parents=[bootstrap_parser])
     parser.add_argument("--model", default=os.environ.get("MODEL_PATH", "AI-Model/runs/detect/nutricycle_foreign_only/weights/best.pt"),
                         help="Path to YOLO model (.pt, .onnx, or NCNN export directory)")
-    parser.add_argument("--source", default=os.environ.get("VIDEO_SOURCE", "0"), help="Camera index or video file path")
+    parser.add_argument("--model-reference", default=os.environ.get("MODEL_REFERENCE_PATH") or None,
+                        help="fp32 model to compare --model against at startup (e.g. when --model is an INT8 export)")
+    parser.add_argument("--model-check-dir", default=os.environ.get("MODEL_CHECK_DIR") or None,
+                        help="Reference images for the --model-reference agreement check")
+    parser.add_argument("--model-check-images", type=int, default=_env_int("MODEL_CHECK_IMAGES", 50),
+                        help="Number of reference images used by the startup model check")
+    parser.add_argument("--model-check-min-recall", type=float, default=_env_float("MODEL_CHECK_MIN_RECALL", 0.9),
+                        help="Fall back to --model-reference when --model reproduces fewer of its detections than this")
+    parser.add_argument("--model-swap-frames", type=int, default=_env_int("MODEL_SWAP_FRAMES", 20),
+                        help="Live frames a hot-swapped model must match the current one on (POST /model)")
+    parser.add_argument("--model-swap-warmup", type=int, default=_env_int("MODEL_SWAP_WARMUP", 3),
+                        help="Live frames used to warm up a hot-swapped model before validation")
+    parser.add_argument("--model-swap-min-precision", type=float, default=_env_float("MODEL_SWAP_MIN_PRECISION", 0.8),
+                        help="Reject a hot-swapped model when fewer of its boxes than this match the current model's")
+    parser.add_argument("--model-swap-min-boxes", type=int, default=_env_int("MODEL_SWAP_MIN_BOXES", 10),
+                        help="Reference boxes a hot-swap or startup --model-reference check needs before it is conclusive "
+                             "(hot-swap sampling continues until then; startup falls back to the reference)")
+    parser.add_argument("--source", default=os.environ.get("VIDEO_SOURCE", "0"), help="Camera index, video file path, or a synthetic source: synthetic:belt?fps=15, replay:<video|image dir>?fps=10 (see frame_sources.py)")
     parser.add_argument("--conf", type=float, default=_env_float("CONFIDENCE", 0.5), help="Confidence threshold")
-    parser.add_argument("--flip", choices=['none', 'vertical', 'horizontal', '180'], default=os.environ.get("FLIP_MODE", "none"),
+    parser.add_argument("--flip", choices=FLIP_MODES, default=os.environ.get("FLIP_MODE", "none"),
                         help="Flip video: vertical=upside-down, horizontal, 180=rotate 180")
     parser.add_argument("--imgsz", type=int, default=_env_int("INFERENCE_IMGSZ", 320), help="Inference image size (pixels)")
+    parser.add_argument("--cascade", action="store_true", default=_env_bool("CASCADE", False),
+                        help="Two-stage detection: cheap first pass on every frame, --imgsz pass only on candidates")
+    parser.add_argument("--cascade-imgsz", type=int, default=_env_int("CASCADE_IMGSZ", 192),
+                        help="First-pass image size (ignored for a fixed-shape --cascade-model)")
+    parser.add_argument("--cascade-model", default=os.environ.get("CASCADE_MODEL") or None,
+                        help="Optional smaller model for the first pass (defaults to --model)")
+    parser.add_argument("--cascade-conf", type=float, default=_env_float("CASCADE_CONF", 0.15),
+                        help="First-pass confidence at which a box becomes a candidate")
+    parser.add_argument("--cascade-margin", type=float, default=_env_float("CASCADE_MARGIN", 0.15),
+                        help="Candidates below --conf + margin are re-checked by the second pass")
     parser.add_argument("--capture-width", type=int, default=_env_int("CAPTURE_WIDTH", 640), help="Camera capture width (stream clarity)")
     parser.add_argument("--capture-height", type=int, default=_env_int("CAPTURE_HEIGHT", 480), help="Camera capture height (stream clarity)")
+    parser.add_argument("--camera-flip", choices=['auto', 'software'], default=os.environ.get("CAMERA_FLIP", "auto"),
+                        help="auto: apply --flip via V4L2 camera controls when supported; software: always flip on the CPU")
+    parser.add_argument("--camera-linger", type=float, default=_env_float("CAMERA_LINGER", 30.0),
+                        help="Seconds to keep the camera open after the last user leaves (0 = release immediately)")
+    parser.add_argument("--camera-linger-drain-fps", type=float, default=_env_float("CAMERA_LINGER_DRAIN_FPS", 2.0),
+                        help="Frames per second grabbed and discarded while the camera lingers")
+    parser.add_argument("--annotate", choices=['server', 'client'], default=os.environ.get("ANNOTATE_MODE", "server"),
+                        help="server: burn boxes into frames; client: send raw frames and stream boxes over /ws for browser overlays")
+    parser.add_argument("--mjpeg-max-fps", type=float, default=_env_float("MJPEG_MAX_FPS", 10.0),
+                        help="Upper bound on /mjpeg frame rate per client (clients may ask for less with ?fps=; 0 = unlimited)")
+    parser.add_argument("--max-webrtc-peers", type=int, default=_env_int("MAX_WEBRTC_PEERS", 4),
+                        help="Concurrent WebRTC viewers allowed (0 = unlimited); extra offers get 503 + MJPEG fallback hint")
+    parser.add_argument("--max-mjpeg-clients", type=int, default=_env_int("MAX_MJPEG_CLIENTS", 8),
+                        help="Concurrent /mjpeg viewers allowed (0 = unlimited)")
+    parser.add_argument("--peer-idle-timeout", type=float, default=_env_float("PEER_IDLE_TIMEOUT", 60.0),
+                        help="Seconds before a peer that is not connected or not pulling frames is evicted (0 disables)")
+    parser.add_argument("--viewer-retry-after", type=int, default=_env_int("VIEWER_RETRY_AFTER", 30),
+                        help="Retry-After seconds sent with 503 when viewer limits are reached")
+    parser.add_argument("--viewer-min-fps", type=float, default=_env_float("VIEWER_MIN_FPS", 5.0),
+                        help="Frame rate viewers (WebRTC, /mjpeg) drop to while the trigger path needs the CPU")
+    parser.add_argument("--viewer-yield-load", type=float, default=_env_float("VIEWER_YIELD_LOAD", 0.7),
+                        help="Fraction of the frame interval spent in trigger inference above which viewers yield")
+    parser.add_argument("--webrtc-relay", action="store_true", default=_env_bool("WEBRTC_RELAY", False),
+                        help="Encode the stream once (H.264) and relay packets to all WebRTC peers")
+    parser.add_argument("--relay-encoder", default=os.environ.get("RELAY_ENCODER", "libx264"),
+                        help="FFmpeg H.264 encoder for relay mode (e.g. libx264, h264_v4l2m2m on Raspberry Pi)")
+    parser.add_argument("--relay-bitrate-kbps", type=int, default=_env_int("RELAY_BITRATE_KBPS", 600),
+                        help="Initial relay bitrate; adapted between --relay-min/max-kbps from receiver loss")
+    parser.add_argument("--relay-min-kbps", type=int, default=_env_int("RELAY_MIN_KBPS", 150), help="Relay bitrate floor")
+    parser.add_argument("--relay-max-kbps", type=int, default=_env_int("RELAY_MAX_KBPS", 1500), help="Relay bitrate ceiling")
+    parser.add_argument("--relay-keyframe-interval", type=float, default=_env_float("RELAY_KEYFRAME_INTERVAL", 2.0),
+                        help="Seconds between periodic keyframes in relay mode (new peers also request one)")
     parser.add_argument("--host", default=os.environ.get("WEBRTC_HOST", "0.0.0.0"), help="Server host")
     parser.add_argument("--port", type=int, default=_env_int("WEBRTC_PORT", 8080), help="Server port")
     parser.add_argument("--announce-server", default=os.environ.get("ANNOUNCE_SERVER", None), help="HTTP endpoint to POST machine_id + video URL")
@@ -1393,6 +3714,47 @@ def main():
     parser.add_argument("--status-update-interval", type=int, default=_env_int("STATUS_UPDATE_INTERVAL", 60), help="Seconds between machine status updates to API")
     parser.add_argument("--persistent", action="store_true", default=_env_bool("PERSISTENT", False), help="Keep camera + inference running even when no clients are connected")
     parser.add_argument("--keepalive-fps", type=int, default=_env_int("KEEPALIVE_FPS", 2), help="FPS to run background inference when persistent (default: 2)")
+    parser.add_argument("--history-capacity", type=int, default=_env_int("DETECTION_HISTORY_CAPACITY", 65536),
+                        help="Per-frame detection summaries kept in memory for /detections (0 disables)")
+    parser.add_argument("--history-dir", default=os.environ.get("DETECTION_HISTORY_DIR", None),
+                        help="Directory to spill detection history segments to (keeps history across restarts)")
+    parser.add_argument("--history-segment-size", type=int, default=_env_int("DETECTION_HISTORY_SEGMENT_SIZE", 4096),
+                        help="Rows per spilled history segment")
+    parser.add_argument("--history-max-mb", type=float, default=_env_float("DETECTION_HISTORY_MAX_MB", 200.0),
+                        help="Disk cap for spilled history segments (oldest deleted first)")
+    parser.add_argument("--history-max-window", type=float, default=_env_float("DETECTION_HISTORY_MAX_WINDOW_S", 86400.0),
+                        help="Longest time range one /detections query covers; also the default when since is omitted (0 = unlimited)")
+    parser.add_argument("--clip-dir", default=os.environ.get("CLIP_DIR") or None,
+                        help="Save pre/post-roll clips around trigger transitions here (unset = disabled)")
+    parser.add_argument("--clip-pre-seconds", type=float, default=_env_float("CLIP_PRE_SECONDS", 5.0),
+                        help="Seconds of video kept before each trigger transition")
+    parser.add_argument("--clip-post-seconds", type=float, default=_env_float("CLIP_POST_SECONDS", 3.0),
+                        help="Seconds of video recorded after each trigger transition")
+    parser.add_argument("--clip-fps", type=float, default=_env_float("CLIP_FPS", 5.0),
+                        help="Frame rate sampled into the clip ring buffer")
+    parser.add_argument("--clip-buffer-mb", type=float, default=_env_float("CLIP_BUFFER_MB", 32.0),
+                        help="Memory cap for the in-memory pre-roll ring (compressed JPEGs)")
+    parser.add_argument("--clip-max-mb", type=float, default=_env_float("CLIP_MAX_MB", 500.0),
+                        help="Disk quota for saved clips (oldest deleted first)")
+    parser.add_argument("--harvest-dir", default=os.environ.get("HARVEST_DIR") or None,
+                        help="Save borderline/flickering frames with YOLO labels here for retraining (unset = disabled)")
+    parser.add_argument("--harvest-band", type=float, default=_env_float("HARVEST_BAND", 0.1),
+                        help="Harvest frames with a detection whose confidence is within this band above --conf")
+    parser.add_argument("--harvest-flicker-s", type=float, default=_env_float("HARVEST_FLICKER_S", 2.0),
+                        help="Harvest frames where the trigger toggles again within this many seconds")
+    parser.add_argument("--harvest-min-interval", type=float, default=_env_float("HARVEST_MIN_INTERVAL", 5.0),
+                        help="Minimum seconds between harvested frames")
+    parser.add_argument("--harvest-max-mb", type=float, default=_env_float("HARVEST_MAX_MB", 1000.0),
+                        help="Disk cap for harvested examples (oldest deleted first)")
+    parser.add_argument("--memory-watchdog-mb", type=float, default=_env_float("MEMORY_WATCHDOG_MB", 0.0),
+                        help="Log the fastest-growing object types once RSS reaches this many MB (0 = off)")
+    parser.add_argument("--memory-watchdog-step-mb", type=float, default=_env_float("MEMORY_WATCHDOG_STEP_MB", 64.0),
+                        help="Log again after every further this many MB of RSS growth")
+    parser.add_argument("--memory-watchdog-interval", type=float, default=_env_float("MEMORY_WATCHDOG_INTERVAL", 60.0),
+                        help="Seconds between watchdog samples (RSS, fds, threads, gc object total)")
+    parser.add_argument("--debug-memory-idle-s", type=float, default=_env_float("DEBUG_MEMORY_IDLE_S", 600.0),
+                        help="Stop the tracemalloc tracing started by /debug/memory after this many seconds "
+                             "without another report (0 = keep tracing until ?stop=1)")
     parser.add_argument("--line-trigger-enabled", action="store_true",
                         default=_env_bool("LINE_TRIGGER_ENABLED", False),
                         help="Enable horizontal trigger line mode for ESP32 ON/OFF signaling")
@@ -1406,17 +3768,32 @@ def main():
                         help="Min confidence for line trigger checks (defaults to --conf)")
     parser.add_argument("--trigger-class", type=int, default=_env_optional_int("TRIGGER_CLASS"),
                         help="Optional class id filter for trigger checks")
+    parser.add_argument("--trigger-zones", default=os.environ.get("TRIGGER_ZONES") or None,
+                        help="JSON file (or inline JSON list) of polygon / slanted-line trigger zones; overrides the single trigger line")
     
     # MQTT options
     parser.add_argument("--mqtt-broker", default=os.environ.get("MQTT_BROKER", None), help="MQTT broker host (optional)")
     parser.add_argument("--mqtt-port", type=int, default=_env_int("MQTT_PORT", 1883), help="MQTT broker port")
     parser.add_argument("--mqtt-topic", default=os.environ.get("MQTT_TOPIC", "nutricycle/detections"), help="MQTT topic for detection events")
     parser.add_argument("--mqtt-esp-topic", default=os.environ.get("MQTT_ESP_TOPIC", "nutricycle/esp32"), help="MQTT topic to send compact alerts to ESP32")
+    parser.add_argument("--esp-alert-format", choices=ALERT_FORMATS, default=os.environ.get("ESP_ALERT_FORMAT", "json"),
+                        help="Payload format on --mqtt-esp-topic: json (legacy), binary or csv (sequenced, see esp_alert_protocol.py)")
     parser.add_argument("--mqtt-control-topic", default=os.environ.get("MQTT_CONTROL_TOPIC", "nutricycle/rpi/control/+"), help="MQTT topic to receive control commands for this Raspberry Pi")
     parser.add_argument("--mqtt-esp-command-topic", default=os.environ.get("MQTT_ESP_COMMAND_TOPIC", "nutricycle/esp32/{machineId}/command"), help="MQTT topic template for forwarding machine commands to ESP32")
     parser.add_argument("--mqtt-username", default=os.environ.get("MQTT_USERNAME", None), help="MQTT username")
     parser.add_argument("--mqtt-password", default=os.environ.get("MQTT_PASSWORD", None), help="MQTT password")
     parser.add_argument("--mqtt-qos", type=int, default=_env_int("MQTT_QOS", 1), help="MQTT QoS")
+    parser.add_argument("--latency-budget-ms", type=float, default=_env_float("LATENCY_BUDGET_MS", 0.0),
+                        help="Capture-to-MQTT-publish trigger budget; when exceeded, lower stream resolution, "
+                             "then inference cadence, then imgsz (0 disables)")
+    parser.add_argument("--latency-min-imgsz", type=int, default=_env_int("LATENCY_MIN_IMGSZ", 192),
+                        help="Smallest imgsz the latency governor may fall back to")
+    parser.add_argument("--latency-headroom", type=float, default=_env_float("LATENCY_HEADROOM", 0.6),
+                        help="Step quality back up once latency stays under this fraction of the budget")
+    parser.add_argument("--latency-recover-s", type=float, default=_env_float("LATENCY_RECOVER_S", 10.0),
+                        help="Seconds of headroom required before each step back up")
+    parser.add_argument("--safety-latency-budget-ms", type=float, default=_env_float("SAFETY_LATENCY_BUDGET_MS", 50.0),
+                        help="Hard budget for emergency_stop receive-to-ESP32-forward latency (logged when exceeded)")
     parser.add_argument("--control-token", default=os.environ.get("CONTROL_TOKEN", None), help="Bearer token required for /control HTTP POSTs")
     parser.add_argument("--server-url", default=os.environ.get("SERVER_URL", "http://localhost:4000"), help="URL of NutriCycle server for batch creation")
     parser.add_argument(
@@ -1436,6 +3813,11 @@ def main():
 
     # Clamp line position so bad values don't break trigger logic.
     args.trigger_line_y = max(0.0, min(1.0, float(args.trigger_line_y)))
+    try:
+        runtime_config = RuntimeConfig.from_args(args)
+    except ValueError as e:
+        logger.error(f"Invalid setting: {e}")
+        sys.exit(1)
     args.ice_stun_urls = _parse_csv(args.ice_stun_urls)
 
     if not args.ice_stun_urls:
@@ -1476,20 +3858,75 @@ def main():
                 logger.error("onnxruntime not installed and no .pt fallback found")
                 sys.exit(1)
     
-    model_is_ncnn = _is_ncnn_export_path(model_path)
     logger.info(f"Loading model: {model_path}")
-    if model_is_ncnn:
-        model = YOLO(model_path, task='detect')
-    else:
-        model = YOLO(model_path)
-    model_is_onnx = model_path.lower().endswith('.onnx')
+    model, model_is_onnx, model_is_ncnn = _load_model(model_path)
     logger.info(f"Model loaded. Classes: {model.names}")
+
+    if args.model_reference and args.model_check_dir:
+        # Typically an INT8 export checked against its fp32 source before it drives the diverter.
+        from quantize_model import collect_images, compare_models
+
+        try:
+            reference_is_ncnn = _is_ncnn_export_path(args.model_reference)
+            reference = YOLO(args.model_reference, task='detect')
+            model_check = compare_models(
+                model,
+                reference,
+                collect_images([args.model_check_dir], limit=args.model_check_images),
+                imgsz=args.imgsz,
+                conf=args.conf,
+                candidate_fixed=model_is_onnx or model_is_ncnn,
+                reference_fixed=reference_is_ncnn or args.model_reference.lower().endswith('.onnx'),
+                min_reference_boxes=args.model_swap_min_boxes,
+            )
+            model_check['passed'] = (
+                not model_check['inconclusive'] and model_check['recall'] >= args.model_check_min_recall
+            )
+            logger.info(f"Model check vs {args.model_reference}: {model_check}")
+            if not model_check['passed']:
+                # An unverified model never drives the diverter: too few reference boxes also falls back.
+                if model_check['inconclusive']:
+                    reason = (f"the check is inconclusive ({model_check['reference_boxes']} reference boxes on "
+                              f"{model_check['images']} images, < {args.model_swap_min_boxes})")
+                else:
+                    reason = (f"it reproduces only {model_check['recall']:.1%} of reference detections "
+                              f"(< {args.model_check_min_recall:.0%})")
+                logger.error(f"❌ {model_path} not verified: {reason}; falling back to {args.model_reference}")
+                model_path = args.model_reference
+                model = reference
+                model_is_ncnn = reference_is_ncnn
+                model_is_onnx = model_path.lower().endswith('.onnx')
+        except Exception as e:
+            logger.error(f"Model check failed to run: {e}")
+            model_check = {'error': str(e)}
+    model_swapper = ModelSwapper(
+        model_path,
+        min_recall=args.model_check_min_recall,
+        min_precision=args.model_swap_min_precision,
+        min_boxes=args.model_swap_min_boxes,
+        sample_frames=args.model_swap_frames,
+        warmup_frames=args.model_swap_warmup,
+    )
     if model_is_onnx:
         logger.info("ONNX model detected: ignoring --imgsz at runtime to avoid fixed-shape mismatch")
     if model_is_ncnn:
         logger.info("NCNN model detected: running detect task with Ultralytics NCNN backend")
 
-    if args.line_trigger_enabled:
+    if args.trigger_zones:
+        try:
+            trigger_zones = TriggerZones.from_config(
+                args.trigger_zones,
+                default_min_conf=args.trigger_min_conf if args.trigger_min_conf is not None else args.conf,
+                default_stable_frames=args.trigger_stable_frames,
+            )
+        except Exception as e:
+            logger.error(f"Invalid --trigger-zones: {e}")
+            sys.exit(1)
+        logger.info(
+            "Trigger zones enabled: "
+            + ", ".join(f"{z['name']}(class={z['cls']}, stable={z['stable_frames']})" for z in trigger_zones.zones)
+        )
+    elif args.line_trigger_enabled:
         trig_conf = args.trigger_min_conf if args.trigger_min_conf is not None else args.conf
         logger.info(
             f"Line trigger enabled: horizontal_y={args.trigger_line_y:.3f} "
@@ -1498,13 +3935,119 @@ def main():
         )
     else:
         logger.info("Line trigger disabled: state changes use full-frame detections")
+
+    if args.cascade:
+        stage1_model, stage1_onnx = None, False
+        if args.cascade_model:
+            stage1_model, stage1_onnx, _ = _load_model(args.cascade_model)
+            logger.info(f"Cascade stage-1 model: {args.cascade_model}")
+        if stage1_model is None and (model_is_onnx or model_is_ncnn):
+            logger.warning("--cascade needs --cascade-model with a fixed-shape main model (imgsz cannot change); cascade disabled")
+        else:
+            detection_cascade = DetectionCascade(
+                stage1_imgsz=args.cascade_imgsz,
+                candidate_conf=args.cascade_conf,
+                margin=args.cascade_margin,
+                stage1_model=stage1_model,
+                stage1_onnx=stage1_onnx,
+            )
+            logger.info(
+                f"Detection cascade enabled: stage 1 at {args.cascade_imgsz}px (candidates >= {args.cascade_conf}), "
+                f"stage 2 at imgsz on crops near threshold (+{args.cascade_margin}) or in the trigger region"
+            )
+
+    if args.latency_budget_ms > 0:
+        latency_governor = LatencyGovernor(
+            budget_ms=args.latency_budget_ms,
+            imgsz=args.imgsz,
+            min_imgsz=args.latency_min_imgsz,
+            # Fixed-shape exports cannot change input size at runtime.
+            fixed_imgsz=model_is_onnx or model_is_ncnn,
+            headroom=args.latency_headroom,
+            recover_s=args.latency_recover_s,
+        )
+        logger.info(
+            f"Latency governor enabled: budget={args.latency_budget_ms:.0f}ms "
+            f"levels={len(latency_governor.levels)} (stream resolution -> inference cadence -> imgsz)"
+        )
+
+    trigger_pipeline = TriggerPipeline(
+        args.source,
+        idle_fps=args.keepalive_fps,
+        viewer_min_fps=args.viewer_min_fps,
+        yield_load=args.viewer_yield_load,
+    )
+
+    if args.webrtc_relay:
+        video_relay = VideoRelay(
+            bitrate_kbps=args.relay_bitrate_kbps,
+            min_kbps=args.relay_min_kbps,
+            max_kbps=args.relay_max_kbps,
+            keyframe_interval=args.relay_keyframe_interval,
+            encoder=args.relay_encoder,
+        )
+        logger.info(
+            f"WebRTC relay enabled: encoder={args.relay_encoder} bitrate={args.relay_bitrate_kbps}kbps "
+            f"(one encode shared by all peers, H.264 only)"
+        )
+
+    if args.history_capacity > 0:
+        detection_history = DetectionHistory(
+            capacity=args.history_capacity,
+            spill_dir=args.history_dir,
+            segment_size=args.history_segment_size,
+            max_disk_mb=args.history_max_mb,
+        )
+        # Warm the batch cache so history rows are tagged without per-frame file reads.
+        _get_last_batch_number(args.machine_id)
+        logger.info(
+            f"Detection history enabled: capacity={args.history_capacity} "
+            f"spill_dir={args.history_dir or 'none'}"
+        )
     
+    if args.clip_dir:
+        clip_recorder = ClipRecorder(
+            out_dir=args.clip_dir,
+            pre_s=args.clip_pre_seconds,
+            post_s=args.clip_post_seconds,
+            fps=args.clip_fps,
+            buffer_mb=args.clip_buffer_mb,
+            max_disk_mb=args.clip_max_mb,
+            machine_id=args.machine_id,
+        )
+        logger.info(
+            f"Trigger clip recorder enabled: {args.clip_pre_seconds}s pre / {args.clip_post_seconds}s post "
+            f"@ {args.clip_fps}fps -> {args.clip_dir}"
+        )
+
+    if args.memory_watchdog_mb > 0:
+        memory_watchdog = MemoryWatchdog(args.memory_watchdog_mb, args.memory_watchdog_step_mb, logger=logger)
+        logger.info(
+            f"Memory watchdog enabled: object census at {args.memory_watchdog_mb:.0f} MB RSS, "
+            f"then every +{args.memory_watchdog_step_mb:.0f} MB (sampling every {args.memory_watchdog_interval:.0f}s)"
+        )
+
+    if args.harvest_dir:
+        hard_example_harvester = HardExampleHarvester(
+            out_dir=args.harvest_dir,
+            conf=args.conf,
+            band=args.harvest_band,
+            flicker_s=args.harvest_flicker_s,
+            min_interval_s=args.harvest_min_interval,
+            max_disk_mb=args.harvest_max_mb,
+        )
+        logger.info(
+            f"Hard-example harvester enabled: conf {args.conf:.2f}-{args.conf + args.harvest_band:.2f}, "
+            f"flicker < {args.harvest_flicker_s}s, at most one frame per {args.harvest_min_interval}s -> {args.harvest_dir}"
+        )
+
     # Test camera access before starting server
     logger.info(f"Testing camera access: {args.source}")
     try:
         test_backend = cv2.CAP_V4L2 if os.name != 'nt' else cv2.CAP_DSHOW
-        test_cap = cv2.VideoCapture(args.source if isinstance(args.source, int) else args.source, 
-                                     test_backend if isinstance(args.source, int) else cv2.CAP_ANY)
+        test_cap = open_frame_source(args.source) or cv2.VideoCapture(
+            args.source, test_backend if isinstance(args.source, int) else cv2.CAP_ANY,
+        )
         if not test_cap.isOpened():
             logger.error(f"❌ Cannot access camera: {args.source}")
             logger.error("Troubleshooting tips:")
@@ -1529,17 +4072,69 @@ def main():
     app.on_shutdown.append(on_shutdown)
     app.router.add_get("/", index)
     app.router.add_post("/offer", offer)
-    # WebSocket endpoint for registration/debugging (optional)
+    # WebSocket endpoint: detection metadata subscription (clients draw overlays), echo otherwise
     async def ws_handler(request):
-        ws = web.WebSocketResponse()
+        ws = web.WebSocketResponse(heartbeat=30)
         await ws.prepare(request)
         logger.info('WebSocket client connected')
+        sender = None
+
+        async def stream_detections():
+            detection_metadata.subscribers += 1
+            try:
+                version = detection_metadata.version
+                while not ws.closed:
+                    # Latest-wins: a slow client skips frames instead of queueing them.
+                    version, payload = await detection_metadata.wait_newer(version)
+                    await ws.send_str(payload)
+            except (ConnectionResetError, RuntimeError, asyncio.CancelledError):
+                pass
+            finally:
+                detection_metadata.subscribers -= 1
+
+        async def send_config():
+            names = getattr(model, 'names', None) or {}
+            await ws.send_json({
+                'type': 'config',
+                'annotate': getattr(args, 'annotate', 'server'),
+                'names': dict(enumerate(names)) if isinstance(names, (list, tuple)) else dict(names),
+                'config_version': runtime_config.version,
+                'line_trigger_enabled': runtime_config.line_trigger_enabled,
+                'trigger_line_y': runtime_config.trigger_line_y,
+                'after_line_side': runtime_config.after_line_side,
+                'zones': trigger_zones.client_config() if trigger_zones else None,
+            })
+
+        async def subscribe():
+            nonlocal sender
+            if sender is None:
+                await send_config()
+                sender = asyncio.create_task(stream_detections())
+
         try:
+            if request.query.get('subscribe') == 'detections':
+                await subscribe()
             async for msg in ws:
-                if msg.type == web.WSMsgType.TEXT:
-                    # Echo or possibly send control commands later
+                if msg.type != web.WSMsgType.TEXT:
+                    continue
+                try:
+                    data = json.loads(msg.data)
+                except ValueError:
+                    data = None
+                action = data.get('type') if isinstance(data, dict) else None
+                if action == 'config':
+                    await send_config()
+                elif action == 'subscribe' and data.get('channel', 'detections') == 'detections':
+                    await subscribe()
+                elif action == 'unsubscribe' and sender is not None:
+                    sender.cancel()
+                    sender = None
+                else:
+                    # Echo for registration/debugging clients
                     await ws.send_str(msg.data)
         finally:
+            if sender is not None:
+                sender.cancel()
             logger.info('WebSocket client disconnected')
         return ws
 
@@ -1547,19 +4142,16 @@ def main():
 
     # Control endpoint: accepts POST from Node server to command machine (start/stop/pause/reset)
     async def control_handler(request):
+        received_at = time.monotonic()
         try:
             data = await request.json()
         except Exception:
             return web.Response(status=400, text="Invalid JSON")
 
         # Authorization (optional)
-        if getattr(args, 'control_token', None):
-            auth = request.headers.get('Authorization', '')
-            if not auth.startswith('Bearer '):
-                return web.Response(status=401, text='Missing Authorization')
-            token = auth.split(None, 1)[1]
-            if token != args.control_token:
-                return web.Response(status=403, text='Forbidden')
+        auth_error = _control_auth_error(request)
+        if auth_error is not None:
+            return auth_error
 
         machine_id = data.get('machine_id') or data.get('machineId')
         if machine_id != args.machine_id:
@@ -1574,9 +4166,46 @@ def main():
         # Normalize stop-like commands so local and ESP32 behavior is consistent.
         normalized_cmd = 'emergency_stop' if cmd in ('stop', 'emergency_stop') else cmd
 
-        # Local control actions: execute immediately via HTTP path before forwarding to ESP32.
+        mqtt_client = request.app.get('mqtt_client')
+        esp_topic_template = getattr(args, 'mqtt_esp_command_topic', 'nutricycle/esp32/{machineId}/command')
+        esp_topic = esp_topic_template.replace('{machineId}', machine_id)
+        payload = {
+            'machine_id': machine_id,
+            'machineId': machine_id,
+            'command': normalized_cmd,
+            'timestamp': time.time(),
+            'source': 'http_control',
+        }
+
+        forwarded = False
+        dispatch_error = None
+
+        def forward_to_esp32():
+            nonlocal forwarded, dispatch_error
+            if mqtt_client:
+                try:
+                    mqtt_client.publish(esp_topic, json.dumps(payload), qos=1)
+                    forwarded = True
+                    logger.info(f"Forwarded HTTP control '{normalized_cmd}' to ESP32 via MQTT on topic {esp_topic}")
+                except Exception as e:
+                    dispatch_error = str(e)
+                    logger.warning(f"MQTT publish failed: {e}")
+            else:
+                dispatch_error = 'MQTT client not connected'
+                logger.warning('MQTT client not connected (local stop applied, ESP32 forward unavailable)')
+
+        # Safety commands reach the ESP32 before the (slower) local teardown runs.
+        scheduler = request.app.get('command_scheduler')
+        if normalized_cmd in SAFETY_COMMANDS:
+            forward_to_esp32()
+            if forwarded and scheduler:
+                scheduler.record_safety_forward(normalized_cmd, received_at, source='http')
+
+        # Local control actions
         try:
             if normalized_cmd == 'emergency_stop':
+                if scheduler:
+                    scheduler.preempt()
                 t = request.app.get('camera_keepalive_task')
                 if t:
                     t.cancel()
@@ -1585,9 +4214,8 @@ def main():
                     except Exception:
                         pass
                     request.app.pop('camera_keepalive_task', None)
-                # Ensure camera released
-                await SharedCamera.release_instance()
-                logger.info(f"Local keepalive stopped and camera released via /control ({normalized_cmd})")
+                # Cancelling the keepalive drops its pipeline reference; the pipeline owns the camera.
+                logger.info(f"Local keepalive stopped via /control ({normalized_cmd})")
 
             elif normalized_cmd == 'pause':
                 # stop keepalive but keep camera open for quicker resume
@@ -1599,10 +4227,12 @@ def main():
                     except Exception:
                         pass
                     request.app.pop('camera_keepalive_task', None)
-                try:
-                    await SharedCamera.get_instance(args.source)
-                except RuntimeError as e:
-                    return web.Response(status=503, text=f'Failed to open camera: {e}')
+                if float(getattr(args, 'camera_linger', 0.0)) <= 0:
+                    # Without linger, hold a reference by hand so resume does not reopen the device.
+                    try:
+                        await SharedCamera.get_instance(args.source)
+                    except RuntimeError as e:
+                        return web.Response(status=503, text=f'Failed to open camera: {e}')
                 logger.info('Local paused: camera open, inference stopped')
 
             elif normalized_cmd == 'reset':
@@ -1622,31 +4252,9 @@ def main():
             logger.error(f'Error handling control {normalized_cmd}: {e}', exc_info=True)
             return web.Response(status=500, text=f'Control handling failed: {e}')
 
-        # Forward to ESP32 via MQTT after local action has been applied.
-        mqtt_client = request.app.get('mqtt_client')
-        esp_topic_template = getattr(args, 'mqtt_esp_command_topic', 'nutricycle/esp32/{machineId}/command')
-        esp_topic = esp_topic_template.replace('{machineId}', machine_id)
-        payload = {
-            'machine_id': machine_id,
-            'machineId': machine_id,
-            'command': normalized_cmd,
-            'timestamp': time.time(),
-            'source': 'http_control',
-        }
-
-        forwarded = False
-        dispatch_error = None
-        if mqtt_client:
-            try:
-                mqtt_client.publish(esp_topic, json.dumps(payload), qos=1)
-                forwarded = True
-                logger.info(f"Forwarded HTTP control '{normalized_cmd}' to ESP32 via MQTT on topic {esp_topic}")
-            except Exception as e:
-                dispatch_error = str(e)
-                logger.warning(f"MQTT publish failed: {e}")
-        else:
-            dispatch_error = 'MQTT client not connected'
-            logger.warning('MQTT client not connected (local stop applied, ESP32 forward unavailable)')
+        # Routine commands are forwarded to ESP32 after the local action has been applied.
+        if normalized_cmd not in SAFETY_COMMANDS:
+            forward_to_esp32()
 
         return web.json_response({
             'success': True,
@@ -1659,21 +4267,215 @@ def main():
 
     app.router.add_post('/control', control_handler)
 
+    # Runtime config: GET shows the current version, POST applies settings live
+    # (requires --control-token). Body: {"conf": 0.4, ..., "expected_version": 3}
+    async def config_get_handler(request):
+        return web.json_response({
+            **runtime_config.as_dict(),
+            'configurable': [name for name in RuntimeConfig.FIELDS if name not in _fixed_config_fields()],
+        })
+
+    async def config_post_handler(request):
+        auth_error = _control_auth_error(request, required=True)
+        if auth_error is not None:
+            return auth_error
+        try:
+            data = await request.json()
+        except Exception:
+            return web.Response(status=400, text="Invalid JSON")
+        if not isinstance(data, dict):
+            return web.Response(status=400, text="Expected a JSON object")
+        expected_version = data.pop('expected_version', None)
+        try:
+            config, changed = await apply_runtime_config(data, source='http', expected_version=expected_version)
+        except ValueError as e:
+            return web.json_response({'error': str(e)}, status=400)
+        except RuntimeError as e:
+            return web.json_response({'error': str(e), 'version': runtime_config.version}, status=409)
+        return web.json_response({'changed': changed, 'config': config.as_dict()})
+
+    app.router.add_get('/config', config_get_handler)
+    app.router.add_post('/config', config_post_handler)
+
+    # Model hot-swap: POST {"path": "...", "force": false} starts a background load,
+    # warm-up and live-frame check; {"action": "rollback"} restores the previous model.
+    async def model_get_handler(request):
+        return web.json_response(model_swapper.snapshot())
+
+    async def model_post_handler(request):
+        auth_error = _control_auth_error(request, required=True)
+        if auth_error is not None:
+            return auth_error
+        try:
+            data = await request.json()
+        except Exception:
+            return web.Response(status=400, text="Invalid JSON")
+        if not isinstance(data, dict):
+            return web.Response(status=400, text="Expected a JSON object")
+        try:
+            if data.get('action') == 'rollback':
+                return web.json_response(model_swapper.rollback())
+            model_swapper.request(data.get('path'), force=bool(data.get('force', False)))
+        except ValueError as e:
+            return web.json_response({'error': str(e)}, status=400)
+        except RuntimeError as e:
+            return web.json_response({'error': str(e)}, status=409)
+        return web.json_response(model_swapper.snapshot(), status=202)
+
+    app.router.add_get('/model', model_get_handler)
+    app.router.add_post('/model', model_post_handler)
+
+    # Field diagnostics (token required). Idle cost is nil: the sampler thread lives only
+    # for one request and tracemalloc runs from the first /debug/memory until ?stop=1 or
+    # until --debug-memory-idle-s pass without another report.
+    stack_sampler = StackSampler()
+    memory_tracker = MemoryTracker(idle_s=args.debug_memory_idle_s)
+
+    async def debug_profile_handler(request):
+        """/debug/profile?seconds=10&interval_ms=5&format=collapsed|json"""
+        auth_error = _control_auth_error(request, required=True)
+        if auth_error is not None:
+            return auth_error
+        try:
+            seconds = float(request.query.get('seconds', 10))
+            interval = float(request.query.get('interval_ms', 5)) / 1000.0
+        except ValueError:
+            return web.Response(status=400, text="seconds and interval_ms must be numbers")
+        fmt = request.query.get('format', 'collapsed')
+        if fmt not in ('collapsed', 'json'):
+            return web.Response(status=400, text="format must be collapsed or json")
+        if stack_sampler.busy:
+            return web.Response(status=409, text="A profile is already running")
+        logger.info(f"Profiling all threads for {seconds:.1f}s ({request.remote})")
+        try:
+            profile = await asyncio.get_running_loop().run_in_executor(None, stack_sampler.sample, seconds, interval)
+        except RuntimeError as e:
+            return web.Response(status=409, text=str(e))
+        if fmt == 'json':
+            return web.json_response(StackSampler.summary(profile))
+        return web.Response(text=StackSampler.collapsed(profile), content_type='text/plain')
+
+    async def debug_memory_handler(request):
+        """/debug/memory?limit=25&group=lineno|filename|traceback, or ?stop=1 to end tracing."""
+        auth_error = _control_auth_error(request, required=True)
+        if auth_error is not None:
+            return auth_error
+        loop = asyncio.get_running_loop()
+        if request.query.get('stop', '').lower() in ('1', 'true', 'yes'):
+            return web.json_response(await loop.run_in_executor(None, memory_tracker.stop))
+        group = request.query.get('group', 'lineno')
+        if group not in ('lineno', 'filename', 'traceback'):
+            return web.Response(status=400, text="group must be lineno, filename or traceback")
+        try:
+            limit = int(request.query.get('limit', 25))
+        except ValueError:
+            return web.Response(status=400, text="limit must be an integer")
+        return web.json_response(await loop.run_in_executor(None, memory_tracker.report, limit, group))
+
+    app.router.add_get('/debug/profile', debug_profile_handler)
+    app.router.add_get('/debug/memory', debug_memory_handler)
+
     async def status_handler(request):
         """Return JSON status about camera, keepalive, and connections."""
         camera_running = SharedCamera._instance is not None
         ref_count = SharedCamera._instance.ref_count if SharedCamera._instance else 0
         keepalive_running = bool(request.app.get('camera_keepalive_task'))
         peers = len(pcs)
+        peer_budgets = await asyncio.gather(*(_peer_budget(pc, sess) for pc, sess in list(peer_sessions.items())))
+        scheduler = request.app.get('command_scheduler')
         return web.json_response({
             'camera_running': camera_running,
             'camera_ref_count': ref_count,
+            'camera_lifecycle': dict(SharedCamera.stats, linger_s=getattr(args, 'camera_linger', 0.0)),
+            'camera_preprocess': {
+                'source': SharedCamera._instance.cap.snapshot() if hasattr(SharedCamera._instance.cap, 'snapshot') else None,
+                'flip': SharedCamera._instance.flip_mode,
+                'hw_flip': SharedCamera._instance.hw_flip,
+                **SharedCamera._instance.preprocessor.stats,
+            } if SharedCamera._instance else None,
             'keepalive_running': keepalive_running,
-            'peer_connections': peers
+            'peer_connections': peers,
+            'peers': list(peer_budgets),
+            'viewer_limits': {
+                'max_webrtc_peers': getattr(args, 'max_webrtc_peers', 0),
+                'max_mjpeg_clients': getattr(args, 'max_mjpeg_clients', 0),
+                'peer_idle_timeout': getattr(args, 'peer_idle_timeout', 60),
+            },
+            'control_scheduler': scheduler.snapshot() if scheduler else None,
+            'mqtt_connected': bool(request.app.get('mqtt_connected') and request.app['mqtt_connected'].is_set()),
+            'event_channel': event_queue.snapshot(),
+            'alert_sequences': alert_sequencer.snapshot(),
+            'model_check': model_check,
+            'model_swap': model_swapper.snapshot() if model_swapper else None,
+            'cascade': detection_cascade.snapshot() if detection_cascade else None,
+            'runtime_config': runtime_config.as_dict(),
+            'latency_governor': latency_governor.snapshot() if latency_governor else None,
+            'trigger_pipeline': trigger_pipeline.snapshot() if trigger_pipeline else None,
+            'trigger_zones': trigger_zones.snapshot() if trigger_zones else None,
+            'detection_history': detection_history.snapshot() if detection_history else None,
+            'clip_recorder': clip_recorder.snapshot() if clip_recorder else None,
+            'hard_example_harvester': hard_example_harvester.snapshot() if hard_example_harvester else None,
+            'ws_detection_subscribers': detection_metadata.subscribers,
+            'mjpeg_clients': mjpeg_frames.subscribers,
+            'mjpeg': {**mjpeg_stats, 'max_fps': args.mjpeg_max_fps},
+            'video_relay': video_relay.snapshot() if video_relay else None,
+            'debug': {'profiling': stack_sampler.busy, 'memory': memory_tracker.snapshot()},
+            'memory_watchdog': memory_watchdog.snapshot() if memory_watchdog else None,
+            'process': dict(
+                process_stats(),
+                cpus=os.cpu_count(),
+                load_avg=[round(v, 2) for v in os.getloadavg()] if hasattr(os, 'getloadavg') else None,
+            ),
         })
 
     app.router.add_get('/status', status_handler)
 
+    async def detections_handler(request):
+        """Query per-frame detection history: /detections?since=&until=&batch=&transitions=1&limit=.
+
+        since/until are epoch seconds; negative values are relative to now (since=-600 = last 10 min).
+        The range is limited to --history-max-window seconds before until (or now).
+        """
+        if detection_history is None:
+            return web.Response(status=404, text='Detection history disabled')
+
+        def _time_param(name):
+            raw = request.query.get(name)
+            if raw is None or raw == '':
+                return None
+            value = float(raw)
+            return time.time() + value if value < 0 else value
+
+        try:
+            since = _time_param('since')
+            until = _time_param('until')
+            limit = max(1, min(int(request.query.get('limit', 5000)), 100000))
+        except ValueError:
+            return web.Response(status=400, text='since/until/limit must be numbers')
+        transitions_only = request.query.get('transitions', '').lower() in {'1', 'true', 'yes'}
+        batch = request.query.get('batch') or None
+        # An open or very long range would read every spilled segment; cap it (the effective
+        # since is echoed back).
+        window = float(args.history_max_window)
+        if window > 0:
+            floor = (until if until is not None else time.time()) - window
+            since = floor if since is None else max(since, floor)
+
+        rows = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(
+                detection_history.query, since, until, batch, transitions_only=transitions_only, limit=limit,
+            ),
+        )
+        return web.json_response({
+            'since': since,
+            'until': until,
+            'batch': batch,
+            'count': int(len(rows)),
+            'records': DetectionHistory.to_records(rows),
+        })
+
+    app.router.add_get('/detections', detections_handler)
+
     async def ice_config_handler(request):
         """Return ICE configuration for browser clients."""
         return web.json_response(
@@ -1687,8 +4489,7 @@ def main():
 
     async def last_frame_handler(request):
         """Return the latest annotated frame as JPEG for quick previews."""
-        async with latest_frame_lock:
-            data = globals().get('latest_frame_jpeg')
+        data = latest_frame_jpeg
         if not data:
             return web.Response(status=404, text='No frame available')
         headers = {'Cache-Control': 'no-cache, no-store, must-revalidate'}
@@ -1696,45 +4497,77 @@ def main():
 
     app.router.add_get('/last_frame.jpg', last_frame_handler)
 
-    async def mjpeg_handler(request):
-        """Serve latest frames as MJPEG over HTTP (fallback when WebRTC fails)."""
-        boundary = 'frame'
-        resp = web.StreamResponse(
-            status=200,
-            reason='OK',
-            headers={
-                'Content-Type': f'multipart/x-mixed-replace; boundary={boundary}',
-                'Cache-Control': 'no-cache, no-store, must-revalidate',
-                'Pragma': 'no-cache',
-                'Connection': 'keep-alive',
-            },
-        )
-        await resp.prepare(request)
+    placeholder_chunk = None
+    mjpeg_stats = {'clients_total': 0, 'frames_sent': 0, 'bytes_sent': 0, 'evicted_idle': 0}
 
-        # Tiny black placeholder while first annotated frame is not available yet.
-        placeholder = np.zeros((240, 320, 3), dtype=np.uint8)
-        cv2.putText(placeholder, 'Waiting for frame...', (20, 130), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-        ok, buf = cv2.imencode('.jpg', placeholder)
-        placeholder_jpeg = buf.tobytes() if ok else b''
+    async def mjpeg_handler(request):
+        """Serve latest frames as MJPEG over HTTP (fallback when WebRTC fails).
 
+        Wakes only when a new frame is published and writes the shared multipart chunk.
+        ?fps= caps the rate for this client; a slow client drops frames instead of buffering.
+        """
+        nonlocal placeholder_chunk
+        try:
+            fps_cap = float(request.query.get('fps') or getattr(args, 'mjpeg_max_fps', 10.0))
+        except ValueError:
+            return web.Response(status=400, text='fps must be a number')
+        max_fps = float(getattr(args, 'mjpeg_max_fps', 10.0))
+        if max_fps > 0:
+            fps_cap = min(fps_cap, max_fps) if fps_cap > 0 else max_fps
+        min_interval = 1.0 / fps_cap if fps_cap > 0 else 0.0
+
+        max_clients = int(getattr(args, 'max_mjpeg_clients', 0))
+        if max_clients > 0 and mjpeg_frames.subscribers >= max_clients:
+            return _viewer_limit_response('mjpeg', max_clients)
+        # A client whose socket stays blocked this long is evicted instead of holding a slot.
+        write_timeout = float(getattr(args, 'peer_idle_timeout', 60)) or None
+
+        # Claim the slot before any await so concurrent requests cannot overshoot the limit.
+        mjpeg_frames.subscribers += 1
+        mjpeg_stats['clients_total'] += 1
         try:
+            resp = web.StreamResponse(
+                status=200,
+                reason='OK',
+                headers={
+                    'Content-Type': f'multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}',
+                    'Cache-Control': 'no-cache, no-store, must-revalidate',
+                    'Pragma': 'no-cache',
+                    'Connection': 'keep-alive',
+                },
+            )
+            await resp.prepare(request)
+
+            if placeholder_chunk is None:
+                # Tiny black placeholder while first annotated frame is not available yet.
+                placeholder = np.zeros((240, 320, 3), dtype=np.uint8)
+                cv2.putText(placeholder, 'Waiting for frame...', (20, 130), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+                ok, buf = cv2.imencode('.jpg', placeholder)
+                placeholder_chunk = _mjpeg_chunk(buf.tobytes() if ok else b'')
+
+            # Start with whatever is current so the viewer sees an image immediately.
+            version = mjpeg_frames.version
+            chunk = _mjpeg_chunk(latest_frame_jpeg) if latest_frame_jpeg else placeholder_chunk
             while True:
-                async with latest_frame_lock:
-                    data = globals().get('latest_frame_jpeg')
-                if not data:
-                    data = placeholder_jpeg
-
-                chunk = (
-                    f'--{boundary}\r\n'
-                    'Content-Type: image/jpeg\r\n'
-                    f'Content-Length: {len(data)}\r\n\r\n'
-                ).encode('ascii') + data + b'\r\n'
-
-                await resp.write(chunk)
-                await asyncio.sleep(0.25)
+                sent_at = time.monotonic()
+                await asyncio.wait_for(resp.write(chunk), timeout=write_timeout)
+                mjpeg_stats['frames_sent'] += 1
+                mjpeg_stats['bytes_sent'] += len(chunk)
+                interval = trigger_pipeline.mjpeg_interval(min_interval) if trigger_pipeline else min_interval
+                if interval:
+                    await asyncio.sleep(max(0.0, interval - (time.monotonic() - sent_at)))
+                try:
+                    version, chunk = await asyncio.wait_for(mjpeg_frames.wait_newer(version), timeout=5.0)
+                except asyncio.TimeoutError:
+                    # No new frames (camera idle): resend the last one to keep proxies from timing out.
+                    pass
+        except asyncio.TimeoutError:
+            mjpeg_stats['evicted_idle'] += 1
+            logger.warning(f"Evicting stalled MJPEG client {request.remote}")
         except (asyncio.CancelledError, ConnectionResetError, BrokenPipeError):
             pass
         finally:
+            mjpeg_frames.subscribers -= 1
             with contextlib.suppress(Exception):
                 await resp.write_eof()
 
@@ -1743,8 +4576,15 @@ def main():
     app.router.add_get('/mjpeg', mjpeg_handler)
 
     async def _start_background_tasks(app):
+        app['command_scheduler'] = CommandScheduler(
+            asyncio.get_running_loop(),
+            getattr(args, 'safety_latency_budget_ms', 50.0),
+        )
         app['announce_task'] = asyncio.create_task(announce_task(app))
         app['event_broadcaster_task'] = asyncio.create_task(event_broadcaster(app))
+        app['peer_idle_reaper_task'] = asyncio.create_task(peer_idle_reaper())
+        if memory_watchdog is not None:
+            app['memory_watchdog_task'] = asyncio.create_task(memory_watchdog_task())
         auto_persistent = getattr(args, 'persistent', False) or bool(getattr(args, 'mqtt_broker', None))
         if auto_persistent:
             app['camera_keepalive_task'] = asyncio.create_task(camera_keepalive(app))
@@ -1753,7 +4593,8 @@ def main():
 
     async def _cleanup_background_tasks(app):
         # Cancel background tasks
-        for name in ('announce_task', 'event_broadcaster_task', 'camera_keepalive_task'):
+        for name in ('announce_task', 'event_broadcaster_task', 'peer_idle_reaper_task', 'memory_watchdog_task',
+                     'camera_keepalive_task'):
             t = app.get(name)
             if t:
                 t.cancel()
@@ -1779,10 +4620,19 @@ def main():
             except Exception as e:
                 logger.warning(f"Failed to send offline status: {e}")
         
+        if trigger_pipeline is not None:
+            await trigger_pipeline.close()
+
+        if detection_history is not None:
+            # After the pipeline stops, so the partial segment holds every row written.
+            flushed = detection_history.flush()
+            if flushed:
+                logger.info(f"Detection history: wrote the last {flushed} rows to {detection_history.spill_dir}")
+
         # Ensure camera released if persistent task was not running or left a reference
         try:
-            # Attempt a graceful release in case refs linger
-            await SharedCamera.release_instance()
+            # Close immediately: no point lingering while the server shuts down
+            await SharedCamera.close_now()
         except Exception:
             pass
 